@@ -0,0 +1,305 @@
+"""JSON API for Blogly, mounted at /api/v1.
+
+    GET /api/v1/<users|posts|tags>             one page of a listing
+    GET /api/v1/<users|posts|tags>/<id>        a single row
+    GET /api/v1/search?q=<words>&tags=<id>     posts ranked by relevance
+
+Query parameters:
+    fields=id,title      only return these fields of the main resource
+    include=tags,user    embed related rows, fetched with one query per relation
+    after/before=<cursor>, limit=<n>   keyset pagination of listings
+    format=ndjson        stream the whole listing, one JSON object per line
+                         (also chosen by Accept: application/x-ndjson)
+
+    POST /api/v1/posts/bulk                    create many posts (BLOGLY_BULK_INGEST)
+
+The bulk endpoint takes {"posts": [...]} or NDJSON, one post per line:
+{"title": ..., "content": ..., "user_id": ..., "tags": [names], "created_at": ...}.
+Tags are created as needed. Posts are written through the write queue, so
+posts from concurrent requests are committed together; the response, with
+the new ids in order, is sent once they are committed.
+"""
+
+import json
+from datetime import datetime
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
+from models import db, User, Post, Tag, PostTag
+from pagination import paginate
+from search import search_posts
+from writequeue import write_queue
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+STREAM_BATCH_SIZE = 1000
+NDJSON = 'application/x-ndjson'
+MAX_BULK_POSTS = 5000
+
+
+def _group(pairs):
+    grouped = {}
+    for key, value in pairs:
+        grouped.setdefault(key, []).append(value)
+    return grouped
+
+
+def _users_by_id(user_ids):
+    return {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+
+
+def _include_post_user(posts):
+    users = _users_by_id({post.user_id for post in posts})
+    return {post.id: serialize(users.get(post.user_id), USER_FIELDS) for post in posts}
+
+
+def _include_post_tags(posts):
+    rows = db.session.execute(select(PostTag.post_id, Tag)
+                              .join(Tag, Tag.id == PostTag.tag_id)
+                              .where(PostTag.post_id.in_([post.id for post in posts]))
+                              .order_by(Tag.name))
+    tags = _group((post_id, serialize(tag, TAG_FIELDS)) for post_id, tag in rows)
+    return {post.id: tags.get(post.id, []) for post in posts}
+
+
+def _include_user_posts(users):
+    rows = (Post.query.filter(Post.user_id.in_([user.id for user in users]))
+            .order_by(Post.created_at.desc(), Post.id.desc()))
+    posts = _group((post.user_id, serialize(post, POST_FIELDS)) for post in rows)
+    return {user.id: posts.get(user.id, []) for user in users}
+
+
+def _include_tag_posts(tags):
+    rows = db.session.execute(select(PostTag.tag_id, Post)
+                              .join(Post, Post.id == PostTag.post_id)
+                              .where(PostTag.tag_id.in_([tag.id for tag in tags]))
+                              .order_by(Post.created_at.desc(), Post.id.desc()))
+    posts = _group((tag_id, serialize(post, POST_FIELDS)) for tag_id, post in rows)
+    return {tag.id: posts.get(tag.id, []) for tag in tags}
+
+
+class Resource:
+    """How one model is listed, serialized and expanded by the API."""
+
+    def __init__(self, model, fields, sort_key, descending=False, includes=None, requires=None):
+        self.model = model
+        self.fields = fields
+        self.sort_key = sort_key
+        self.descending = descending
+        self.includes = includes or {}
+        # columns a field or include needs loaded, besides itself
+        self.requires = requires or {}
+
+    def columns(self, fields, includes):
+        """The columns to load for the requested fields, sort key and includes."""
+        names = {'id', *(column.key for column in self.sort_key())}
+        for name in (*fields, *includes):
+            names.update(self.requires.get(name, ()))
+            if name in self.model.__table__.columns.keys():
+                names.add(name)
+        return [getattr(self.model, name) for name in sorted(names)]
+
+
+USER_FIELDS = ('id', 'first_name', 'last_name', 'full_name', 'image_url')
+POST_FIELDS = ('id', 'title', 'content', 'created_at', 'user_id')
+TAG_FIELDS = ('id', 'name')
+
+RESOURCES = {
+    'users': Resource(User, USER_FIELDS, lambda: (User.last_name, User.first_name, User.id),
+                      includes={'posts': _include_user_posts},
+                      requires={'full_name': ('first_name', 'last_name')}),
+    'posts': Resource(Post, POST_FIELDS, lambda: (Post.created_at, Post.id), descending=True,
+                      includes={'user': _include_post_user, 'tags': _include_post_tags},
+                      requires={'user': ('user_id',)}),
+    'tags': Resource(Tag, TAG_FIELDS, lambda: (Tag.name, Tag.id),
+                     includes={'posts': _include_tag_posts}),
+}
+
+
+def serialize(row, fields):
+    """Dict of the given fields of a model instance."""
+    if row is None:
+        return None
+    data = {}
+    for field in fields:
+        value = getattr(row, field)
+        data[field] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+def _resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        abort(404)
+    return resource
+
+
+def _requested(param, allowed):
+    """Parse a comma-separated query parameter, rejecting unknown names."""
+    raw = request.args.get(param)
+    if not raw:
+        return None
+    names = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = sorted(set(names) - set(allowed))
+    if unknown:
+        abort(400, f'Unknown {param}: {", ".join(unknown)}')
+    return names
+
+
+def _fields_and_includes(resource):
+    fields = _requested('fields', resource.fields) or list(resource.fields)
+    includes = _requested('include', resource.includes) or []
+    return fields, includes
+
+
+def _render(resource, rows, fields, includes):
+    """Serialize rows, embedding the includes fetched once for all of them."""
+    included = {name: resource.includes[name](rows) for name in includes} if rows else {}
+    items = []
+    for row in rows:
+        item = serialize(row, fields)
+        for name in includes:
+            item[name] = included[name][row.id]
+        items.append(item)
+    return items
+
+
+def _wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def _stream(resource, fields, includes):
+    """Stream every row as NDJSON through a server-side cursor."""
+    statement = (select(resource.model)
+                 .options(load_only(*resource.columns(fields, includes)))
+                 .order_by(resource.model.id)
+                 .execution_options(yield_per=STREAM_BATCH_SIZE))
+
+    def generate():
+        result = db.session.execute(statement)
+        for partition in result.scalars().partitions():
+            for item in _render(resource, partition, fields, includes):
+                yield json.dumps(item) + '\n'
+            # Rows of finished batches are no longer needed.
+            db.session.expunge_all()
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def _limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        abort(400, f'limit must be between 1 and {MAX_LIMIT}')
+    return limit
+
+
+@api.route('/search')
+def search():
+    """Posts matching q (and having every one of tags), most relevant first."""
+    fields = _requested('fields', POST_FIELDS) or list(POST_FIELDS)
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0:
+        abort(400, 'offset must not be negative')
+    results = search_posts(request.args.get('q', ''), request.args.getlist('tags', type=int),
+                           limit=_limit(), offset=offset)
+    return jsonify(data=[{**serialize(result.post, fields), 'rank': result.rank, 'snippet': str(result.snippet)}
+                         for result in results])
+
+
+def _bulk_post(item, number):
+    """Validate one post of a bulk request, as a row for the write queue."""
+    def invalid(message):
+        abort(400, f'Post {number}: {message}')
+
+    if not isinstance(item, dict):
+        invalid('must be an object')
+    title, content, user_id = item.get('title'), item.get('content'), item.get('user_id')
+    if not isinstance(title, str) or not 0 < len(title) <= Post.title.type.length:
+        invalid(f'title must be a string of 1 to {Post.title.type.length} characters')
+    if content is not None and not isinstance(content, str):
+        invalid('content must be a string')
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        invalid('user_id must be an integer')
+    tags = item.get('tags', [])
+    if not isinstance(tags, list) or not all(isinstance(name, str) and 0 < len(name.strip()) <= Tag.name.type.length
+                                             for name in tags):
+        invalid(f'tags must be a list of names of 1 to {Tag.name.type.length} characters')
+    row = {'title': title, 'content': content, 'user_id': user_id, 'tags': sorted({name.strip() for name in tags})}
+    if item.get('created_at') is not None:
+        try:
+            row['created_at'] = datetime.fromisoformat(item['created_at'])
+        except (TypeError, ValueError):
+            invalid('created_at must be an ISO 8601 timestamp')
+    return row
+
+
+def _bulk_items():
+    if request.mimetype == NDJSON:
+        try:
+            return [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            abort(400, 'Invalid NDJSON')
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('posts'), list):
+        abort(400, 'Expected {"posts": [...]} or NDJSON')
+    return body['posts']
+
+
+@api.route('/posts/bulk', methods=['POST'])
+def bulk_create_posts():
+    """Create many posts, committed together with those of concurrent requests."""
+    if not current_app.config.get('BLOGLY_BULK_INGEST'):
+        abort(404)
+    items = _bulk_items()
+    if not 0 < len(items) <= MAX_BULK_POSTS:
+        abort(400, f'Send between 1 and {MAX_BULK_POSTS} posts')
+    rows = [_bulk_post(item, number) for number, item in enumerate(items)]
+    try:
+        ids = write_queue.submit(rows)
+    except IntegrityError:
+        abort(422, 'The posts could not be written; check that every user_id exists')
+    except TimeoutError as e:
+        abort(503, str(e))
+    return jsonify(data=[{'id': post_id} for post_id in ids]), 201
+
+
+@api.route('/<name>')
+def list_resource(name):
+    """One page of users, posts or tags (or all of them as NDJSON)."""
+    resource = _resource(name)
+    fields, includes = _fields_and_includes(resource)
+    if _wants_ndjson():
+        return _stream(resource, fields, includes)
+
+    limit = _limit()
+    rows = resource.model.query.options(load_only(*resource.columns(fields, includes)))
+    try:
+        page = paginate(rows, resource.sort_key(),
+                        after=request.args.get('after'), before=request.args.get('before'),
+                        per_page=limit, descending=resource.descending)
+    except ValueError as e:
+        abort(400, str(e))
+
+    return jsonify(data=_render(resource, page.items, fields, includes),
+                   next=page.next_cursor, prev=page.prev_cursor)
+
+
+@api.route('/<name>/<int:row_id>')
+def show_resource(name, row_id):
+    """A single user, post or tag."""
+    resource = _resource(name)
+    fields, includes = _fields_and_includes(resource)
+    row = resource.model.query.options(load_only(*resource.columns(fields, includes))).get_or_404(row_id)
+    return jsonify(data=_render(resource, [row], fields, includes)[0])
+
+
+@api.errorhandler(HTTPException)
+def api_error(e):
+    """Errors of API views are JSON too."""
+    return jsonify(error=e.description), e.code
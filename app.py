@@ -1,47 +1,136 @@
 """Blogly application."""
 
-from flask import Flask, redirect, render_template, request, flash
-from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
+import os
+from flask import Blueprint, Flask, abort, current_app, make_response, redirect, render_template, request, flash
+from markupsafe import Markup
+from models import db, connect_db, User, Post, Tag, PostTag, tag_name
+from config import PROFILES
+from queries import query
+from pagination import paginate_request, cursor_url, DEFAULT_PAGE_SIZE
+from migrations import migrate_command
+from query_plans import check_plans_command
+from associations import sync_post_tags, sync_tag_posts
+from counters import counters_command, trending_command, trending, uncount_posts
+from seeding import seed_command
+from cache import cache
+from instrumentation import instrumentation
+from templating import templates, render_macro
+from writequeue import write_queue
+from tag_dictionary import tag_dictionary
+from deletions import soft_delete, purger, purge_command
+from transfer import blogly_command
+from feeds import feeds, feeds_command, GLOBAL, user_feed, tag_feed
+from conditional import conditional_page
+from api import api
+from search import search_posts
 from datetime import datetime, timezone
-
-app = Flask(__name__)
-# app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['SECRET_KEY'] = 'Orion'
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-debug = DebugToolbarExtension(app)
-
-connect_db(app)
-
-@app.route('/')
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+
+views = Blueprint('blogly', __name__)
+
+# Entries of the Atom feeds.
+ATOM_ENTRIES = 20
+
+def create_app(profile=None):
+    """Create the Blogly app with the dev, test or prod configuration profile.
+
+    The profile defaults to the BLOGLY_PROFILE environment variable, then 'dev'.
+    """
+    profile = profile or os.environ.get('BLOGLY_PROFILE', 'dev')
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown configuration profile: {profile}')
+
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile]())
+
+    if app.config['DEBUG_TOOLBAR']:
+        # Only imported (and only instrumenting requests) in development.
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+    app.jinja_env.globals['cursor_url'] = cursor_url
+    templates.init_app(app)
+
+    connect_db(app)
+    cache.init_app(app)
+    instrumentation.init_app(app)
+    write_queue.init_app(app)
+    tag_dictionary.init_app(app)
+    purger.init_app(app)
+    feeds.init_app(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_plans_command)
+    app.cli.add_command(counters_command)
+    app.cli.add_command(trending_command)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(purge_command)
+    app.cli.add_command(blogly_command)
+    app.cli.add_command(feeds_command)
+    return app
+
+def card_deps(post):
+    """Cache dependencies of a post card: the post, its author and its tags."""
+    return {f'post:{post.id}', f'user:{post.user_id}', *(f'tag:{tag.id}' for tag in post.tags)}
+
+def post_card(post):
+    """Rendered HTML card of a post loaded with the post_card profile."""
+    return Markup(cache.cached(f'card:{post.id}',
+                               lambda: (str(render_macro('macros.html', 'post_card', post)), card_deps(post))))
+
+@views.route('/')
 def root():
     """Home/root page."""
-    posts = Post.query.order_by(Post.created_at.desc()).limit(5).all()
-    return render_template('home_page.html', posts=posts)
-
-@app.route('/users')
+    def render():
+        posts = feeds.posts(GLOBAL, 5)
+        deps = set().union({'posts'}, *(card_deps(post) for post in posts))
+        return render_template('home_page.html', cards=[post_card(post) for post in posts]), deps
+    return conditional_page(render)
+
+def atom_page(feed, page, title):
+    """Serve the newest posts of a feed as an Atom document.
+
+    page is the path of the HTML page of the feed; title() gives the title
+    of the feed (or aborts), called only when it is rendered.
+    """
+    def render():
+        heading = title()
+        posts = feeds.posts(feed, ATOM_ENTRIES)
+        updated = posts[0].created_at if posts else datetime.now(timezone.utc)
+        xml = render_template('feed.xml', title=heading, page=page, posts=posts, updated=updated)
+        # The cache keys of the global, user and tag feeds are 'posts', 'user:<id>' and 'tag:<id>'.
+        return xml, set().union({'posts' if feed == GLOBAL else feed}, *(card_deps(post) for post in posts))
+    response = make_response(conditional_page(render))
+    response.mimetype = 'application/atom+xml'
+    return response
+
+@views.route('/feed.atom')
+def recent_posts_feed():
+    """Atom feed of the newest posts."""
+    return atom_page(GLOBAL, '/', lambda: 'Blogly Recent Posts')
+
+@views.route('/users')
 def list_users():
     """Show a list of all users in the db"""
-    users = User.query.order_by('last_name', 'first_name').all()
-    return render_template('list_users.html', users=users)
+    if request.args.get('sort') == 'popular':
+        users = paginate_request(query(User), (User.post_count, User.id), descending=True)
+    else:
+        users = paginate_request(query(User), (User.last_name, User.first_name, User.id))
+    return render_template('list_users.html', users=users, sort=request.args.get('sort'))
 
-@app.route('/users/new')
+@views.route('/users/new')
 def add_user_form():
     """Show the add a new user form."""
     return render_template('add_user.html')
 
-@app.route('/users/new', methods=['POST'])
+@views.route('/users/new', methods=['POST'])
 def submit_new_user():
     """Get info from the add new user form, save info to database, redirect to all-users page."""
     first_name = request.form['fname']
     last_name = request.form['lname']
     image_url = request.form['image-url'] if request.form['image-url'] else None
 
-    import pdb
-    pdb.set_trace()
     new_user = User(first_name=first_name, last_name=last_name, image_url=image_url)
     db.session.add(new_user)
     db.session.commit()
@@ -51,22 +140,32 @@ def submit_new_user():
 
     return redirect('/users')
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
 def show_user_details(user_id):
     """Show details of a user and a list of his/her posts"""
-    user = User.query.get_or_404(user_id)
-    return render_template('user_details.html', user=user)
-
-@app.route('/users/<int:user_id>/edit')
+    def render():
+        user = query(User).get_or_404(user_id)
+        posts = paginate_request(query(Post).filter_by(user_id=user_id), (Post.created_at, Post.id), descending=True)
+        deps = {f'user:{user_id}', *(f'post:{post.id}' for post in posts)}
+        return render_template('user_details.html', user=user, posts=posts), deps
+    return conditional_page(render)
+
+@views.route('/users/<int:user_id>/feed.atom')
+def user_posts_feed(user_id):
+    """Atom feed of the newest posts of a user."""
+    return atom_page(user_feed(user_id), f'/users/{user_id}',
+                     lambda: f'Posts by {query(User).get_or_404(user_id).full_name}')
+
+@views.route('/users/<int:user_id>/edit')
 def edit_user_form(user_id):
     """Edit user info page."""
-    user = User.query.get(user_id)
+    user = query(User).get_or_404(user_id)
     return render_template('edit_user.html', user=user)
 
-@app.route('/users/<int:user_id>/edit', methods=['POST'])
+@views.route('/users/<int:user_id>/edit', methods=['POST'])
 def submit_user_edit(user_id):
     """Get info from edit user page, update database, redirect back to all-users page."""
-    user = User.query.get(user_id)
+    user = query(User).get_or_404(user_id)
     user.first_name = request.form['fname']
     user.last_name = request.form['lname']
     user.image_url = request.form['image-url']
@@ -78,78 +177,69 @@ def submit_user_edit(user_id):
 
     return redirect('/users')
 
-@app.route('/users/<int:user_id>/delete', methods=['POST'])
+@views.route('/users/<int:user_id>/delete', methods=['POST'])
 def delete_user(user_id):
     """Delete user and redirect back to all-users page."""
-    User.query.filter_by(id=user_id).delete()
+    # hidden at once, purged with their posts in the background
+    soft_delete(query(User).get_or_404(user_id))
     db.session.commit()
+    purger.wake()
 
     # add flash message for success in deleting user
     flash(f'User with an id of {user_id} was deleted!')
     return redirect('/users')
 
-@app.route('/users/<int:user_id>/posts/new')
+@views.route('/users/<int:user_id>/posts/new')
 def new_post_form(user_id):
     """Add a new post form."""
-    user = User.query.get(user_id)
-    tags = Tag.query.all()
-    return render_template('add_post.html', user=user, tags=tags)
+    user = query(User).get_or_404(user_id)
+    return render_template('add_post.html', user=user, tags=tag_dictionary.all())
 
-@app.route('/users/<int:user_id>/posts/new', methods=['POST'])
+@views.route('/users/<int:user_id>/posts/new', methods=['POST'])
 def submit_new_post(user_id):
     """Get info from add new post form, save to database, redirect to the user's detail page."""
     post_title = request.form['ptitle']
     post_content = request.form['pcontent']
     post_user_id = user_id
     new_post = Post(title=post_title, content=post_content, user_id=post_user_id)
+    db.session.add(new_post)
+    db.session.flush()
 
     # add tags-posts relationship
-    for key in request.form.keys():
-        if key.startswith('tag-'):
-            tag_id = int(key[4:])
-            tag = Tag.query.get(tag_id)
-            new_post.tags.append(tag)
+    tag_ids = [int(key[4:]) for key in request.form.keys() if key.startswith('tag-')]
+    sync_post_tags(new_post, tag_dictionary.known(tag_ids))
 
-    db.session.add(new_post)
     db.session.commit()
 
     # add flash message for success in adding a new post
     flash('A new post was successfully created!')
     return redirect(f'/users/{user_id}')
 
-@app.route('/posts/<int:post_id>')
+@views.route('/posts/<int:post_id>')
 def show_post_details(post_id):
     """Page to show the detailed content of a post."""
-    post = Post.query.get(post_id)
-    return render_template('post_details.html', post=post)
+    def render():
+        post = query(Post, 'post_card').get_or_404(post_id)
+        return render_template('post_details.html', post=post), card_deps(post)
+    return conditional_page(render)
 
-@app.route('/posts/<int:post_id>/edit')
+@views.route('/posts/<int:post_id>/edit')
 def edit_post_form(post_id):
     """Page to edit a post."""
-    post = Post.query.get(post_id)
-    tags = Tag.query.all()
-    return render_template('edit_post.html', post=post, tags=tags)
+    post = query(Post, 'post_form').get_or_404(post_id)
+    return render_template('edit_post.html', post=post, tags=tag_dictionary.all(),
+                           selected={tag.id for tag in post.tags})
 
-@app.route('/posts/<int:post_id>/edit', methods=['POST'])
+@views.route('/posts/<int:post_id>/edit', methods=['POST'])
 def submit_post_edit(post_id):
     """Get info from post edit page, update database, redirect back to the post detail page."""
-    post = Post.query.get_or_404(post_id)
+    post = query(Post).get_or_404(post_id)
     post.title = request.form['ptitle']
     post.content = request.form['pcontent']
     post.created_at = datetime.now(timezone.utc)
 
     # Update post-tag relationship
-    current_tag_ids = [tag.id for tag in post.tags]
-    new_tag_ids = [int(id) for id in request.form.getlist('tags')]
-    combined_tag_ids = set(current_tag_ids + new_tag_ids)
-    tag_ids_2_delete = [id for id in combined_tag_ids if (id in current_tag_ids) and (id not in new_tag_ids)]
-    tag_ids_2_add = [id for id in combined_tag_ids if (id not in current_tag_ids) and (id in new_tag_ids)]
-    # delete tags that are no longer checked by user
-    for tag_id in tag_ids_2_delete:
-        PostTag.query.filter_by(post_id=post.id, tag_id=tag_id).delete()
-    # Add new tags
-    for tag_id in tag_ids_2_add:
-        post.posts_tags.append(PostTag(post_id=post.id, tag_id=tag_id))
+    sync_post_tags(post, tag_dictionary.known([int(id) for id in request.form.getlist('tags')]))
 
     db.session.add(post)
     db.session.commit()
@@ -158,77 +248,105 @@ def submit_post_edit(post_id):
     flash('Your post was modified!')
     return redirect(f'/posts/{post_id}')
 
-@app.route('/posts/<int:post_id>/delete', methods=['POST'])
+@views.route('/posts/<int:post_id>/delete', methods=['POST'])
 def delete_post(post_id):
     """delete a post, update database, redirect to user detail page."""
-    user_id = Post.query.get(post_id).user.id
-    Post.query.filter_by(id=post_id).delete()
+    uncount_posts([post_id])
+    # one statement, which also tells where to go next
+    user_id = db.session.execute(delete(Post).where(Post.id == post_id).returning(Post.user_id)).scalar()
+    if user_id is None:
+        db.session.rollback()
+        abort(404)
     db.session.commit()
 
     # add flash message for success in deleting a post
     flash(f'Your post was deleted!')
     return redirect(f'/users/{user_id}')
 
-@app.route('/tags')
+@views.route('/tags')
 def list_all_tags():
     """A page to list all available tags."""
-    all_tags = Tag.query.all()
-    return render_template('list_tags.html', tags=all_tags)
+    if request.args.get('sort') == 'popular':
+        all_tags = paginate_request(query(Tag), (Tag.post_count, Tag.id), descending=True)
+    else:
+        all_tags = paginate_request(query(Tag), (Tag.name, Tag.id))
+    return render_template('list_tags.html', tags=all_tags, sort=request.args.get('sort'), trending=trending())
 
-@app.route('/tags/<int:tag_id>')
+@views.route('/tags/<int:tag_id>')
 def show_tag_details(tag_id):
     """A page to show the details of a tag."""
-    tag = Tag.query.get(tag_id)
-    return render_template('tag_details.html', tag=tag)
-
-@app.route('/tags/new')
+    def render():
+        tag = query(Tag).get_or_404(tag_id)
+        tagged_posts = query(Post).join(PostTag).filter(PostTag.tag_id == tag_id)
+        posts = paginate_request(tagged_posts, (Post.created_at, Post.id), descending=True)
+        deps = {f'tag:{tag_id}', *(f'post:{post.id}' for post in posts)}
+        return render_template('tag_details.html', tag=tag, posts=posts), deps
+    return conditional_page(render)
+
+@views.route('/tags/<int:tag_id>/feed.atom')
+def tag_posts_feed(tag_id):
+    """Atom feed of the newest posts with a tag."""
+    return atom_page(tag_feed(tag_id), f'/tags/{tag_id}', lambda: f'Posts tagged {query(Tag).get_or_404(tag_id).name}')
+
+@views.route('/tags/new')
 def add_tag():
     """Add a new tag form page."""
-    all_posts = Post.query.all()
+    all_posts = query(Post, 'post_title').order_by(Post.id).all()
     return render_template('add_tag.html', posts=all_posts)
 
-@app.route('/tags/new', methods=['POST'])
+@views.route('/tags/new', methods=['POST'])
 def submit_new_tag():
     """Process add new tag form, add a new tag to database, redirect to all tag page."""
-    tag_name = request.form['tname']
-    new_tag = Tag(name=tag_name)
+    name = tag_name(request.form['tname'])
+    existing = tag_dictionary.find(name)
+    if existing is not None:
+        flash(f'Tag {existing.name} already exists.')
+        return redirect('/tags/new')
+    new_tag = Tag(name=name)
+    db.session.add(new_tag)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # created by a concurrent request since the dictionary looked
+        db.session.rollback()
+        flash(f'Tag {name} already exists.')
+        return redirect('/tags/new')
 
-    for post_id in request.form.getlist('posts'):
-        new_tag.posts.append(Post.query.get(int(post_id)))
+    sync_tag_posts(new_tag, [int(post_id) for post_id in request.form.getlist('posts')])
 
-    db.session.add(new_tag)
     db.session.commit()
 
     # flash a message to user for successful tag edit
-    flash(f'Tag {tag_name} has been added.')
+    flash(f'Tag {name} has been added.')
 
     return redirect('/tags')
 
-@app.route('/tags/<int:tag_id>/edit')
+@views.route('/tags/<int:tag_id>/edit')
 def edit_tag(tag_id):
     """A page to display the edit a tag form."""
-    tag = Tag.query.get(tag_id)
-    all_posts = Post.query.all()
+    tag = query(Tag, 'tag_with_posts').get_or_404(tag_id)
+    all_posts = query(Post, 'post_title').order_by(Post.id).all()
     return render_template('edit_tag.html', tag=tag, posts=all_posts)
 
-@app.route('/tags/<int:tag_id>/edit', methods=['POST'])
+@views.route('/tags/<int:tag_id>/edit', methods=['POST'])
 def submit_tag_edit(tag_id):
     """Process edit tag form, update database, redirect to all tag list."""
-    tag = Tag.query.get_or_404(tag_id)
-    tag.name = request.form['tname']
+    tag = query(Tag).get_or_404(tag_id)
+    name = tag_name(request.form['tname'])
+    existing = tag_dictionary.find(name)
+    if existing is not None and existing.id != tag_id:
+        flash(f'Tag {existing.name} already exists.')
+        return redirect(f'/tags/{tag_id}/edit')
+    tag.name = name
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        flash(f'Tag {name} already exists.')
+        return redirect(f'/tags/{tag_id}/edit')
 
     # Update posts linked to this tag
-    current_post_ids = [post.id for post in tag.posts]
-    new_post_ids = [int(id) for id in request.form.getlist('posts')]
-    combined_post_ids = set(current_post_ids + new_post_ids)
-    post_ids_2_delete = [id for id in combined_post_ids if id in current_post_ids and id not in new_post_ids]
-    post_ids_2_add = [id for id in combined_post_ids if id not in current_post_ids and id in new_post_ids]
-    # delete unchecked ids
-    for id in post_ids_2_delete:
-        PostTag.query.filter_by(post_id=id, tag_id=tag_id).delete()
-    # add newly checked ids
-    for id in post_ids_2_add:
-        tag.posts_tags.append(PostTag(post_id=id, tag_id=tag_id))
+    sync_tag_posts(tag, [int(id) for id in request.form.getlist('posts')])
 
     db.session.add(tag)
     db.session.commit()
@@ -237,17 +355,31 @@ def submit_tag_edit(tag_id):
     flash(f'Tag {tag.name} has been modified.')
     return redirect('/tags')
 
-@app.route('/tags/<int:tag_id>/delete', methods=['POST'])
+@views.route('/tags/<int:tag_id>/delete', methods=['POST'])
 def delete_tag(tag_id):
     """Delete a tag from database, redirect to all tag list."""
-    Tag.query.filter_by(id=tag_id).delete()
+    soft_delete(query(Tag).get_or_404(tag_id))
     db.session.commit()
+    purger.wake()
 
     # flash a message to indicate the tag has been deleted
     flash(f'Tag with id={tag_id} has been deleted.')
     return redirect('/tags')
 
-@app.errorhandler(404)
+@views.route('/search')
+def search():
+    """Search posts by the words in their title and content, optionally within tags."""
+    terms = request.args.get('q', '')
+    tag_ids = request.args.getlist('tags', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config.get('BLOGLY_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+    # one extra result tells whether there is a next page
+    results = search_posts(terms, tag_ids, limit=per_page + 1, offset=(page - 1) * per_page)
+    return render_template('search.html', terms=terms, results=results[:per_page], tags=tag_dictionary.all(),
+                           selected=set(tag_ids), page=page, has_next=len(results) > per_page)
+
+@views.app_errorhandler(404)
 def page_not_found(e):
     """Custom 404 not found page."""
     return render_template('not_found_page.html'), 404
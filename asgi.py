@@ -0,0 +1,316 @@
+"""Async serving mode: Blogly as an ASGI application.
+
+    uvicorn --factory asgi:create_asgi_app
+
+The read pages below are served by coroutines on an AsyncSession engine
+(asyncpg for Postgres, aiosqlite for SQLite; both optional dependencies,
+only imported by this mode), so a request waiting on the database holds no
+thread. Queries that do not depend on each other run concurrently, each on
+its own session and connection: the user and their posts, the tag and its
+posts. Templates are rendered with
+the regular Flask app, inside a request context built from the ASGI scope,
+so sessions, flashes, caching, conditional GET and the after_request hooks
+behave as in the sync views.
+
+Whatever still blocks in those views (template rendering, the fragment
+cache backend, a tag dictionary reload) runs in a worker thread through
+asyncio.to_thread(), which carries the request context along, so it does
+not stall the event loop. The before_request and after_request hooks
+themselves run on the loop and must stay cheap.
+
+The async drivers and uvicorn are in requirements-async.txt.
+
+Every other request (forms, writes, the JSON API) is passed to the WSGI
+app on a small thread pool (BLOGLY_ASGI_THREADS). The async engine always
+talks to the primary database.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from flask import abort, render_template, request
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import HTTPException, NotFound, MethodNotAllowed
+from werkzeug.routing import Map, Rule, RequestRedirect
+from app import create_app, card_deps, post_card
+from conditional import conditional_page_async
+from feeds import feeds, GLOBAL
+from instrumentation import instrumentation
+from models import User, Post, Tag, PostTag
+from pagination import paginate_request_async
+from pooling import PoolPolicy
+from queries import options_for
+from tag_dictionary import tag_dictionary
+
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+DEFAULT_THREADS = 8
+
+ASYNC_VIEWS = {}
+
+
+def async_view(rule):
+    """Register a coroutine as the async version of the GET view at rule."""
+    def register(fn):
+        ASYNC_VIEWS[fn.__name__] = (rule, fn)
+        return fn
+    return register
+
+
+async def _gather(*queries):
+    """asyncio.gather() that lets every query finish before raising the first error.
+
+    A 404 from one query must not leave the others running on their sessions
+    while the request ends and the engine is disposed.
+    """
+    results = await asyncio.gather(*queries, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def async_url(url):
+    """The async-driver form of a database URL, e.g. postgresql+asyncpg://..."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver for {backend} databases')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+class AsyncBlogly:
+    """ASGI app serving the async views natively and the rest through WSGI."""
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.url = app.config.get('BLOGLY_ASYNC_DATABASE_URL') or async_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.policy = PoolPolicy.from_config(app.config)
+        self.executor = ThreadPoolExecutor(threads or app.config.get('BLOGLY_ASGI_THREADS', DEFAULT_THREADS),
+                                           thread_name_prefix='blogly-wsgi')
+        self.url_map = Map([Rule(rule, endpoint=name, methods=['GET']) for name, (rule, _) in ASYNC_VIEWS.items()])
+        self.engine = None
+        self.sessions = None
+
+    def start(self):
+        """Create the async engine; the driver is imported here, not at import time."""
+        if self.engine is not None:
+            return
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        self.engine = create_async_engine(self.url, **self.policy.async_engine_options(self.url))
+        metrics = self.policy.install(self.engine.sync_engine)
+        instrumentation.listen(self.engine.sync_engine)
+        self.app.extensions.setdefault('blogly_pool', {})['async'] = (self.engine.sync_engine, metrics)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def close(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+        self.executor.shutdown(wait=False)
+
+    # Queries, each on its own session so that they can run side by side.
+
+    async def all(self, statement):
+        async with self.sessions() as session:
+            return (await session.scalars(statement)).all()
+
+    async def get_or_404(self, model, ident, *options):
+        async with self.sessions() as session:
+            obj = await session.get(model, ident, options=options)
+        if obj is None:
+            abort(404)
+        return obj
+
+    # ASGI
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        environ = _environ(scope, body)
+
+        view = self._match(environ)
+        if view is None:
+            await self._wsgi(environ, send)
+        else:
+            self.start()
+            await self._native(*view, environ, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _match(self, environ):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+        try:
+            name, args = self.url_map.bind_to_environ(environ).match()
+        except (NotFound, MethodNotAllowed, RequestRedirect):
+            return None
+        return ASYNC_VIEWS[name][1], args
+
+    async def _native(self, view, args, environ, send):
+        app = self.app
+        with app.request_context(environ):
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    response = await view(self, **args)
+                response = app.make_response(response)
+            except HTTPException as e:
+                response = app.make_response(app.handle_user_exception(e))
+            except Exception as e:
+                response = app.make_response(app.handle_exception(e))
+            response = app.process_response(response)
+            body = b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.get_data()
+            headers = response.headers.to_wsgi_list()
+            status = response.status_code
+        await send({'type': 'http.response.start', 'status': status, 'headers': _encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        def run():
+            result = self.app(environ, start_response)
+            return result, iter(result)
+
+        result, chunks = await loop.run_in_executor(self.executor, run)
+        try:
+            first = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': _encode_headers(started['headers'])})
+            chunk = first
+            while chunk is not None:
+                # Streamed responses (NDJSON exports) are forwarded chunk by chunk.
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+
+def _environ(scope, body):
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': unquote(scope['path'], errors='surrogateescape').encode('utf-8', 'surrogateescape').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            key = f'HTTP_{key}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+@async_view('/')
+async def root(blogly):
+    async def render():
+        posts = await feeds.posts_async(blogly.all, GLOBAL, 5)
+        deps = set().union({'posts'}, *(card_deps(post) for post in posts))
+        html = await asyncio.to_thread(
+            lambda: render_template('home_page.html', cards=[post_card(post) for post in posts]))
+        return html, deps
+    return await conditional_page_async(render)
+
+
+@async_view('/users')
+async def list_users(blogly):
+    if request.args.get('sort') == 'popular':
+        users = await paginate_request_async(blogly.all, select(User), (User.post_count, User.id), descending=True)
+    else:
+        users = await paginate_request_async(blogly.all, select(User), (User.last_name, User.first_name, User.id))
+    return await asyncio.to_thread(render_template, 'list_users.html', users=users, sort=request.args.get('sort'))
+
+
+@async_view('/users/<int:user_id>')
+async def show_user_details(blogly, user_id):
+    async def render():
+        user, posts = await _gather(
+            blogly.get_or_404(User, user_id),
+            paginate_request_async(blogly.all, select(Post).where(Post.user_id == user_id),
+                                   (Post.created_at, Post.id), descending=True))
+        deps = {f'user:{user_id}', *(f'post:{post.id}' for post in posts)}
+        return await asyncio.to_thread(render_template, 'user_details.html', user=user, posts=posts), deps
+    return await conditional_page_async(render)
+
+
+@async_view('/posts/<int:post_id>')
+async def show_post_details(blogly, post_id):
+    async def render():
+        post = await blogly.get_or_404(Post, post_id, *options_for('post_card'))
+        return await asyncio.to_thread(render_template, 'post_details.html', post=post), card_deps(post)
+    return await conditional_page_async(render)
+
+
+@async_view('/posts/<int:post_id>/edit')
+async def edit_post_form(blogly, post_id):
+    post = await blogly.get_or_404(Post, post_id, *options_for('post_form'))
+    # The tag list comes from the in-process dictionary, which checks its
+    # version and reloads after a tag changed: both blocking, so in the thread.
+    return await asyncio.to_thread(lambda: render_template('edit_post.html', post=post, tags=tag_dictionary.all(),
+                                                           selected={tag.id for tag in post.tags}))
+
+
+@async_view('/tags/<int:tag_id>')
+async def show_tag_details(blogly, tag_id):
+    async def render():
+        tagged_posts = select(Post).join(PostTag).where(PostTag.tag_id == tag_id)
+        tag, posts = await _gather(
+            blogly.get_or_404(Tag, tag_id),
+            paginate_request_async(blogly.all, tagged_posts, (Post.created_at, Post.id), descending=True))
+        deps = {f'tag:{tag_id}', *(f'post:{post.id}' for post in posts)}
+        return await asyncio.to_thread(render_template, 'tag_details.html', tag=tag, posts=posts), deps
+    return await conditional_page_async(render)
+
+
+def create_asgi_app(profile=None):
+    """The ASGI app for a configuration profile (see create_app())."""
+    return AsyncBlogly(create_app(profile))
@@ -0,0 +1,75 @@
+"""Set-based syncing of the posts <-> tags association."""
+
+from sqlalchemy import ARRAY, Integer, any_, delete, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Post, PostTag
+from cache import invalidate_on_commit
+from counters import adjust_tag_counts
+from feeds import publish_on_commit
+
+posts_tags = PostTag.__table__
+
+# Rows per INSERT statement; keeps the bound parameters under the driver limits.
+INSERT_CHUNK_SIZE = 10000
+
+_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def _in(column, ids, dialect_name):
+    """column IN ids, as a single array parameter on Postgres."""
+    if dialect_name == 'postgresql':
+        return column == any_(literal(sorted(ids), ARRAY(Integer)))
+    return column.in_(ids)
+
+
+def _sync(owner_column, owner_id, other_column, wanted_ids):
+    """Make the links of one post (or tag) exactly wanted_ids.
+
+    Costs one SELECT, at most one DELETE and one INSERT (per INSERT_CHUNK_SIZE
+    links) no matter how many links change. Returns (added, removed) id sets.
+    """
+    dialect_name = db.session.get_bind().dialect.name
+    wanted = set(wanted_ids)
+    current = set(db.session.execute(select(other_column).where(owner_column == owner_id)).scalars())
+    added = wanted - current
+    removed = current - wanted
+
+    if removed:
+        db.session.execute(delete(posts_tags).where(owner_column == owner_id,
+                                                    _in(other_column, removed, dialect_name)))
+    if added:
+        rows = [{owner_column.key: owner_id, other_column.key: other_id} for other_id in sorted(added)]
+        insert = _INSERTS[dialect_name]
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            chunk = rows[start:start + INSERT_CHUNK_SIZE]
+            db.session.execute(insert(posts_tags).values(chunk).on_conflict_do_nothing())
+    return added, removed
+
+
+def sync_post_tags(post, tag_ids):
+    """Set the tags of a (flushed) post to tag_ids."""
+    added, removed = _sync(posts_tags.c.post_id, post.id, posts_tags.c.tag_id, tag_ids)
+    adjust_tag_counts(added, 1)
+    adjust_tag_counts(removed, -1)
+    db.session.expire(post, ['tags', 'posts_tags'])
+    if added or removed:
+        invalidate_on_commit(db.session(), f'post:{post.id}', *(f'tag:{tag_id}' for tag_id in added | removed))
+        publish_on_commit(db.session(), post.id)
+    return added, removed
+
+
+def sync_tag_posts(tag, post_ids):
+    """Set the posts of a (flushed) tag to post_ids; ids of posts that do not exist are ignored."""
+    post_ids = set(post_ids)
+    if post_ids:
+        # Like the tag ids of a post (tag_dictionary.known), drop stale ids
+        # instead of failing on the foreign key.
+        dialect_name = db.session.get_bind().dialect.name
+        post_ids = set(db.session.execute(select(Post.id).where(_in(Post.id, post_ids, dialect_name))).scalars())
+    added, removed = _sync(posts_tags.c.tag_id, tag.id, posts_tags.c.post_id, post_ids)
+    adjust_tag_counts([tag.id], len(added) - len(removed))
+    db.session.expire(tag, ['posts', 'posts_tags', 'post_count'])
+    if added or removed:
+        invalidate_on_commit(db.session(), f'tag:{tag.id}', *(f'post:{post_id}' for post_id in added | removed))
+        publish_on_commit(db.session(), *(added | removed))
+    return added, removed
@@ -0,0 +1,2 @@
+"""Performance benchmarks for Blogly. Run each one from the repository root,
+e.g. ``python -m benchmarks.cache_backends``."""
@@ -0,0 +1,193 @@
+"""Sync (threaded WSGI) vs async (ASGI) serving of the read pages.
+
+    python -m benchmarks.async_mode [--database-url URL] [--users 1000 --posts 20000 --tags 100]
+                                    [--requests 500] [--concurrency 32] [--modes sync,async]
+
+Seeds the database like benchmarks.routes, then drives the pages that have
+async views (see asgi.py) with --concurrency clients, first through a
+threaded werkzeug server and then through uvicorn running the ASGI app.
+Requests go to different users, posts and tags so most of them miss the page
+cache. For each mode the JSON report gives requests per second, p50/p99
+latency, errors, and the database connections used: how many were opened
+and the most checked out of the pool at once. uvicorn is needed for the
+async mode, and asyncpg or aiosqlite for its engine (pip install -r
+requirements-async.txt).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import select
+from werkzeug.serving import make_server
+from benchmarks.routes import QuietHandler, percentile, server_request
+
+PAGES = ('root', 'show_user_details', 'show_post_details', 'edit_post_form', 'show_tag_details')
+
+
+class Page:
+    """A route as benchmarks.routes drives it, cycling over the given ids."""
+
+    def __init__(self, name, template, ids):
+        self.name = name
+        self.method = 'GET'
+        self.template = template
+        self.ids = ids
+        self.data = lambda i: None
+
+    def path(self, i):
+        return self.template.format(self.ids[i % len(self.ids)] if self.ids else 0)
+
+
+def prepare(app, args):
+    from models import db, User, Post, Tag
+    from migrations import upgrade
+    from seeding import seed
+    from sqlalchemy import func
+
+    with app.app_context():
+        upgrade()
+        have = db.session.execute(select(func.count()).select_from(Post)).scalar()
+        if have < args.posts:
+            seed(args.users, args.posts - have, args.tags if not have else 0, args.seed,
+                 echo=lambda line: print(line, file=sys.stderr))
+        ids = {model: db.session.execute(select(model.id).order_by(model.id).limit(args.requests)).scalars().all()
+               for model in (User, Post, Tag)}
+    return [Page('root', '/', [0]),
+            Page('show_user_details', '/users/{}', ids[User]),
+            Page('show_post_details', '/posts/{}', ids[Post]),
+            Page('edit_post_form', '/posts/{}/edit', ids[Post]),
+            Page('show_tag_details', '/tags/{}', ids[Tag])]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve_sync(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port, server.shutdown
+
+
+def serve_async(app, threads):
+    import uvicorn
+    from asgi import AsyncBlogly
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(AsyncBlogly(app, threads), host='127.0.0.1', port=port,
+                                           log_level='warning', lifespan='on'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return port, stop
+
+
+def run(pages, send, requests, concurrency, metrics):
+    """Drive every page requests times over concurrency threads."""
+    work = itertools.count()
+    jobs = [(page, i) for page in pages for i in range(requests)]
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    peak = [0]
+    running = threading.Event()
+    running.set()
+
+    def sample():
+        while running.is_set():
+            peak[0] = max(peak[0], metrics.in_use)
+            time.sleep(0.001)
+
+    def worker():
+        nonlocal errors
+        mine, failed = [], 0
+        while (n := next(work)) < len(jobs):
+            page, i = jobs[n]
+            started = time.perf_counter()
+            try:
+                status = send(page, i)
+            except OSError:
+                status = None
+            mine.append(time.perf_counter() - started)
+            failed += status != 200
+        with lock:
+            latencies.extend(mine)
+            errors += failed
+
+    connects = metrics.connects
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    running.clear()
+    sampler.join()
+    return {'requests_per_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'errors': errors,
+            'connections_opened': metrics.connects - connects,
+            'connections_peak_in_use': peak[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=500, help='requests per page and mode')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None, help='WSGI fallback threads of the async mode')
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{directory.name}/async_mode.db'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from app import create_app
+    from cache import cache
+
+    app = create_app('prod')
+    pages = prepare(app, args)
+    report = {'dataset': {'users': args.users, 'posts': args.posts, 'tags': args.tags},
+              'concurrency': args.concurrency, 'requests': args.requests, 'modes': {}}
+    for mode in args.modes.split(','):
+        with app.app_context():
+            cache.clear()
+        if mode == 'async':
+            port, stop = serve_async(app, args.threads)
+            metrics = app.extensions['blogly_pool']['async'][1]
+        else:
+            port, stop = serve_sync(app)
+            metrics = app.extensions['blogly_pool'][None][1]
+        try:
+            report['modes'][mode] = run(pages, server_request('127.0.0.1', port), args.requests,
+                                        args.concurrency, metrics)
+        finally:
+            stop()
+        print(f'{mode}: {report["modes"][mode]}', file=sys.stderr)
+    directory.cleanup()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compare the fragment cache backends: hit latency and cross-worker invalidation.
+
+    python -m benchmarks.cache_backends [--hits 20000]
+
+Prints a JSON report. Invalidation is measured by bumping a dependency in the
+parent process and timing how long a separate worker process keeps serving
+the stale fragment.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from cache import FragmentCache
+from cache_backends import MemoryBackend, SQLiteBackend
+
+FRAGMENT = '<h2>Post</h2>' + '<p>content</p>' * 200
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def hit_latency(fragments, hits):
+    fragments.set('card:1', FRAGMENT, {'post:1', 'user:1', 'tag:1'})
+    samples = []
+    for _ in range(hits):
+        start = time.perf_counter()
+        fragments.get('card:1')
+        samples.append((time.perf_counter() - start) * 1e6)
+    return {'p50_us': round(statistics.median(samples), 2), 'p99_us': round(percentile(samples, 99), 2)}
+
+
+def _worker(make_backend, ready, bumped, result):
+    fragments = FragmentCache(make_backend())
+    fragments.set('card:1', FRAGMENT, {'post:1'})
+    ready.set()
+    bumped.wait()
+    start = time.perf_counter()
+    while fragments.get('card:1') is not None:
+        if time.perf_counter() - start > 1:
+            result.put(None)
+            return
+    result.put((time.perf_counter() - start) * 1e6)
+
+
+def cross_worker_invalidation(make_backend):
+    ctx = multiprocessing.get_context('fork')
+    ready, bumped, result = ctx.Event(), ctx.Event(), ctx.Queue()
+    worker = ctx.Process(target=_worker, args=(make_backend, ready, bumped, result))
+    worker.start()
+    ready.wait()
+    FragmentCache(make_backend()).invalidate('post:1')
+    bumped.set()
+    visible_after = result.get()
+    worker.join()
+    if visible_after is None:
+        return {'invalidated': False}
+    return {'invalidated': True, 'visible_after_us': round(visible_after, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hits', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cache.sqlite3')
+        backends = {
+            'memory': MemoryBackend,
+            'sqlite': lambda: SQLiteBackend(path),
+        }
+        report = {}
+        for name, make_backend in backends.items():
+            report[name] = {
+                'hit': hit_latency(FragmentCache(make_backend()), args.hits),
+                'cross_worker': cross_worker_invalidation(make_backend),
+            }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
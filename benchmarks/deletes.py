@@ -0,0 +1,109 @@
+"""Latency of deleting a user, by how many posts they have.
+
+    python -m benchmarks.deletes [--database-url URL] [--sizes 10,1000,10000,50000]
+                                 [--tags-per-post 2] [--chunk-size 1000]
+
+For each size, creates a user with that many tagged posts, twice: one is
+deleted the way delete_user used to (counts adjusted, then the rows removed
+by ON DELETE CASCADE, inside the request), the other through the
+/users/<id>/delete route, which soft-deletes. The purge of the soft-deleted
+user is then timed separately, along with its longest chunk transaction,
+the longest time it held locks. Prints the timings in milliseconds as JSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import delete, insert, select
+
+
+def create_user(conn, posts, tag_ids, tags_per_post):
+    from models import User, Post, PostTag
+    from counters import recount_all
+
+    user_id = conn.execute(insert(User.__table__).values(first_name='Prolific', last_name='User')
+                           .returning(User.__table__.c.id)).scalar()
+    rows = [{'title': f'Post {n}', 'content': 'Content', 'user_id': user_id} for n in range(posts)]
+    post_ids = conn.execute(insert(Post.__table__).returning(Post.__table__.c.id, sort_by_parameter_order=True),
+                            rows).scalars().all()
+    links = [{'post_id': post_id, 'tag_id': tag_ids[(n + k) % len(tag_ids)]}
+             for n, post_id in enumerate(post_ids) for k in range(tags_per_post)]
+    if links:
+        conn.execute(insert(PostTag.__table__), links)
+    recount_all(conn)
+    return user_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--sizes', default='10,1000,10000,50000')
+    parser.add_argument('--tags-per-post', type=int, default=2)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{directory.name}/deletes.db'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['BLOGLY_PURGE_WORKER'] = 'false'
+    from app import create_app
+    from counters import uncount_posts
+    from deletions import purge
+    from migrations import upgrade
+    from models import db, User, Post, Tag
+
+    app = create_app('prod')
+    with app.app_context():
+        upgrade()
+        engine = db.engine
+        with engine.begin() as conn:
+            tag_ids = conn.execute(insert(Tag.__table__).returning(Tag.__table__.c.id),
+                                   [{'name': f'bench-delete-{time.time()}-{n}'} for n in range(20)]).scalars().all()
+
+    client = app.test_client()
+    report = {'chunk_size': args.chunk_size, 'sizes': {}}
+    for size in (int(size) for size in args.sizes.split(',')):
+        with engine.begin() as conn:
+            inline_user = create_user(conn, size, tag_ids, args.tags_per_post)
+            soft_user = create_user(conn, size, tag_ids, args.tags_per_post)
+
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            uncount_posts(conn.execute(select(Post.id).where(Post.user_id == inline_user)).scalars(), conn)
+            conn.execute(delete(User.__table__).where(User.__table__.c.id == inline_user))
+        inline = time.perf_counter() - started
+
+        started = time.perf_counter()
+        response = client.post(f'/users/{soft_user}/delete')
+        soft = time.perf_counter() - started
+        assert response.status_code == 302, response.status_code
+
+        chunks = []
+        last = [time.perf_counter()]
+
+        def progress(kind, row_id, rows):
+            now = time.perf_counter()
+            chunks.append(now - last[0])
+            last[0] = now
+
+        started = time.perf_counter()
+        with app.app_context():
+            totals = purge(args.chunk_size, progress=progress)
+        purged = time.perf_counter() - started
+
+        report['sizes'][size] = {'inline_delete_ms': round(inline * 1000, 2),
+                                 'soft_delete_request_ms': round(soft * 1000, 2),
+                                 'purge_ms': round(purged * 1000, 2),
+                                 'purge_longest_chunk_ms': round(max(chunks) * 1000, 2),
+                                 'purge_chunks': len(chunks), 'posts_purged': totals['posts']}
+        print(f'{size} posts: {report["sizes"][size]}', file=sys.stderr)
+    directory.cleanup()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
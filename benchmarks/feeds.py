@@ -0,0 +1,90 @@
+"""Feed page reads from the precomputed lists against the direct query, and the cost of a write.
+
+    python -m benchmarks.feeds [--database-url URL] [--posts 200000] [--reads 200]
+
+Seeds the database (which builds the feeds), then times reading the 20
+newest posts of the global feed, of the busiest author, and of the busiest
+and of a rarely used tag: from the feed list (one range read of
+feed_entries) and from the posts (the query the pages used before). Then
+times creating a tagged post through the ORM, with and without the fan-out
+to its feeds. Prints milliseconds per operation as JSON.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--page', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{directory.name}/feeds.db'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from sqlalchemy import func, select
+    from app import create_app
+    from feeds import feeds, GLOBAL, user_feed, tag_feed
+    from migrations import upgrade
+    from models import db, User, Post, Tag
+    from seeding import seed
+
+    app = create_app('prod')
+    report = {'posts': args.posts, 'page': args.page, 'reads': {}}
+    with app.app_context():
+        upgrade()
+        seed(users=max(args.posts // 100, 1), posts=args.posts, tags=max(args.posts // 1000, 10),
+             echo=lambda line: None)
+        busiest_user = db.session.execute(select(User.id).order_by(User.post_count.desc())).scalar()
+        busiest_tag = db.session.execute(select(Tag.id).order_by(Tag.post_count.desc())).scalar()
+        rare_tag = db.session.execute(select(Tag.id).where(Tag.post_count >= args.page)
+                                      .order_by(Tag.post_count)).scalar()
+
+        for name, feed in (('global', GLOBAL), ('busiest_user', user_feed(busiest_user)),
+                           ('busiest_tag', tag_feed(busiest_tag)), ('rare_tag', tag_feed(rare_tag))):
+            from_list = feeds.page_statement(feed, args.page)
+            direct = feeds.tail_statement(feed, None, args.page)
+            assert ([post.id for post in db.session.scalars(from_list)]
+                    == [post.id for post in db.session.scalars(direct)]), feed
+            report['reads'][name] = {
+                'feed_list_ms': timed(lambda: db.session.scalars(from_list).all(), args.reads),
+                'direct_query_ms': timed(lambda: db.session.scalars(direct).all(), args.reads),
+            }
+            db.session.rollback()
+
+        def write():
+            post = Post(title='Fan-out', content='Content', user_id=busiest_user)
+            post.tags = [db.session.get(Tag, busiest_tag)]
+            db.session.add(post)
+            db.session.commit()
+
+        report['write_ms'] = timed(write, 50)
+        publish = feeds.publish
+        feeds.publish = lambda post_ids, conn: None
+        report['write_without_feeds_ms'] = timed(write, 50)
+        feeds.publish = publish
+        report['feed_entries'] = db.session.execute(select(func.count()).select_from(
+            db.metadata.tables['feed_entries'])).scalar()
+    directory.cleanup()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Load-test the connection pool: throughput and tail latency under exhaustion.
+
+    python -m benchmarks.pool [--database-url URL] [--threads 32]
+                              [--pool-sizes 2,5,10] [--duration 5] [--hold-ms 5]
+
+Each thread repeatedly checks out a connection, runs a query and holds the
+connection for --hold-ms (pg_sleep on Postgres) as a request would. With
+more threads than connections, requests queue for the pool; the report shows
+requests/sec, latency percentiles, checkout waits and timeouts per pool size.
+Prints a JSON report. Defaults to a temporary SQLite file.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from pooling import PoolPolicy
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else 0.0
+
+
+def run(url, pool_size, threads, duration, hold_ms, timeout):
+    policy = PoolPolicy(size=pool_size, max_overflow=0, timeout=timeout)
+    engine = create_engine(url, **policy.engine_options(url))
+    metrics = policy.install(engine)
+    postgres = engine.dialect.name == 'postgresql'
+    latencies, failures = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        mine, failed = [], 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    if postgres:
+                        conn.execute(text('SELECT pg_sleep(:s)'), {'s': hold_ms / 1000})
+                    else:
+                        conn.execute(text('SELECT 1'))
+                        time.sleep(hold_ms / 1000)
+            except PoolTimeout:
+                failed += 1
+                continue
+            mine.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(mine)
+            failures.append(failed)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+    return {
+        'pool_size': pool_size,
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 50), 2),
+        'latency_p99_ms': round(percentile(latencies, 99), 2),
+        'failed': sum(failures),
+        'pool': metrics.snapshot(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--pool-sizes', default='2,5,10')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--hold-ms', type=float, default=5)
+    parser.add_argument('--timeout', type=float, default=30, help='pool checkout timeout, seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.database_url or f'sqlite:///{directory}/pool.db'
+        report = {
+            'database': url.split('://')[0],
+            'threads': args.threads,
+            'runs': [run(url, int(size), args.threads, args.duration, args.hold_ms, args.timeout)
+                     for size in args.pool_sizes.split(',')],
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
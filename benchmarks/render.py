@@ -0,0 +1,123 @@
+"""Template compile and render times, with and without the template caches.
+
+    python -m benchmarks.render [--posts 1000] [--repeat 20]
+
+Reports, as JSON:
+
+- cold_start: compiling every template in a fresh Jinja environment, from
+  source and from a warm bytecode cache;
+- pages: rendering the home page with --posts post cards, and the user and
+  tag pages listing --posts posts, in milliseconds per render. The cards are
+  rendered as the previous version of the app did (a render_template() of
+  post_card.html per card, strftime per date) and through the post_card
+  macro with the memoized date filter.
+
+No database is needed: the posts are built in memory.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from flask import render_template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+# post_card.html as it was before the macros.
+LEGACY_CARD = '''<h2><a href="/posts/{{post.id}}">{{post.title}}</a></h2>
+<p>{{post.content}}</p>
+<p>
+    <b>Tags:</b>
+    {% for tag in post.tags %}
+    <span class="badge text-bg-primary">{{tag.name}}</span>
+    {% endfor %}
+</p>
+<p>By <a href="/users/{{post.user.id}}">{{post.user.full_name}}</a> on {{post.created_at.strftime('%a %b %d %Y, %I:%M %p')}}</p>'''
+
+
+def best_of(repeat, fn):
+    """Fastest of repeat runs of fn(), in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return round(min(times) * 1000, 3)
+
+
+def build_posts(count):
+    from models import User, Post, Tag
+    users = [User(id=n, first_name='Bench', last_name=f'User{n}') for n in range(1, 21)]
+    tags = [Tag(id=n, name=f'tag{n}') for n in range(1, 11)]
+    start = datetime(2025, 1, 1)
+    return [Post(id=n, title=f'Post number {n}', content='Lorem ipsum dolor sit amet. ' * 8,
+                 created_at=start - timedelta(minutes=n), user=users[n % len(users)],
+                 tags=tags[n % 3:n % 3 + 2]) for n in range(1, count + 1)]
+
+
+def cold_start(app, repeat):
+    folder = os.path.join(app.root_path, app.template_folder)
+    names = [name for name in os.listdir(folder) if name.endswith('.html')]
+
+    def compile_all(bytecode_cache):
+        environment = Environment(loader=FileSystemLoader(folder), bytecode_cache=bytecode_cache)
+        environment.filters['post_date'] = str
+        for name in names:
+            environment.get_template(name)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bytecode_cache = FileSystemBytecodeCache(directory)
+        compile_all(bytecode_cache)
+        return {'templates': len(names),
+                'from_source_ms': best_of(repeat, lambda: compile_all(None)),
+                'from_bytecode_ms': best_of(repeat, lambda: compile_all(bytecode_cache))}
+
+
+def pages(app, posts, repeat):
+    from models import Tag
+    from pagination import Page
+    from templating import render_macro, format_date
+
+    legacy_card = app.jinja_env.from_string(LEGACY_CARD)
+    user, tag = posts[0].user, Tag(id=1, name='tag1', post_count=len(posts))
+    with app.test_request_context():
+        def legacy_home():
+            cards = [render_template(legacy_card, post=post) for post in posts]
+            return render_template('home_page.html', cards=cards)
+
+        def macro_home():
+            cards = [render_macro('macros.html', 'post_card', post) for post in posts]
+            return render_template('home_page.html', cards=cards)
+
+        format_date.cache_clear()
+        return {
+            'home_legacy_cards_ms': best_of(repeat, legacy_home),
+            'home_macro_cards_ms': best_of(repeat, macro_home),
+            'user_details_ms': best_of(repeat, lambda: render_template('user_details.html', user=user,
+                                                                       posts=Page(posts))),
+            'tag_details_ms': best_of(repeat, lambda: render_template('tag_details.html', tag=tag,
+                                                                      posts=Page(posts))),
+            'date_cache': format_date.cache_info()._asdict(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from app import create_app
+
+    app = create_app('prod')
+    posts = build_posts(args.posts)
+    report = {'posts': args.posts, 'repeat': args.repeat,
+              'cold_start': cold_start(app, args.repeat), 'pages': pages(app, posts, args.repeat)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
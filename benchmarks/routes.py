@@ -0,0 +1,311 @@
+"""Throughput and latency of every route, through the test client and a real server.
+
+    python -m benchmarks.routes [--database-url URL] [--users 1000 --posts 20000 --tags 100]
+                                [--requests 200] [--concurrency 8] [--modes client,server]
+                                [--output report.json] [--compare baseline.json]
+
+Seeds the database with `flask seed` data (unless it already has the posts
+asked for), then drives each GET and POST route of the app with concurrent
+clients: Flask test clients in threads ("client" mode) and HTTP requests to a
+threaded werkzeug server ("server" mode). For each route it reports requests
+per second, p50/p95/p99 latency, SQL statements per request and errors, plus
+the peak RSS of the process, as JSON.
+
+With --compare, the report is checked against a stored one (e.g. a previous
+--output) and the command exits with status 1 if any route got slower or
+issues more SQL than the baseline allows.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+from werkzeug.serving import WSGIRequestHandler, make_server
+from sqlalchemy import func, select
+
+# Allowed slowdown before a route counts as a regression (fraction of the baseline).
+DEFAULT_THRESHOLD = 0.25
+# Allowed growth of SQL statements per request.
+SQL_SLACK = 0.5
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Route:
+    """One route to drive: method, URL and form data for the i-th request."""
+
+    def __init__(self, name, method, path, data=None, expect=200):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data or (lambda i: None)
+        self.expect = expect
+
+
+def build_routes(fixture, rng):
+    """The routes of the app, filled in with ids from the seeded data."""
+    user, post, tag = fixture['user_id'], fixture['post_id'], fixture['tag_id']
+    words = ['flask', 'python', 'sql', 'orion', 'cache', 'search']
+
+    def pop(pool):
+        return lambda i: pool[i % len(pool)]
+
+    victim_post, victim_user, victim_tag = (pop(fixture[key]) for key in
+                                            ('spare_post_ids', 'spare_user_ids', 'spare_tag_ids'))
+    user_form = lambda i: {'fname': 'Bench', 'lname': f'User{i}', 'image-url': ''}
+    return [
+        Route('root', 'GET', lambda i: '/'),
+        Route('recent_posts_feed', 'GET', lambda i: '/feed.atom'),
+        Route('list_users', 'GET', lambda i: '/users'),
+        Route('list_users_popular', 'GET', lambda i: '/users?sort=popular'),
+        Route('add_user_form', 'GET', lambda i: '/users/new'),
+        Route('submit_new_user', 'POST', lambda i: '/users/new', user_form, expect=302),
+        Route('show_user_details', 'GET', lambda i: f'/users/{user}'),
+        Route('user_posts_feed', 'GET', lambda i: f'/users/{user}/feed.atom'),
+        Route('edit_user_form', 'GET', lambda i: f'/users/{user}/edit'),
+        Route('submit_user_edit', 'POST', lambda i: f'/users/{user}/edit',
+              lambda i: {'fname': 'Bench', 'lname': 'Author', 'image-url': 'https://example.com/a.png'}, expect=302),
+        Route('delete_user', 'POST', lambda i: f'/users/{victim_user(i)}/delete', expect=302),
+        Route('new_post_form', 'GET', lambda i: f'/users/{user}/posts/new'),
+        Route('submit_new_post', 'POST', lambda i: f'/users/{user}/posts/new',
+              lambda i: {'ptitle': f'Bench post {i}', 'pcontent': ' '.join(rng.choices(words, k=40)),
+                         f'tag-{tag}': 'on'}, expect=302),
+        Route('show_post_details', 'GET', lambda i: f'/posts/{post}'),
+        Route('edit_post_form', 'GET', lambda i: f'/posts/{post}/edit'),
+        Route('submit_post_edit', 'POST', lambda i: f'/posts/{post}/edit',
+              lambda i: {'ptitle': 'Edited', 'pcontent': 'Edited content', 'tags': [tag]}, expect=302),
+        Route('delete_post', 'POST', lambda i: f'/posts/{victim_post(i)}/delete', expect=302),
+        Route('list_all_tags', 'GET', lambda i: '/tags'),
+        Route('list_all_tags_popular', 'GET', lambda i: '/tags?sort=popular'),
+        Route('show_tag_details', 'GET', lambda i: f'/tags/{tag}'),
+        Route('tag_posts_feed', 'GET', lambda i: f'/tags/{tag}/feed.atom'),
+        Route('add_tag', 'GET', lambda i: '/tags/new'),
+        Route('submit_new_tag', 'POST', lambda i: '/tags/new',
+              lambda i: {'tname': f'bench-{fixture["run"]}-{i}', 'posts': [post]}, expect=302),
+        Route('edit_tag', 'GET', lambda i: f'/tags/{tag}/edit'),
+        Route('submit_tag_edit', 'POST', lambda i: f'/tags/{tag}/edit',
+              lambda i: {'tname': fixture['tag_name'], 'posts': [post]}, expect=302),
+        Route('delete_tag', 'POST', lambda i: f'/tags/{victim_tag(i)}/delete', expect=302),
+        Route('search', 'GET', lambda i: f'/search?{urlencode({"q": rng.choice(words)})}'),
+        Route('api_posts', 'GET', lambda i: '/api/v1/posts'),
+    ]
+
+
+def prepare(app, args):
+    """Seed if needed, and pick the ids the routes work on."""
+    from models import db, User, Post, Tag
+    from migrations import upgrade
+    from seeding import seed
+
+    with app.app_context():
+        upgrade()
+        have = db.session.execute(select(func.count()).select_from(Post)).scalar()
+        if have < args.posts:
+            seed(args.users, args.posts - have, args.tags if not have else 0, args.seed,
+                 echo=lambda line: print(line, file=sys.stderr))
+
+        user_id = db.session.execute(select(User.id).order_by(User.post_count.desc(), User.id)).scalars().first()
+        tag = db.session.execute(select(Tag).order_by(Tag.post_count.desc(), Tag.id)).scalars().first()
+        post_id = db.session.execute(select(Post.id).where(Post.user_id == user_id)
+                                     .order_by(Post.id)).scalars().first()
+
+        # Rows for the delete routes to remove, one per request and mode.
+        spares = args.requests * len(args.modes)
+        run = int(time.time())
+        users = [User(first_name='Spare', last_name=f'User{i}') for i in range(spares)]
+        tags = [Tag(name=f'spare-{run}-{i}') for i in range(spares)]
+        db.session.add_all(users + tags)
+        db.session.flush()
+        posts = [Post(title='Spare', content='', user_id=user_id) for _ in range(spares)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return {'user_id': user_id, 'post_id': post_id, 'tag_id': tag.id, 'tag_name': tag.name, 'run': run,
+                'spare_user_ids': [u.id for u in users], 'spare_tag_ids': [t.id for t in tags],
+                'spare_post_ids': [p.id for p in posts]}
+
+
+def client_request(app):
+    local = threading.local()
+
+    def send(route, i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.open(route.path(i), method=route.method, data=route.data(i))
+        response.close()
+        return response.status_code
+    return send
+
+
+def server_request(host, port):
+    def send(route, i):
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            data = route.data(i)
+            body = urlencode(data, doseq=True) if data is not None else None
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else {}
+            conn.request(route.method, route.path(i), body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+    return send
+
+
+def drive(route, send, requests, concurrency, offset, statements):
+    """Run requests of route over concurrency threads; returns its stats."""
+    latencies, errors = [], []
+    turn = itertools.count()
+    lock = threading.Lock()
+
+    def worker():
+        mine, failed = [], 0
+        while True:
+            with lock:
+                i = next(turn)
+            if i >= requests:
+                break
+            start = time.perf_counter()
+            try:
+                status = send(route, offset + i)
+            except Exception:
+                status = None
+            mine.append((time.perf_counter() - start) * 1000)
+            if status != route.expect:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    before = len(statements)
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'requests_per_s': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'sql_per_request': round((len(statements) - before) / requests, 2),
+        'errors': sum(errors),
+    }
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """Describe each route of report that regressed against baseline."""
+    regressions = []
+    for mode, routes in report['modes'].items():
+        for name, stats in routes.items():
+            old = baseline.get('modes', {}).get(mode, {}).get(name)
+            if old is None:
+                continue
+            if stats['p95_ms'] > old['p95_ms'] * (1 + threshold):
+                regressions.append(f'{mode} {name}: p95 {old["p95_ms"]}ms -> {stats["p95_ms"]}ms')
+            if stats['requests_per_s'] < old['requests_per_s'] * (1 - threshold):
+                regressions.append(f'{mode} {name}: {old["requests_per_s"]} -> {stats["requests_per_s"]} req/s')
+            if stats['sql_per_request'] > old['sql_per_request'] + SQL_SLACK:
+                regressions.append(f'{mode} {name}: SQL/request {old["sql_per_request"]} -> '
+                                   f'{stats["sql_per_request"]}')
+            if stats['errors'] > old['errors']:
+                regressions.append(f'{mode} {name}: {stats["errors"]} errors')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='database to seed and use (default: a temporary SQLite file)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and mode')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--modes', default='client,server')
+    parser.add_argument('--routes', default=None, help='comma-separated route names (default: all)')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--compare', help='baseline report to check for regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+    args.modes = args.modes.split(',')
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{directory.name}/routes.db'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from app import create_app
+    from models import db
+    from queries import capture_statements
+
+    app = create_app('prod')
+    fixture = prepare(app, args)
+    rng = random.Random(args.seed)
+    routes = build_routes(fixture, rng)
+    if args.routes:
+        routes = [route for route in routes if route.name in args.routes.split(',')]
+    covered = {f'blogly.{route.name}' for route in build_routes(fixture, rng)}
+    uncovered = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                       if rule.endpoint.startswith('blogly.') and rule.endpoint not in covered)
+
+    report = {'dataset': {'users': args.users, 'posts': args.posts, 'tags': args.tags},
+              'concurrency': args.concurrency, 'requests': args.requests, 'modes': {},
+              'uncovered_routes': uncovered}
+    with app.app_context():
+        engine = db.engine
+    for number, mode in enumerate(args.modes):
+        if mode == 'server':
+            server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            send = server_request('127.0.0.1', server.server_port)
+        else:
+            server, send = None, client_request(app)
+        results = {}
+        with capture_statements(engine) as statements:
+            for route in routes:
+                results[route.name] = drive(route, send, args.requests, args.concurrency,
+                                            number * args.requests, statements)
+                print(f'{mode} {route.name}: {results[route.name]}', file=sys.stderr)
+        if server is not None:
+            server.shutdown()
+        report['modes'][mode] = results
+    report['peak_rss_mb'] = peak_rss_mb()
+    directory.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(report, json.load(f), args.threshold)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Search latency at scale.
+
+    python -m benchmarks.search --database-url postgresql:///blogly_bench --posts 1000000
+
+Fills the database (if it holds fewer posts than asked for) with synthetic
+posts drawn from a Zipf-distributed vocabulary, then times search_posts()
+for random one- and two-word queries, with and without a tag filter, and
+prints a JSON report. Against SQLite it measures the in-process fallback.
+"""
+
+import argparse
+import itertools
+import json
+import random
+import statistics
+import time
+from flask import Flask
+from sqlalchemy import func, insert, select
+from models import db, connect_db, User, Post, Tag, PostTag
+from migrations import upgrade
+from search import search_posts
+
+VOCABULARY = [f'word{i}' for i in range(20000)]
+ZIPF_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+BATCH_SIZE = 10000
+
+
+def zipf_words(rng, count):
+    return rng.choices(VOCABULARY, cum_weights=ZIPF_WEIGHTS, k=count)
+
+
+def fill(posts_wanted, rng):
+    existing = db.session.execute(select(func.count()).select_from(Post)).scalar()
+    if existing >= posts_wanted:
+        return existing
+    user_id = db.session.execute(insert(User).values(first_name='Bench', last_name='User')
+                                 .returning(User.id)).scalar()
+    tag_ids = [db.session.execute(insert(Tag).values(name=f'bench-{existing}-{i}').returning(Tag.id)).scalar()
+               for i in range(20)]
+    for start in range(existing, posts_wanted, BATCH_SIZE):
+        count = min(BATCH_SIZE, posts_wanted - start)
+        post_ids = db.session.execute(insert(Post).returning(Post.id), [
+            {'title': ' '.join(zipf_words(rng, 5)), 'content': ' '.join(zipf_words(rng, 80)), 'user_id': user_id}
+            for _ in range(count)]).scalars().all()
+        db.session.execute(insert(PostTag), [{'post_id': post_id, 'tag_id': rng.choice(tag_ids)}
+                                             for post_id in post_ids])
+        db.session.commit()
+        print(f'  loaded {start + count} posts', flush=True)
+    return posts_wanted
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'p50_ms': round(statistics.median(samples), 2),
+            'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 2),
+            'max_ms': round(samples[-1], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///blogly_bench')
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    connect_db(app)
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        upgrade()
+        posts = fill(args.posts, rng)
+        tag_id = db.session.execute(select(func.min(Tag.id))).scalar()
+        # common words produce big result sets, rare ones small ones
+        queries = [' '.join(zipf_words(rng, rng.choice((1, 2)))) for _ in range(args.queries)]
+
+        search_posts(queries[0])  # warm up (builds the fallback index)
+        report = {
+            'dialect': db.engine.dialect.name,
+            'posts': posts,
+            'queries': args.queries,
+            'search': summarize([timed(lambda: search_posts(q)) for q in queries]),
+            'search_with_tag': summarize([timed(lambda: search_posts(q, [tag_id])) for q in queries]),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
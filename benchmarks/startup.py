@@ -0,0 +1,62 @@
+"""Import, app creation and first-request time per configuration profile.
+
+    DATABASE_URL=postgresql:///blogly python -m benchmarks.startup [--path /] [--runs 5]
+
+Each run is a fresh interpreter, so module imports are measured cold. Prints
+the median of each phase per profile as JSON. Exits with 1 if any first
+request did not answer 200 (e.g. no database to reach), as its timing is
+then not a start-up time.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app(sys.argv[1])
+created = time.perf_counter()
+status = flask_app.test_client().get(sys.argv[2]).status_code
+served = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (served - created) * 1000, "status": status}))
+'''
+
+
+def run(profile, path):
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'benchmark')
+    out = subprocess.run([sys.executable, '-c', CHILD, profile, path], env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/', help='URL of the first request')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--profiles', default='dev,prod')
+    args = parser.parse_args()
+
+    report, failed = {}, []
+    for profile in args.profiles.split(','):
+        runs = [run(profile, args.path) for _ in range(args.runs)]
+        report[profile] = {phase: round(statistics.median(r[phase] for r in runs), 2)
+                           for phase in ('import_ms', 'create_app_ms', 'first_request_ms')}
+        report[profile]['statuses'] = sorted({r['status'] for r in runs})
+        if report[profile]['statuses'] != [200]:
+            failed.append(profile)
+    print(json.dumps(report, indent=2))
+    if failed:
+        print(f'First request to {args.path} did not answer 200 for: {", ".join(failed)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""SQL statements and time per post form with the tag dictionary.
+
+    python -m benchmarks.tag_forms [--database-url URL] [--tags 500] [--requests 200]
+
+Renders the new post form, the edit post form and the search page through
+the test client, with the tag dictionary warm (as it is between tag
+changes) and cold (the tags version bumped before every request, which
+costs what the pages paid before the dictionary: loading every tag). Prints
+statements per request and milliseconds per request for each, as JSON.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+
+def measure(app, engine, url, requests, before_each):
+    from queries import capture_statements
+
+    client = app.test_client()
+    client.get(url)
+    elapsed, statements = 0.0, 0
+    for _ in range(requests):
+        before_each()
+        with capture_statements(engine) as captured:
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed += time.perf_counter() - started
+        assert response.status_code == 200, (url, response.status_code)
+        statements += len(captured)
+    return {'statements_per_request': round(statements / requests, 2),
+            'ms_per_request': round(elapsed / requests * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--tags', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{directory.name}/tag_forms.db'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from app import create_app
+    from cache import cache, TAGS
+    from migrations import upgrade
+    from models import db, Post
+    from seeding import seed
+    from sqlalchemy import select
+
+    app = create_app('prod')
+    with app.app_context():
+        upgrade()
+        seed(users=10, posts=100, tags=args.tags, echo=lambda line: None)
+        post = db.session.execute(select(Post).order_by(Post.id)).scalars().first()
+        engine = db.engine
+    pages = {'new_post_form': f'/users/{post.user_id}/posts/new',
+             'edit_post_form': f'/posts/{post.id}/edit',
+             'search': '/search?q=flask'}
+
+    report = {'tags': args.tags, 'requests': args.requests, 'pages': {}}
+    for name, url in pages.items():
+        report['pages'][name] = {
+            'cold': measure(app, engine, url, args.requests, lambda: cache.invalidate(TAGS)),
+            'warm': measure(app, engine, url, args.requests, lambda: None),
+        }
+    directory.cleanup()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
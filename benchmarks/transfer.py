@@ -0,0 +1,84 @@
+"""Round trip of a generated blog through export and import.
+
+    python -m benchmarks.transfer [--source-url URL] [--target-url URL] [--posts 1000000]
+                                  [--format ndjson] [--chunk-size 10000]
+
+Seeds the source database (users and tags scaled to the posts), exports it,
+imports the export into the empty target database, then imports it again
+to show the second run changes nothing. Both databases are temporary SQLite
+files unless given. Every table is then compared row by row. Prints rows/s
+for each step and the size of the export as JSON; fails if the round trip
+lost or changed any row.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from sqlalchemy import create_engine, select
+
+
+def same_rows(source, target, table):
+    """Whether both databases hold exactly the same rows of table, compared as a stream."""
+    order = list(table.primary_key.columns)
+    with source.connect() as left, target.connect() as right:
+        left_rows = left.execution_options(yield_per=10000).execute(select(table).order_by(*order))
+        right_rows = right.execution_options(yield_per=10000).execute(select(table).order_by(*order))
+        sentinel = object()
+        for left_row, right_row in zip(left_rows, right_rows):
+            if left_row != right_row:
+                return False
+        return next(left_rows, sentinel) is sentinel and next(right_rows, sentinel) is sentinel
+
+
+def export_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--target-url', help='an empty database; defaults to a temporary SQLite file')
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{directory.name}/unused.db')
+    from migrations import upgrade
+    from models import User, Post, Tag, PostTag
+    from seeding import seed
+    from transfer import export_data, import_data
+
+    source = create_engine(args.source_url or f'sqlite:///{directory.name}/source.db')
+    target = create_engine(args.target_url or f'sqlite:///{directory.name}/target.db')
+    quiet = lambda line: None
+    upgrade(source)
+    upgrade(target)
+    seed(users=max(args.posts // 100, 1), posts=args.posts, tags=max(args.posts // 1000, 10), seed=1,
+         engine=source, echo=quiet)
+    path = os.path.join(directory.name, 'blogly.ndjson.gz' if args.format == 'ndjson' else 'blogly')
+
+    report = {'posts': args.posts, 'format': args.format, 'chunk_size': args.chunk_size}
+    for step, run in (('export', lambda: export_data(path, args.format, args.chunk_size, engine=source, echo=quiet)),
+                      ('import', lambda: import_data(path, args.chunk_size, engine=target, echo=quiet)),
+                      ('reimport', lambda: import_data(path, args.chunk_size, engine=target, echo=quiet))):
+        started = time.perf_counter()
+        rows = sum(run().values())
+        elapsed = time.perf_counter() - started
+        report[step] = {'rows': rows, 'seconds': round(elapsed, 2), 'rows_per_second': round(rows / elapsed)}
+    report['export_bytes'] = export_size(path)
+    report['identical'] = {model.__tablename__: same_rows(source, target, model.__table__)
+                           for model in (User, Tag, Post, PostTag)}
+    directory.cleanup()
+    print(json.dumps(report, indent=2))
+    if not all(report['identical'].values()):
+        raise SystemExit('The round trip changed the data')
+
+
+if __name__ == '__main__':
+    main()
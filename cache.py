@@ -0,0 +1,175 @@
+"""Rendered-fragment cache for Blogly pages, invalidated by model events.
+
+Every cached fragment is stored with the set of dependency keys it was built
+from, e.g. 'post:3', 'user:1', 'tag:2', or 'posts' for "which posts are the
+latest". Model events collect the keys touched by a transaction and, once it
+commits, bump their version counters in the backend; fragments built from an
+older version of any dependency are then treated as misses. Because the
+counters live in the backend, a shared backend invalidates every worker.
+"""
+
+from flask import has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from models import db, User, Post, Tag, PostTag
+from cache_backends import MemoryBackend, backend_from_config, now_ms
+from routing import replica_lag
+
+PENDING_KEY = 'blogly_cache_pending'
+
+# Every fragment depends on this key, so bumping it invalidates everything.
+ALL = '*'
+# Bumped by any change to the set of tags (see tag_dictionary.py).
+TAGS = 'tags'
+
+
+class FragmentCache:
+    """Cache of rendered HTML with dependency-based invalidation."""
+
+    def __init__(self, backend=None, ttl=300, enabled=True):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Configure the cache from app.config and hook it up to the models."""
+        self.backend = backend_from_config(app.config)
+        self.ttl = app.config.get('BLOGLY_CACHE_TTL', self.ttl)
+        self.enabled = app.config.get('BLOGLY_CACHE_ENABLED', self.enabled)
+        app.extensions['blogly_cache'] = self
+        register_invalidation(self)
+
+    def get(self, key):
+        """Return the cached value of key, or None if missing or stale."""
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        """Return (value, {dep: version}) for key, or None if missing or stale."""
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, versions = entry
+            if self.backend.get_versions(versions) == versions:
+                self.hits += 1
+                return value, versions
+        self.misses += 1
+        return None
+
+    def snapshot(self):
+        """The version clock, read before building a value to set() with since=."""
+        return self.backend.clock()
+
+    def set(self, key, value, deps=(), since=None):
+        """Cache value under key until one of deps is invalidated or the TTL passes.
+
+        since is the snapshot() taken before the value was built. A dependency
+        bumped after it may not be reflected in the value, which is then not
+        stored: its versions would claim it is fresh. A value built from a
+        replica is only as fresh as the replica, which may be behind by the
+        sticky window: a bump within it counts as after since as well. Returns
+        the dependency versions the value was stored with (or would have been).
+        """
+        since = _read_horizon(since)
+        versions = self.backend.get_versions({ALL, *deps})
+        if since is not None and any(version > since for version in versions.values()):
+            # Stale from the start: report versions that no longer match.
+            return {name: min(version, since) for name, version in versions.items()}
+        if self.enabled:
+            self.backend.set(key, [value, versions], self.ttl)
+        return versions
+
+    def cached(self, key, render):
+        """Return the value of key, calling render() -> (value, deps) on a miss."""
+        if not self.enabled:
+            return render()[0]
+        value = self.get(key)
+        if value is None:
+            since = self.snapshot()
+            value, deps = render()
+            self.set(key, value, deps, since)
+        return value
+
+    def invalidate(self, *deps):
+        """Make every fragment that depends on one of deps stale."""
+        self.backend.bump(*deps)
+
+    def clear(self):
+        self.backend.bump(ALL)
+        self.backend.clear()
+
+
+def _read_horizon(since):
+    """since, moved back by how far the replica the current request read from may lag."""
+    lag = replica_lag(db.session()) if has_app_context() else 0
+    if not lag:
+        return since
+    horizon = now_ms() - int(lag * 1000)
+    return horizon if since is None else min(since, horizon)
+
+
+def invalidate_on_commit(session, *deps):
+    """Evict fragments depending on deps once the session's transaction commits."""
+    pending = session.info.setdefault(PENDING_KEY, set())
+    if pending is not None:
+        pending.update(deps)
+
+
+def clear_on_commit(session):
+    """Evict every fragment once the session's transaction commits."""
+    session.info[PENDING_KEY] = None
+
+
+def model_deps(target):
+    """The dependency keys touched by inserting, updating or deleting a model row."""
+    if isinstance(target, User):
+        return {f'user:{target.id}'}
+    if isinstance(target, Post):
+        return {f'post:{target.id}', f'user:{target.user_id}', 'posts'}
+    if isinstance(target, Tag):
+        return {f'tag:{target.id}', TAGS}
+    if isinstance(target, PostTag):
+        return {f'post:{target.post_id}', f'tag:{target.tag_id}'}
+    return set()
+
+
+_registered = []
+
+
+def register_invalidation(cache):
+    """Listen to model and session events on behalf of cache (once per cache)."""
+    if cache in _registered:
+        return
+    _registered.append(cache)
+
+    def on_change(mapper, connection, target):
+        invalidate_on_commit(object_session(target), *model_deps(target))
+
+    for model in (User, Post, Tag, PostTag):
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, on_change)
+
+    @event.listens_for(db.session, 'do_orm_execute')
+    def on_bulk_statement(orm_execute_state):
+        # Query.delete()/update() do not fire mapper events and do not say
+        # which rows they touched, so they evict everything.
+        if orm_execute_state.is_orm_statement and (orm_execute_state.is_delete or orm_execute_state.is_update):
+            clear_on_commit(orm_execute_state.session)
+
+    @event.listens_for(db.session, 'after_commit')
+    def on_commit(session):
+        if PENDING_KEY not in session.info:
+            return
+        deps = session.info.pop(PENDING_KEY)
+        if deps is None:
+            cache.clear()
+        else:
+            cache.invalidate(*deps)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def on_rollback(session):
+        session.info.pop(PENDING_KEY, None)
+
+
+cache = FragmentCache()
@@ -0,0 +1,219 @@
+"""Storage backends for the Blogly fragment cache.
+
+A backend stores JSON-serializable values under string keys with a TTL, and
+keeps integer version counters that can be read and bumped. FragmentCache
+builds dependency invalidation on top of the counters: an entry remembers the
+versions of its dependencies and is stale once any of them has been bumped,
+so invalidating never needs to find the entries themselves.
+
+Versions are stamps from one clock per backend: a bump sets each name to the
+next tick. A value built after reading clock() is therefore known to be
+current only if none of its dependencies is newer than that reading. The
+ticks are milliseconds since the epoch (one more than the last tick when two
+come in the same millisecond), so a version also tells when its name last
+changed. Names never bumped are at the base version, the time the version
+store was created: a restarted MemoryBackend does not reuse old versions.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def now_ms():
+    """The current time as a version tick."""
+    return int(time.time() * 1000)
+
+
+class CacheBackend:
+    """Interface every cache backend implements."""
+
+    def get(self, key):
+        """Return the value stored under key, or None if missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_versions(self, names):
+        """Return {name: version} for names; names never bumped are at the base version."""
+        raise NotImplementedError
+
+    def bump(self, *names):
+        """Move the versions of names forward, to the next ticks of the clock."""
+        raise NotImplementedError
+
+    def clock(self):
+        """The last version handed out by bump() (the base version before any bump)."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Drop every entry (version counters are kept)."""
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process LRU dict. Fast, but every worker process has its own copy."""
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._base = self._clock = now_ms()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def get_versions(self, names):
+        return {name: self._versions.get(name, self._base) for name in names}
+
+    def bump(self, *names):
+        with self._lock:
+            for name in names:
+                self._clock = max(self._clock + 1, now_ms())
+                self._versions[name] = self._clock
+
+    def clock(self):
+        return self._clock
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class SQLiteBackend(CacheBackend):
+    """A SQLite file shared by every worker process on the host.
+
+    Needs no outside service. WAL mode lets readers proceed while a writer
+    commits. Entries past the caps are evicted oldest-written first.
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'expires REAL NOT NULL, written REAL NOT NULL, size INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entries_written ON cache_entries (written)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_versions ('
+                         'name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_versions_version ON cache_versions (version)')
+            # The row named '' holds the base version.
+            conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('', ?)", (now_ms(),))
+
+    def _conn(self):
+        # One connection per thread, reopened after a fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value FROM cache_entries WHERE key = ? AND expires >= ?',
+                                   (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        data = json.dumps(value)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO cache_entries (key, value, expires, written, size) '
+                         'VALUES (?, ?, ?, ?, ?)', (key, data, now + ttl, now, len(data)))
+            conn.execute('DELETE FROM cache_entries WHERE expires < ?', (now,))
+            count, size = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM cache_entries').fetchone()
+            while count > self.max_entries or size > self.max_bytes:
+                # Drop the oldest tenth (at least one) and re-measure.
+                conn.execute('DELETE FROM cache_entries WHERE key IN '
+                             '(SELECT key FROM cache_entries ORDER BY written LIMIT ?)', (max(count // 10, 1),))
+                count, size = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM cache_entries').fetchone()
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def get_versions(self, names):
+        names = list(names)
+        placeholders = ', '.join('?' * (len(names) + 1))
+        found = dict(self._conn().execute(
+            f'SELECT name, version FROM cache_versions WHERE name IN ({placeholders})', ['', *names]))
+        return {name: found.get(name, found.get('', 0)) for name in names}
+
+    def bump(self, *names):
+        if not names:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # The clock is the highest version; BEGIN IMMEDIATE serializes the ticks.
+            conn.executemany('INSERT INTO cache_versions (name, version) '
+                             'VALUES (?, max((SELECT coalesce(max(version), 0) + 1 FROM cache_versions), ?)) '
+                             'ON CONFLICT (name) DO UPDATE SET version = excluded.version',
+                             [(name, now_ms()) for name in names])
+
+    def clock(self):
+        return self._conn().execute('SELECT coalesce(max(version), 0) FROM cache_versions').fetchone()[0]
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache_entries')
+
+
+def backend_from_config(config):
+    """Build the backend named by BLOGLY_CACHE_BACKEND ('memory' or 'sqlite')."""
+    name = config.get('BLOGLY_CACHE_BACKEND', 'memory')
+    max_entries = config.get('BLOGLY_CACHE_MAX_ENTRIES', 1000)
+    max_bytes = config.get('BLOGLY_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    if name == 'memory':
+        return MemoryBackend(max_entries, max_bytes)
+    if name == 'sqlite':
+        return SQLiteBackend(config.get('BLOGLY_CACHE_PATH', 'blogly_cache.sqlite3'), max_entries, max_bytes)
+    raise ValueError(f'Unknown cache backend: {name}')
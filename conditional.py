@@ -0,0 +1,96 @@
+"""HTTP conditional GET (ETag / Last-Modified / 304) for cached Blogly pages."""
+
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timezone
+from flask import make_response, request, session
+from werkzeug.http import is_resource_modified
+from cache import cache, ALL
+
+# How long the dependencies of a page are remembered for revalidation; much
+# longer than the page itself, as they are small.
+VALIDATOR_TTL = 24 * 3600
+
+
+def etag_for(key, versions):
+    """ETag of a page: its key and the versions of everything it was built from.
+
+    The same data gives the same ETag whether the page was cached, evicted
+    or rendered again by another worker sharing the backend.
+    """
+    raw = json.dumps([key, sorted(versions.items())])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def last_modified_for(versions):
+    """When the newest of the page's dependencies last changed (versions are millisecond ticks)."""
+    return datetime.fromtimestamp(max(versions.values()) // 1000, timezone.utc)
+
+
+def conditional_page(render):
+    """Serve the page at the current URL, answering conditional requests with 304.
+
+    render() -> (html, deps) builds the page on a fragment cache miss. The
+    validators come from the versions of the page's dependencies, so a
+    request whose If-None-Match or If-Modified-Since still matches costs
+    neither a query nor a template render: while the page is cached, or
+    after it was evicted as long as its dependencies are remembered. Pages
+    carrying flash messages are one-offs and are neither cached nor
+    validated.
+    """
+    if session.get('_flashes'):
+        return render()[0]
+    key, entry = _cached_page()
+    if entry is None:
+        since = cache.snapshot()
+        entry = _store_page(key, *render(), since)
+    return _page_response(key, *entry)
+
+
+async def conditional_page_async(render):
+    """conditional_page() for the async views: render is a coroutine function.
+
+    The cache backend is read and written from a worker thread, off the event loop.
+    """
+    if session.get('_flashes'):
+        return (await render())[0]
+    key, entry = await asyncio.to_thread(_cached_page)
+    if entry is None:
+        since = await asyncio.to_thread(cache.snapshot)
+        entry = await asyncio.to_thread(_store_page, key, *(await render()), since)
+    return _page_response(key, *entry)
+
+
+def _cached_page():
+    """(key, (html, versions)) of the current page; html is '' for a 304 without the page."""
+    key = f'page:{request.full_path}'
+    entry = cache.get_entry(key)
+    if entry is not None:
+        return key, entry
+    deps = cache.backend.get(f'deps:{key}') if _is_conditional() else None
+    if deps is not None:
+        versions = cache.backend.get_versions({ALL, *deps})
+        if not is_resource_modified(request.environ, etag=etag_for(key, versions),
+                                    last_modified=last_modified_for(versions)):
+            return key, ('', versions)
+    return key, None
+
+
+def _is_conditional():
+    return 'HTTP_IF_NONE_MATCH' in request.environ or 'HTTP_IF_MODIFIED_SINCE' in request.environ
+
+
+def _store_page(key, html, deps, since):
+    versions = cache.set(key, html, deps, since)
+    if cache.enabled:
+        cache.backend.set(f'deps:{key}', sorted(deps), VALIDATOR_TTL)
+    return html, versions
+
+
+def _page_response(key, html, versions):
+    response = make_response(html)
+    response.set_etag(etag_for(key, versions))
+    response.last_modified = last_modified_for(versions)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
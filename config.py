@@ -0,0 +1,200 @@
+"""Configuration profiles for Blogly: dev, test and prod.
+
+Settings that differ between deployments come from the environment:
+
+    DATABASE_URL            database of the dev and prod profiles
+    TEST_DATABASE_URL       database of the test profile (sqlite:// runs the
+                            suite in memory)
+    BLOGLY_TEST_WORKER      number of a parallel test worker (set by
+                            runtests.py), which gets a database of its own
+    SECRET_KEY              required by the prod profile
+    BLOGLY_POOL_SIZE, BLOGLY_POOL_MAX_OVERFLOW, BLOGLY_POOL_TIMEOUT,
+    BLOGLY_POOL_RECYCLE, BLOGLY_POOL_PRE_PING
+                            connection pool settings (see pooling.PoolPolicy)
+    BLOGLY_STATEMENT_TIMEOUT
+                            per-statement time limit on Postgres, in milliseconds
+    BLOGLY_APPLICATION_NAME application_name reported to Postgres
+    BLOGLY_REPLICA_URLS     comma-separated read replicas of DATABASE_URL
+    BLOGLY_REPLICA_STRATEGY round_robin (default) or least_loaded
+    BLOGLY_STICKY_SECONDS   how long a browser reads from the primary after
+                            a write (default 5)
+    BLOGLY_SQL_ECHO         log every SQL statement (dev profile only)
+    BLOGLY_METRICS          serve /metrics (default on, off in the prod profile)
+    BLOGLY_PROFILE_SLOW_MS, BLOGLY_PROFILE_SAMPLE_RATE, BLOGLY_PROFILER,
+    BLOGLY_PROFILE_DIR      sampled profiles of slow requests (see instrumentation.py)
+    BLOGLY_TEMPLATE_CACHE_DIR
+                            compiled template cache (default: the instance folder)
+    BLOGLY_PRECOMPILE_TEMPLATES
+                            compile all templates at startup (default on)
+    BLOGLY_BULK_INGEST      enable POST /api/v1/posts/bulk (default off)
+    BLOGLY_WRITE_BATCH_ROWS, BLOGLY_WRITE_BATCH_MS
+                            group commit window of the bulk writes
+                            (default 500 posts or 5 ms, see writequeue.py)
+    BLOGLY_PURGE_WORKER     purge soft-deleted users and tags in a background
+                            thread (default on; else run `flask purge`)
+    BLOGLY_PURGE_CHUNK_SIZE rows per purge transaction (default 1000)
+    BLOGLY_FEED_LENGTH      posts kept in each precomputed feed (default 200)
+    BLOGLY_TAG_DICTIONARY_TTL
+                            seconds before the tag dictionary reloads even
+                            without a version bump (default 60)
+    BLOGLY_NULL_POOL        open a connection per checkout, for running
+                            behind a transaction-mode PgBouncer
+"""
+
+import os
+
+
+def env_int(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_float(name, default=None):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def pool_settings_from_env():
+    """The connection pool settings given in the environment, as config keys."""
+    settings = {
+        'BLOGLY_POOL_SIZE': env_int('BLOGLY_POOL_SIZE'),
+        'BLOGLY_POOL_MAX_OVERFLOW': env_int('BLOGLY_POOL_MAX_OVERFLOW'),
+        'BLOGLY_POOL_TIMEOUT': env_int('BLOGLY_POOL_TIMEOUT'),
+        'BLOGLY_POOL_RECYCLE': env_int('BLOGLY_POOL_RECYCLE'),
+        'BLOGLY_STATEMENT_TIMEOUT': env_int('BLOGLY_STATEMENT_TIMEOUT'),
+        'BLOGLY_APPLICATION_NAME': os.environ.get('BLOGLY_APPLICATION_NAME') or None,
+    }
+    settings = {key: value for key, value in settings.items() if value is not None}
+    for key in ('BLOGLY_POOL_PRE_PING', 'BLOGLY_NULL_POOL'):
+        if key in os.environ:
+            settings[key] = env_bool(key)
+    return settings
+
+
+def test_database_url(url, worker=None):
+    """The test database of a test worker: its own schema, file or memory database.
+
+    On Postgres each worker uses the schema blogly_test_w<worker> of the
+    database; with SQLite, a file next to the given one. An in-memory SQLite
+    URL becomes a named in-memory database shared by every connection of the
+    process, so that background threads see the same data.
+    """
+    suffix = f'_w{worker}' if worker else ''
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        # The name is absolute, so that Flask-SQLAlchemy leaves it alone.
+        return f'sqlite:///file:/blogly_test{suffix}?mode=memory&cache=shared&uri=true'
+    if not worker:
+        return url
+    if url.startswith('postgresql'):
+        separator = '&' if '?' in url else '?'
+        return f'{url}{separator}options=-csearch_path%3Dblogly_test{suffix}'
+    if url.startswith('sqlite'):
+        base, extension = os.path.splitext(url)
+        return f'{base}{suffix}{extension}'
+    raise ValueError(f'Cannot give each test worker a database of its own on {url}')
+
+
+def worker_schema(url):
+    """The schema set by test_database_url(), if any."""
+    marker = 'search_path%3D'
+    return url.split(marker, 1)[1].split('&', 1)[0] if marker in url else None
+
+
+def replicas_from_env():
+    """SQLALCHEMY_BINDS for BLOGLY_REPLICA_URLS, and the list of their bind keys."""
+    urls = [url.strip() for url in os.environ.get('BLOGLY_REPLICA_URLS', '').split(',') if url.strip()]
+    binds = {f'replica_{number}': url for number, url in enumerate(urls, 1)}
+    return binds, list(binds)
+
+
+class Config:
+    """Settings shared by every profile. Read from the environment when instantiated."""
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    DEBUG_TOOLBAR = False
+    TESTING = False
+
+    def __init__(self):
+        self.SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///blogly')
+        for key, value in pool_settings_from_env().items():
+            setattr(self, key, value)
+        self.SQLALCHEMY_BINDS, self.BLOGLY_REPLICAS = replicas_from_env()
+        self.BLOGLY_REPLICA_STRATEGY = os.environ.get('BLOGLY_REPLICA_STRATEGY', 'round_robin')
+        self.BLOGLY_STICKY_SECONDS = env_int('BLOGLY_STICKY_SECONDS', 5)
+        self.BLOGLY_METRICS = env_bool('BLOGLY_METRICS', True)
+        self.BLOGLY_PROFILE_SLOW_MS = env_int('BLOGLY_PROFILE_SLOW_MS')
+        self.BLOGLY_PROFILE_SAMPLE_RATE = env_float('BLOGLY_PROFILE_SAMPLE_RATE', 0.1)
+        self.BLOGLY_PROFILER = os.environ.get('BLOGLY_PROFILER', 'cprofile')
+        if os.environ.get('BLOGLY_PROFILE_DIR'):
+            self.BLOGLY_PROFILE_DIR = os.environ['BLOGLY_PROFILE_DIR']
+        if os.environ.get('BLOGLY_TEMPLATE_CACHE_DIR'):
+            self.BLOGLY_TEMPLATE_CACHE_DIR = os.environ['BLOGLY_TEMPLATE_CACHE_DIR']
+        self.BLOGLY_PRECOMPILE_TEMPLATES = env_bool('BLOGLY_PRECOMPILE_TEMPLATES', True)
+        self.BLOGLY_BULK_INGEST = env_bool('BLOGLY_BULK_INGEST')
+        self.BLOGLY_PURGE_WORKER = env_bool('BLOGLY_PURGE_WORKER', True)
+        self.BLOGLY_PURGE_CHUNK_SIZE = env_int('BLOGLY_PURGE_CHUNK_SIZE', 1000)
+        self.BLOGLY_FEED_LENGTH = env_int('BLOGLY_FEED_LENGTH', 200)
+        self.BLOGLY_TAG_DICTIONARY_TTL = env_float('BLOGLY_TAG_DICTIONARY_TTL', 60)
+        self.BLOGLY_WRITE_BATCH_ROWS = env_int('BLOGLY_WRITE_BATCH_ROWS', 500)
+        self.BLOGLY_WRITE_BATCH_MS = env_float('BLOGLY_WRITE_BATCH_MS', 5)
+        self.SECRET_KEY = os.environ.get('SECRET_KEY', 'Orion')
+
+
+class DevConfig(Config):
+    """Local development: the debug toolbar, and SQL echo if BLOGLY_SQL_ECHO is set.
+
+    Per-request SQL counts and timings are in the Server-Timing header and at
+    /metrics, without the cost of logging every statement.
+    """
+
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    def __init__(self):
+        super().__init__()
+        self.SQLALCHEMY_ECHO = env_bool('BLOGLY_SQL_ECHO')
+
+
+class TestConfig(Config):
+    """The test suite: its own database, Flask errors raised as exceptions."""
+
+    TESTING = True
+
+    def __init__(self):
+        super().__init__()
+        url = os.environ.get('TEST_DATABASE_URL', 'postgresql:///blogly_test')
+        self.SQLALCHEMY_DATABASE_URI = test_database_url(url, os.environ.get('BLOGLY_TEST_WORKER'))
+        # Tests purge deleted rows themselves, when they want to.
+        self.BLOGLY_PURGE_WORKER = env_bool('BLOGLY_PURGE_WORKER')
+        # Compile templates in memory only, leaving the instance folder alone.
+        self.BLOGLY_TEMPLATE_CACHE_DIR = os.environ.get('BLOGLY_TEMPLATE_CACHE_DIR')
+
+
+class ProdConfig(Config):
+    """Production: secrets from the environment, and /metrics only if BLOGLY_METRICS is set.
+
+    Requests still carry Server-Timing headers; the metrics endpoint is
+    opt-in so it is not exposed publicly by accident.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.BLOGLY_METRICS = env_bool('BLOGLY_METRICS')
+        if 'SECRET_KEY' not in os.environ:
+            raise RuntimeError('SECRET_KEY must be set in the environment for the prod profile')
+        self.SECRET_KEY = os.environ['SECRET_KEY']
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
@@ -0,0 +1,241 @@
+"""Maintained post counts of users and tags, and the trending tags table.
+
+users.post_count and tags.post_count are kept up to date in the same
+transaction as the change that affects them:
+
+* inserting or deleting a Post (ORM) counts it for its user (and, on
+  delete, its tags),
+* inserting or deleting a PostTag (ORM) counts it for its tag,
+* sync_post_tags()/sync_tag_posts() adjust the tags they link or unlink,
+* bulk deletes call uncount_posts() first,
+* soft-deleting a user takes all their posts out of the counts at once
+  (uncount_user()); the purge then deletes them without counting again.
+
+The posts of soft-deleted users are not counted anywhere, trending
+included, just as no page shows them.
+
+Changes made any other way (raw SQL, Post.tags.append) are not counted;
+`flask counters check` reports drift and `flask counters repair` fixes it.
+
+trending_tags holds the tags with the most posts created in the last
+BLOGLY_TRENDING_DAYS days. It is a table rebuilt in one transaction by
+`flask trending refresh` (from cron, or with --every), so readers see
+either the old or the new ranking, never a partial one.
+"""
+
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, exists, func, insert, literal, select, update
+from models import db, User, Post, Tag, PostTag
+
+users = User.__table__
+posts = Post.__table__
+tags = Tag.__table__
+posts_tags = PostTag.__table__
+
+TRENDING_DAYS = 7
+TRENDING_LIMIT = 50
+
+trending_tags = db.Table(
+    'trending_tags',
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('recent_posts', db.Integer, nullable=False),
+    db.Column('rank', db.Integer, nullable=False),
+    db.Column('refreshed_at', db.DateTime, nullable=False),
+    db.Index('ix_trending_tags_rank', 'rank'),
+)
+
+# An alias, so it never correlates with the users of an enclosing query.
+owners = users.alias('owners')
+_counted = ~exists().where(owners.c.id == posts.c.user_id, owners.c.deleted_at.is_not(None))
+
+_user_actual = select(func.count()).where(posts.c.user_id == users.c.id, _counted).scalar_subquery()
+_tag_actual = (select(func.count()).select_from(posts_tags.join(posts, posts.c.id == posts_tags.c.post_id))
+               .where(posts_tags.c.tag_id == tags.c.id, _counted).scalar_subquery())
+
+
+def _executor(conn):
+    return conn if conn is not None else db.session
+
+
+def adjust_user_counts(deltas, conn=None):
+    """Add {user_id: delta} to the post counts of users."""
+    for user_id, delta in deltas.items():
+        if delta:
+            _executor(conn).execute(update(users).where(users.c.id == user_id)
+                                    .values(post_count=users.c.post_count + delta))
+
+
+def adjust_tag_counts(tag_ids, delta, conn=None):
+    """Add delta to the post count of each of tag_ids, in one UPDATE."""
+    if tag_ids and delta:
+        _executor(conn).execute(update(tags).where(tags.c.id.in_(sorted(tag_ids)))
+                                .values(post_count=tags.c.post_count + delta))
+
+
+def adjust_tag_deltas(deltas, conn=None):
+    """Add {tag_id: delta} to the post counts of tags, one UPDATE per distinct delta."""
+    by_delta = {}
+    for tag_id, delta in deltas.items():
+        by_delta.setdefault(delta, []).append(tag_id)
+    for delta, tag_ids in by_delta.items():
+        adjust_tag_counts(tag_ids, delta, conn)
+
+
+def uncount_posts(post_ids, conn=None):
+    """Take posts that are about to be deleted out of the user and tag counts."""
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    executor = _executor(conn)
+    by_user = executor.execute(select(posts.c.user_id, func.count()).where(posts.c.id.in_(post_ids), _counted)
+                               .group_by(posts.c.user_id)).all()
+    adjust_user_counts({user_id: -count for user_id, count in by_user if user_id is not None}, conn)
+    by_tag = executor.execute(select(posts_tags.c.tag_id, func.count())
+                              .join(posts, posts.c.id == posts_tags.c.post_id)
+                              .where(posts_tags.c.post_id.in_(post_ids), _counted)
+                              .group_by(posts_tags.c.tag_id))
+    adjust_tag_deltas({tag_id: -count for tag_id, count in by_tag.all()}, conn)
+
+
+def uncount_user(user_id, conn=None):
+    """Take the posts of a user who is being soft-deleted out of the user and tag counts."""
+    executor = _executor(conn)
+    by_tag = executor.execute(select(posts_tags.c.tag_id, func.count())
+                              .join(posts, posts.c.id == posts_tags.c.post_id)
+                              .where(posts.c.user_id == user_id)
+                              .group_by(posts_tags.c.tag_id))
+    adjust_tag_deltas({tag_id: -count for tag_id, count in by_tag.all()}, conn)
+    executor.execute(update(users).where(users.c.id == user_id).values(post_count=0))
+
+
+@event.listens_for(Post, 'after_insert')
+def _count_new_post(mapper, connection, target):
+    if target.user_id is not None:
+        adjust_user_counts({target.user_id: 1}, connection)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _uncount_deleted_posts(session, flush_context, instances):
+    # Before the flush, while the posts_tags rows of the posts still exist.
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if deleted:
+        uncount_posts(deleted, session.connection())
+
+
+@event.listens_for(PostTag, 'after_insert')
+def _count_new_link(mapper, connection, target):
+    adjust_tag_counts([target.tag_id], 1, connection)
+
+
+@event.listens_for(PostTag, 'after_delete')
+def _uncount_deleted_link(mapper, connection, target):
+    adjust_tag_counts([target.tag_id], -1, connection)
+
+
+def check_counters(conn=None):
+    """Return [(table, id, stored, actual)] for every count that has drifted."""
+    executor = _executor(conn)
+    drift = []
+    for table, actual in ((users, _user_actual), (tags, _tag_actual)):
+        rows = executor.execute(select(table.c.id, table.c.post_count, actual)
+                                .where(table.c.post_count != actual).order_by(table.c.id))
+        drift.extend((table.name, row_id, stored, count) for row_id, stored, count in rows)
+    return drift
+
+
+def repair_counters(conn=None):
+    """Recount the drifted counts. Returns what check_counters() found."""
+    drift = check_counters(conn)
+    for table, actual in ((users, _user_actual), (tags, _tag_actual)):
+        ids = [row_id for name, row_id, _, _ in drift if name == table.name]
+        if ids:
+            _executor(conn).execute(update(table).where(table.c.id.in_(ids)).values(post_count=actual))
+    return drift
+
+
+def recount_all(conn):
+    """Set every user and tag count from scratch (used by the backfill migration)."""
+    conn.execute(update(users).values(post_count=_user_actual))
+    conn.execute(update(tags).values(post_count=_tag_actual))
+
+
+def refresh_trending(days=TRENDING_DAYS, limit=TRENDING_LIMIT, engine=None):
+    """Rebuild trending_tags from the posts of the last days. Returns the rows written."""
+    engine = engine if engine is not None else db.engine
+    now = datetime.now(timezone.utc)
+    recent = func.count().label('recent_posts')
+    ranked = (select(posts_tags.c.tag_id, recent,
+                     func.row_number().over(order_by=(recent.desc(), posts_tags.c.tag_id)).label('rank'))
+              .join(posts, posts.c.id == posts_tags.c.post_id)
+              .where(posts.c.created_at >= now - timedelta(days=days), _counted)
+              .group_by(posts_tags.c.tag_id)
+              .order_by(recent.desc(), posts_tags.c.tag_id)
+              .limit(limit)
+              .subquery())
+    with engine.begin() as conn:
+        conn.execute(delete(trending_tags))
+        result = conn.execute(insert(trending_tags).from_select(
+            ['tag_id', 'recent_posts', 'rank', 'refreshed_at'],
+            select(ranked.c.tag_id, ranked.c.recent_posts, ranked.c.rank, literal(now, db.DateTime))))
+    return result.rowcount
+
+
+def trending(limit=10):
+    """[(tag, recent_posts)] from the last refresh, most popular first."""
+    rows = db.session.execute(select(Tag, trending_tags.c.recent_posts)
+                              .join(trending_tags, trending_tags.c.tag_id == Tag.id)
+                              .order_by(trending_tags.c.rank).limit(limit))
+    return rows.all()
+
+
+@click.group('counters')
+def counters_command():
+    """Check or repair the post counts of users and tags."""
+
+
+@counters_command.command('check')
+@with_appcontext
+def check_command():
+    """Report counts that do not match the posts; exit 1 if any."""
+    with db.engine.connect() as conn:
+        drift = check_counters(conn)
+    for table, row_id, stored, actual in drift:
+        click.echo(f'{table} {row_id}: post_count={stored}, actual {actual}')
+    if drift:
+        raise SystemExit(1)
+    click.echo('All counts are consistent.')
+
+
+@counters_command.command('repair')
+@with_appcontext
+def repair_command():
+    """Recount the counts that do not match the posts."""
+    with db.engine.begin() as conn:
+        drift = repair_counters(conn)
+    click.echo(f'Repaired {len(drift)} count(s).')
+
+
+@click.group('trending')
+def trending_command():
+    """Maintain the trending tags table."""
+
+
+@trending_command.command('refresh')
+@click.option('--days', type=int, default=None, help='Window of recent posts (BLOGLY_TRENDING_DAYS).')
+@click.option('--limit', type=int, default=TRENDING_LIMIT, help='Tags to keep.')
+@click.option('--every', type=float, default=None, help='Keep refreshing every this many seconds.')
+@with_appcontext
+def refresh_command(days, limit, every):
+    """Rebuild trending_tags from the recent posts."""
+    days = days if days is not None else current_app.config.get('BLOGLY_TRENDING_DAYS', TRENDING_DAYS)
+    while True:
+        start = time.perf_counter()
+        count = refresh_trending(days, limit)
+        click.echo(f'Ranked {count} trending tag(s) in {time.perf_counter() - start:.3f}s.')
+        if every is None:
+            return
+        time.sleep(every)
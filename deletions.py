@@ -0,0 +1,225 @@
+"""Soft deletes of users and tags, purged in the background in bounded chunks.
+
+Deleting a user (with all their posts) or a tag (with all its links) used
+to run the database cascade inside the request, holding locks for as long
+as it took. Now the request only sets deleted_at on the row. Every ORM
+query hides soft-deleted users and tags, and the posts of soft-deleted
+users, through a global loader criteria. A query can opt out with the
+include_deleted execution option.
+
+The purge then removes the rows in chunks of BLOGLY_PURGE_CHUNK_SIZE, one
+short transaction each. It runs in a worker thread woken by each soft delete
+(BLOGLY_PURGE_WORKER, on by default), or from cron:
+
+    flask purge [--chunk-size 1000] [--every 60]
+    flask purge --status
+
+The posts of a user leave the post counts when the user is soft-deleted
+(see counters.uncount_user), so the purge deletes them without counting
+them again, and several purgers can run at once.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, exists, func, select
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import db, User, Post, Tag, PostTag
+from cache import cache, clear_on_commit
+from counters import uncount_user
+
+PURGE_CHUNK_SIZE = 1000
+INCLUDE_DELETED = 'include_deleted'
+
+users = User.__table__
+posts = Post.__table__
+tags = Tag.__table__
+posts_tags = PostTag.__table__
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(execute_state):
+    if (execute_state.is_select and not execute_state.is_column_load and not execute_state.is_relationship_load
+            and not execute_state.execution_options.get(INCLUDE_DELETED, False)):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(User, lambda cls: cls.deleted_at.is_(None), include_aliases=True),
+            with_loader_criteria(Tag, lambda cls: cls.deleted_at.is_(None), include_aliases=True),
+            # Core columns in the subquery, which the criteria above leave alone.
+            with_loader_criteria(Post, lambda cls: ~exists().where(users.c.id == cls.user_id,
+                                                                   users.c.deleted_at.is_not(None)),
+                                 include_aliases=True),
+        )
+
+
+def soft_delete(obj):
+    """Hide a user (and their posts) or a tag until it is purged. Commit to apply."""
+    if obj.deleted_at is not None:
+        return
+    obj.deleted_at = datetime.now(timezone.utc)
+    if isinstance(obj, User):
+        uncount_user(obj.id)
+        # Their posts disappear from every listing and page.
+        clear_on_commit(db.session())
+
+
+def _purge_user_chunk(conn, user_id, chunk_size):
+    """Delete up to chunk_size posts of a deleted user, or the user once none are left."""
+    post_ids = conn.execute(select(posts.c.id).where(posts.c.user_id == user_id).limit(chunk_size)).scalars().all()
+    if not post_ids:
+        conn.execute(delete(users).where(users.c.id == user_id))
+        return 0, set()
+    # Out of the counts since the soft delete (see counters.uncount_user).
+    unlinked = conn.execute(delete(posts_tags).where(posts_tags.c.post_id.in_(post_ids))
+                            .returning(posts_tags.c.tag_id)).scalars().all()
+    deleted = conn.execute(delete(posts).where(posts.c.id.in_(post_ids)).returning(posts.c.id)).scalars().all()
+    return len(deleted), {f'tag:{tag_id}' for tag_id in unlinked}
+
+
+def _purge_tag_chunk(conn, tag_id, chunk_size):
+    """Unlink up to chunk_size posts from a deleted tag, or delete the tag once none are left."""
+    chunk = select(posts_tags.c.post_id).where(posts_tags.c.tag_id == tag_id).limit(chunk_size)
+    unlinked = conn.execute(delete(posts_tags).where(posts_tags.c.tag_id == tag_id,
+                                                     posts_tags.c.post_id.in_(chunk))
+                            .returning(posts_tags.c.post_id)).scalars().all()
+    if not unlinked:
+        conn.execute(delete(tags).where(tags.c.id == tag_id))
+    return len(unlinked), set()
+
+
+def pending(conn):
+    """What is left to purge: {'users': {id: posts}, 'tags': {id: links}}."""
+    user_rows = conn.execute(select(users.c.id, func.count(posts.c.id))
+                             .select_from(users.outerjoin(posts, posts.c.user_id == users.c.id))
+                             .where(users.c.deleted_at.is_not(None)).group_by(users.c.id))
+    tag_rows = conn.execute(select(tags.c.id, func.count(posts_tags.c.post_id))
+                            .select_from(tags.outerjoin(posts_tags, posts_tags.c.tag_id == tags.c.id))
+                            .where(tags.c.deleted_at.is_not(None)).group_by(tags.c.id))
+    return {'users': dict(user_rows.all()), 'tags': dict(tag_rows.all())}
+
+
+def purge(chunk_size=PURGE_CHUNK_SIZE, engine=None, progress=None):
+    """Purge every soft-deleted user and tag, one chunk per transaction.
+
+    progress(kind, row_id, rows) is called after each chunk. Returns the
+    totals: {'posts': posts deleted, 'links': tag links deleted,
+    'users': users and 'tags': tags deleted}.
+    """
+    engine = engine if engine is not None else db.engine
+    totals = {'posts': 0, 'links': 0, 'users': 0, 'tags': 0}
+    with engine.connect() as conn:
+        user_ids = conn.execute(select(users.c.id).where(users.c.deleted_at.is_not(None))).scalars().all()
+        tag_ids = conn.execute(select(tags.c.id).where(tags.c.deleted_at.is_not(None))).scalars().all()
+
+    for kind, ids, purge_chunk, counted in (('user', user_ids, _purge_user_chunk, 'posts'),
+                                            ('tag', tag_ids, _purge_tag_chunk, 'links')):
+        for row_id in ids:
+            while True:
+                with engine.begin() as conn:
+                    rows, deps = purge_chunk(conn, row_id, chunk_size)
+                if deps:
+                    cache.invalidate(*deps)
+                totals[counted] += rows
+                if progress is not None:
+                    progress(kind, row_id, rows)
+                if not rows:
+                    totals[f'{kind}s'] += 1
+                    break
+    return totals
+
+
+class Purger:
+    """Background thread that purges soft-deleted rows after each soft delete."""
+
+    def __init__(self, chunk_size=PURGE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.enabled = True
+        self.progress = {'posts': 0, 'links': 0, 'users': 0, 'tags': 0, 'last_purge': None}
+        self._app = None
+        self._wanted = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.chunk_size = app.config.get('BLOGLY_PURGE_CHUNK_SIZE', self.chunk_size)
+        self.enabled = app.config.get('BLOGLY_PURGE_WORKER', self.enabled)
+        self._app = app
+        app.extensions['blogly_purger'] = self
+
+    def wake(self):
+        """Start a purge soon, in the worker thread (if enabled)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._idle.clear()
+            self._wanted.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='blogly-purge', daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        """Block until the worker has nothing left to do. Returns False on timeout."""
+        return self._idle.wait(timeout)
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            try:
+                with self._app.app_context():
+                    purge(self.chunk_size, progress=self._report)
+                self.progress['last_purge'] = datetime.now(timezone.utc).isoformat()
+            except Exception:
+                self._app.logger.exception('Purge of deleted rows failed')
+            with self._lock:
+                if not self._wanted.is_set():
+                    self._idle.set()
+
+    def _report(self, kind, row_id, rows):
+        self.progress['posts' if kind == 'user' else 'links'] += rows
+        if rows:
+            self._app.logger.info('Purged %d %s of deleted %s %d', rows, 'posts' if kind == 'user' else 'links',
+                                  kind, row_id)
+        else:
+            self.progress[f'{kind}s'] += 1
+            self._app.logger.info('Purged deleted %s %d', kind, row_id)
+
+
+@click.command('purge')
+@click.option('--chunk-size', type=int, default=None, help='Rows per transaction (BLOGLY_PURGE_CHUNK_SIZE).')
+@click.option('--every', type=float, default=None, help='Keep purging every this many seconds.')
+@click.option('--status', is_flag=True, help='Only show what is waiting to be purged.')
+@with_appcontext
+def purge_command(chunk_size, every, status):
+    """Purge soft-deleted users and tags."""
+    if status:
+        with db.engine.connect() as conn:
+            left = pending(conn)
+        for kind, counted in (('users', 'posts'), ('tags', 'links')):
+            for row_id, rows in sorted(left[kind].items()):
+                click.echo(f'{kind[:-1]} {row_id}: {rows} {counted} left')
+        if not left['users'] and not left['tags']:
+            click.echo('Nothing to purge.')
+        return
+
+    chunk_size = chunk_size or current_app.config.get('BLOGLY_PURGE_CHUNK_SIZE', PURGE_CHUNK_SIZE)
+
+    def progress(kind, row_id, rows):
+        click.echo(f'{kind} {row_id}: purged {rows} {"posts" if kind == "user" else "links"}' if rows
+                   else f'{kind} {row_id}: deleted')
+
+    while True:
+        start = time.perf_counter()
+        totals = purge(chunk_size, progress=progress)
+        click.echo(f'Purged {totals["users"]} user(s), {totals["tags"]} tag(s), {totals["posts"]} post(s) '
+                   f'and {totals["links"]} link(s) in {time.perf_counter() - start:.3f}s.')
+        if every is None:
+            break
+        time.sleep(every)
+
+
+purger = Purger()
@@ -0,0 +1,239 @@
+"""Precomputed feeds: the newest posts overall, of each author and of each tag.
+
+Every feed is a bounded list of (post id, created_at) in feed_entries, the
+BLOGLY_FEED_LENGTH newest posts of the feed at most. Writes fan out: when a
+post is created, edited or retagged, it is appended to the global feed, the
+feed of its author ('user:<id>') and those of its tags ('tag:<id>') in the
+same transaction, and dropped from the feeds it left. Reading a feed page is
+then one range read of the (feed, created_at, post_id) index, joined to the
+posts on their primary key.
+
+A list always holds every post of its feed from its oldest entry on, so a
+page reaching past its end continues with the regular query from there.
+Lists shrink when posts are deleted, untagged or hidden with their author,
+and are refilled from the posts when a shorter one is written to again.
+Changes made any other way (raw SQL, Post.tags.append on a stored post)
+are not published; `flask feeds rebuild` rebuilds every list, as do the
+migration, seeding and imports.
+"""
+
+from collections import Counter
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import String, cast, delete, event, exists, func, insert, literal, select, tuple_
+from sqlalchemy.orm import object_session
+from models import db, Post, PostTag
+from queries import options_for
+
+FEED_LENGTH = 200
+GLOBAL = 'all'
+PENDING_KEY = 'blogly_feeds_pending'
+
+posts = Post.__table__
+posts_tags = PostTag.__table__
+
+feed_entries = db.Table(
+    'feed_entries',
+    db.Column('feed', db.String(40), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('created_at', db.DateTime, nullable=False),
+    # a page of a feed: WHERE feed = ? ORDER BY created_at DESC, post_id DESC
+    db.Index('ix_feed_entries_feed_created_at_post_id', 'feed', 'created_at', 'post_id'),
+    # the entries of a post, when it is published again or deleted
+    db.Index('ix_feed_entries_post_id', 'post_id'),
+)
+
+
+def user_feed(user_id):
+    return f'user:{user_id}'
+
+
+def tag_feed(tag_id):
+    return f'tag:{tag_id}'
+
+
+def feeds_of(user_id, tag_ids):
+    """The feeds a post by user_id with tag_ids belongs to."""
+    return [GLOBAL, *([user_feed(user_id)] if user_id is not None else []),
+            *(tag_feed(tag_id) for tag_id in tag_ids)]
+
+
+def _criteria(feed):
+    """Conditions on posts selecting the posts of a feed."""
+    kind, _, row_id = feed.partition(':')
+    if kind == 'user':
+        return [posts.c.user_id == int(row_id)]
+    if kind == 'tag':
+        return [exists().where(posts_tags.c.post_id == posts.c.id, posts_tags.c.tag_id == int(row_id))]
+    if feed == GLOBAL:
+        return []
+    raise ValueError(f'Unknown feed: {feed}')
+
+
+class Feeds:
+    """Maintains and reads the feed lists."""
+
+    def __init__(self, length=FEED_LENGTH):
+        self.length = length
+
+    def init_app(self, app):
+        self.length = app.config.get('BLOGLY_FEED_LENGTH', self.length)
+        app.extensions['blogly_feeds'] = self
+
+    # Writing
+
+    def publish(self, post_ids, conn):
+        """Bring the posts' entries up to date, in every feed they joined or left."""
+        post_ids = sorted(set(post_ids))
+        if not post_ids:
+            return
+        rows = conn.execute(select(posts.c.id, posts.c.user_id, posts.c.created_at, posts_tags.c.tag_id)
+                            .outerjoin(posts_tags, posts_tags.c.post_id == posts.c.id)
+                            .where(posts.c.id.in_(post_ids))).all()
+        tag_ids, found = {}, {}
+        for post_id, user_id, created_at, tag_id in rows:
+            found[post_id] = (user_id, created_at)
+            if tag_id is not None:
+                tag_ids.setdefault(post_id, []).append(tag_id)
+        wanted = [{'feed': feed, 'post_id': post_id, 'created_at': created_at}
+                  for post_id, (user_id, created_at) in found.items()
+                  for feed in feeds_of(user_id, tag_ids.get(post_id, ()))]
+
+        left = conn.execute(delete(feed_entries).where(feed_entries.c.post_id.in_(post_ids))
+                            .returning(feed_entries.c.feed)).scalars().all()
+        touched = set(left) | {entry['feed'] for entry in wanted}
+        lists = {feed: (size, oldest) for feed, size, oldest in conn.execute(
+            select(feed_entries.c.feed, func.count(), func.min(feed_entries.c.created_at))
+            .where(feed_entries.c.feed.in_(sorted(touched))).group_by(feed_entries.c.feed))}
+
+        appended, refill = [], set()
+        for entry in wanted:
+            size, oldest = lists.get(entry['feed'], (0, None))
+            if size and entry['created_at'] >= oldest:
+                appended.append(entry)
+            elif size < self.length:
+                # Older than a list that may be missing older posts: refill it.
+                refill.add(entry['feed'])
+        refill |= {feed for feed in left if feed not in lists}
+        appended = [entry for entry in appended if entry['feed'] not in refill]
+        if appended:
+            conn.execute(insert(feed_entries), appended)
+            overflow = Counter(entry['feed'] for entry in appended)
+            for feed, added in sorted(overflow.items()):
+                self._trim(conn, feed, lists[feed][0] + added - self.length)
+        if refill:
+            self.rebuild(conn, refill)
+
+    def _trim(self, conn, feed, count):
+        """Drop the count oldest entries of a feed."""
+        if count > 0:
+            oldest = (select(feed_entries.c.post_id).where(feed_entries.c.feed == feed)
+                      .order_by(feed_entries.c.created_at, feed_entries.c.post_id).limit(count))
+            conn.execute(delete(feed_entries).where(feed_entries.c.feed == feed,
+                                                    feed_entries.c.post_id.in_(oldest)))
+
+    def rebuild(self, conn, names):
+        """Refill the lists of the named feeds from the posts."""
+        names = sorted(names)
+        conn.execute(delete(feed_entries).where(feed_entries.c.feed.in_(names)))
+        for feed in names:
+            newest = (select(literal(feed, String), posts.c.id, posts.c.created_at).where(*_criteria(feed))
+                      .order_by(posts.c.created_at.desc(), posts.c.id.desc()).limit(self.length))
+            conn.execute(insert(feed_entries).from_select(['feed', 'post_id', 'created_at'], newest))
+
+    def rebuild_all(self, conn):
+        """Rebuild every feed from the posts, a statement per kind of feed."""
+        conn.execute(delete(feed_entries))
+        self.rebuild(conn, [GLOBAL])
+        for name, owner, source in (('user:', posts.c.user_id, posts),
+                                    ('tag:', posts_tags.c.tag_id,
+                                     posts_tags.join(posts, posts.c.id == posts_tags.c.post_id))):
+            ranked = (select(literal(name, String).concat(cast(owner, String)).label('feed'), posts.c.id,
+                             posts.c.created_at,
+                             func.row_number().over(partition_by=owner,
+                                                    order_by=(posts.c.created_at.desc(), posts.c.id.desc()))
+                             .label('rank'))
+                      .select_from(source).where(owner.is_not(None)).subquery())
+            conn.execute(insert(feed_entries).from_select(
+                ['feed', 'post_id', 'created_at'],
+                select(ranked.c.feed, ranked.c.id, ranked.c.created_at).where(ranked.c.rank <= self.length)))
+
+    # Reading
+
+    def page_statement(self, feed, limit):
+        """The newest posts of a feed, from its list: one index range read."""
+        _criteria(feed)  # raises ValueError for an unknown feed
+        return (select(Post).options(*options_for('post_card'))
+                .join(feed_entries, feed_entries.c.post_id == Post.id).where(feed_entries.c.feed == feed)
+                .order_by(feed_entries.c.created_at.desc(), feed_entries.c.post_id.desc()).limit(limit))
+
+    def tail_statement(self, feed, after, limit):
+        """The posts of a feed older than the post after (or all), by the regular query."""
+        statement = select(Post).options(*options_for('post_card')).where(*_criteria(feed))
+        if after is not None:
+            statement = statement.where(tuple_(Post.created_at, Post.id) < tuple_(after.created_at, after.id))
+        return statement.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit)
+
+    def posts(self, feed, limit):
+        """The limit newest posts of a feed, ready to be rendered as post cards."""
+        found = db.session.scalars(self.page_statement(feed, limit)).all()
+        if len(found) < limit:
+            found += db.session.scalars(self.tail_statement(feed, found[-1] if found else None,
+                                                            limit - len(found))).all()
+        return found
+
+    async def posts_async(self, fetch, feed, limit):
+        """posts() for the async views; await fetch(statement) returns its rows."""
+        found = list(await fetch(self.page_statement(feed, limit)))
+        if len(found) < limit:
+            found += await fetch(self.tail_statement(feed, found[-1] if found else None, limit - len(found)))
+        return found
+
+
+feeds = Feeds()
+
+
+def publish_on_commit(session, *post_ids):
+    """Publish posts to their feeds when the session's transaction commits."""
+    session.info.setdefault(PENDING_KEY, set()).update(post_ids)
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_update')
+def _post_changed(mapper, connection, target):
+    publish_on_commit(object_session(target), target.id)
+
+
+@event.listens_for(PostTag, 'after_insert')
+@event.listens_for(PostTag, 'after_delete')
+def _link_changed(mapper, connection, target):
+    publish_on_commit(object_session(target), target.post_id)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _publish_pending(session):
+    # Flush first: its inserts and updates add to the pending posts.
+    session.flush()
+    post_ids = session.info.pop(PENDING_KEY, None)
+    if post_ids:
+        feeds.publish(post_ids, session.connection())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+@click.group('feeds')
+def feeds_command():
+    """Maintain the precomputed feeds."""
+
+
+@feeds_command.command('rebuild')
+@with_appcontext
+def rebuild_command():
+    """Rebuild every feed from the posts."""
+    with db.engine.begin() as conn:
+        feeds.rebuild_all(conn)
+        entries = conn.execute(select(func.count()).select_from(feed_entries)).scalar()
+    click.echo(f'Rebuilt the feeds: {entries} entries.')
@@ -0,0 +1,290 @@
+"""Per-request timing, SQL counts, Prometheus metrics and slow-request profiles.
+
+Every request gets a Server-Timing header with its database time and query
+count, template render time and total time, e.g.
+
+    Server-Timing: db;dur=3.1;desc="4 queries", tpl;dur=1.2, total;dur=6.0
+
+The same numbers feed per-route histograms served in the Prometheus text
+format at /metrics (BLOGLY_METRICS, on by default except in the prod
+profile), along with the connection pool metrics.
+
+Profiling is opt-in: with BLOGLY_PROFILE_SLOW_MS set, a sample of requests
+(BLOGLY_PROFILE_SAMPLE_RATE, default 0.1) runs under a profiler, and those
+slower than the threshold are dumped to BLOGLY_PROFILE_DIR. The profiler is
+cProfile (.prof files for pstats/snakeviz), or pyinstrument (.html) if
+BLOGLY_PROFILER is 'pyinstrument' and it is installed. One request is
+profiled at a time, from before_request until teardown, so a request that
+raises frees the profiler too.
+"""
+
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from flask import (Response, before_render_template, current_app, g, has_app_context, request,
+                   template_rendered)
+from sqlalchemy import event
+from models import db
+from pooling import pool_metrics
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+TIMING_KEY = 'blogly_timing'
+QUERY_START_KEY = 'blogly_query_start'
+
+
+class RequestTiming:
+    """What one request has spent so far, in seconds."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.templates = 0.0
+        self.template_depth = 0
+        self.template_start = 0.0
+        self.profiler = None
+        self.profiling = False
+
+    def server_timing(self, total):
+        return (f'db;dur={self.db * 1000:.1f};desc="{self.queries} queries", '
+                f'tpl;dur={self.templates * 1000:.1f}, total;dur={total * 1000:.1f}')
+
+
+def _current():
+    return g.get(TIMING_KEY) if has_app_context() else None
+
+
+def _stop(profiler):
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    else:
+        profiler.stop()
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class Histogram:
+    """A Prometheus histogram, one series per combination of label values."""
+
+    def __init__(self, name, help_text, buckets, labels):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self._lock:
+            series = self.series.setdefault(values, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((values, (list(counts), count, total))
+                            for values, (counts, count, total) in self.series.items())
+        for values, (counts, count, total) in series:
+            labels = _labels(self.labels, values)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Instrumentation:
+    """Hooks request, template and SQL timing into an app."""
+
+    def __init__(self):
+        labels = ('route', 'method')
+        self.durations = Histogram('blogly_request_duration_seconds', 'Time to handle a request.',
+                                   DURATION_BUCKETS, labels)
+        self.db_time = Histogram('blogly_request_db_seconds', 'Time spent in SQL per request.',
+                                 DURATION_BUCKETS, labels)
+        self.template_time = Histogram('blogly_request_template_seconds', 'Time spent rendering templates.',
+                                       DURATION_BUCKETS, labels)
+        self.queries = Histogram('blogly_request_sql_queries', 'SQL statements per request.',
+                                 QUERY_BUCKETS, labels)
+        self.statuses = {}
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        self._engines = set()
+
+    def init_app(self, app):
+        app.config.setdefault('BLOGLY_METRICS', True)
+        app.config.setdefault('BLOGLY_PROFILE_SLOW_MS', None)
+        app.config.setdefault('BLOGLY_PROFILE_SAMPLE_RATE', 0.1)
+        app.config.setdefault('BLOGLY_PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('BLOGLY_PROFILER', 'cprofile')
+        app.extensions['blogly_instrumentation'] = self
+
+        with app.app_context():
+            for engine in db.engines.values():
+                self.listen(engine)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        app.before_request(self._request_started)
+        app.after_request(self._request_finished)
+        app.teardown_request(self._request_torn_down)
+        if app.config['BLOGLY_METRICS']:
+            app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def listen(self, engine):
+        if engine in self._engines:
+            return
+        self._engines.add(engine)
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault(QUERY_START_KEY, []).append(time.perf_counter())
+            if context is not None:
+                context.blogly_executing = True
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.blogly_executing = False
+            self._query_finished(conn)
+
+        @event.listens_for(engine, 'handle_error')
+        def failed(context):
+            # A statement that raised never reaches after_cursor_execute; its
+            # start would otherwise stay on the connection's stack for good.
+            if getattr(context.execution_context, 'blogly_executing', False):
+                context.execution_context.blogly_executing = False
+                self._query_finished(context.connection)
+
+    def _query_finished(self, conn):
+        elapsed = time.perf_counter() - conn.info[QUERY_START_KEY].pop()
+        timing = _current()
+        if timing is not None:
+            timing.queries += 1
+            timing.db += elapsed
+
+    def _template_started(self, app, template, context, **extra):
+        timing = _current()
+        if timing is not None:
+            if timing.template_depth == 0:
+                timing.template_start = time.perf_counter()
+            timing.template_depth += 1
+
+    def _template_finished(self, app, template, context, **extra):
+        timing = _current()
+        if timing is not None and timing.template_depth:
+            timing.template_depth -= 1
+            if timing.template_depth == 0:
+                timing.templates += time.perf_counter() - timing.template_start
+
+    def _request_started(self):
+        timing = g.blogly_timing = RequestTiming()
+        config = current_app.config
+        if config['BLOGLY_PROFILE_SLOW_MS'] is not None and random.random() < config['BLOGLY_PROFILE_SAMPLE_RATE']:
+            if self._profiling.acquire(blocking=False):
+                timing.profiling = True
+                timing.profiler = self._start_profiler(config['BLOGLY_PROFILER'])
+
+    def _request_finished(self, response):
+        timing = g.get(TIMING_KEY)
+        if timing is None:
+            return response
+        total = time.perf_counter() - timing.start
+        if timing.profiler is not None:
+            profiler, timing.profiler = timing.profiler, None
+            self._finish_profile(profiler, total)
+        response.headers['Server-Timing'] = timing.server_timing(total)
+
+        labels = (request.url_rule.rule if request.url_rule is not None else 'unmatched', request.method)
+        self.durations.observe(labels, total)
+        self.db_time.observe(labels, timing.db)
+        self.template_time.observe(labels, timing.templates)
+        self.queries.observe(labels, timing.queries)
+        with self._lock:
+            key = labels + (str(response.status_code),)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+        return response
+
+    def _request_torn_down(self, exc):
+        """Stop the profiler and free it for the next request, however this one ended.
+
+        after_request is skipped when a view raises, so this is where the
+        profiling lock is given back.
+        """
+        timing = g.pop(TIMING_KEY, None)
+        if timing is None or not timing.profiling:
+            return
+        try:
+            if timing.profiler is not None:
+                _stop(timing.profiler)
+        finally:
+            timing.profiler = None
+            timing.profiling = False
+            self._profiling.release()
+
+    def _start_profiler(self, kind):
+        try:
+            if kind == 'pyinstrument':
+                # optional dependency, only needed when asked for
+                from pyinstrument import Profiler
+                profiler = Profiler(async_mode='disabled')
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+        except ValueError:
+            # another profiler (e.g. a debugger) is active in this process
+            return None
+        return profiler
+
+    def _finish_profile(self, profiler, total):
+        config = current_app.config
+        _stop(profiler)
+        if total * 1000 < config['BLOGLY_PROFILE_SLOW_MS']:
+            return
+        os.makedirs(config['BLOGLY_PROFILE_DIR'], exist_ok=True)
+        name = re.sub(r'[^\w.-]+', '_', f'{request.method} {request.path}').strip('_')
+        path = os.path.join(config['BLOGLY_PROFILE_DIR'],
+                            f'{time.strftime("%Y%m%d-%H%M%S")}-{total * 1000:.0f}ms-{name}')
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(path + '.prof')
+        else:
+            with open(path + '.html', 'w') as f:
+                f.write(profiler.output_html())
+
+    def render_metrics(self, app):
+        lines = []
+        for histogram in (self.durations, self.db_time, self.template_time, self.queries):
+            lines.extend(histogram.render())
+        lines += ['# HELP blogly_requests_total Requests handled.', '# TYPE blogly_requests_total counter']
+        with self._lock:
+            statuses = sorted(self.statuses.items())
+        for values, count in statuses:
+            lines.append(f'blogly_requests_total{{{_labels(("route", "method", "status"), values)}}} {count}')
+
+        pools = pool_metrics(app)
+        for name, key, kind, help_text in (
+                ('blogly_pool_checkouts_total', 'checkouts', 'counter', 'Connections checked out of the pool.'),
+                ('blogly_pool_timeouts_total', 'timeouts', 'counter', 'Checkouts that timed out.'),
+                ('blogly_pool_wait_seconds_total', 'wait_total_s', 'counter', 'Time spent waiting for a connection.'),
+                ('blogly_pool_checked_out', 'checked_out', 'gauge', 'Connections in use.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines.extend(f'{name}{{bind="{bind}"}} {stats[key]}' for bind, stats in sorted(pools.items())
+                         if key in stats)
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return Response(self.render_metrics(current_app), mimetype='text/plain; version=0.0.4')
+
+
+instrumentation = Instrumentation()
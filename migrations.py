@@ -0,0 +1,166 @@
+"""Versioned schema migrations for Blogly.
+
+An empty database gets the current schema from db.create_all() and is stamped
+with the latest version. A database that already has the tables (for example
+one built by seed.py) gets every migration newer than its recorded version,
+inside a single transaction, so no data has to be dropped.
+"""
+
+from datetime import datetime, timezone
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, inspect, select, func, text
+from models import db, User, Post, Tag, PostTag, POST_SEARCH_DDL
+from counters import recount_all, trending_tags
+from feeds import feeds, feed_entries
+
+schema_version = db.Table(
+    'schema_version',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('description', db.String(200), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description, dialects=None):
+    """Register a function taking a connection as the migration to a version.
+
+    dialects limits a migration to some database backends (e.g. 'postgresql');
+    on the others it is recorded as applied without running.
+    """
+    def register(fn):
+        MIGRATIONS.append((version, description, dialects, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def _index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+@migration(1, 'Index the columns behind the listing and detail pages')
+def add_listing_indexes(conn):
+    for model, name in ((User, 'ix_users_last_name_first_name_id'),
+                        (Post, 'ix_posts_created_at_id'),
+                        (Post, 'ix_posts_user_id_created_at_id'),
+                        (PostTag, 'ix_posts_tags_tag_id_post_id')):
+        _index(model, name).create(conn, checkfirst=True)
+
+
+@migration(2, 'Add the full-text search vector of posts', dialects=('postgresql',))
+def add_post_search_vector(conn):
+    for statement in POST_SEARCH_DDL:
+        conn.execute(text(statement))
+
+
+@migration(3, 'Add maintained post counts of users and tags, and trending_tags')
+def add_post_counts(conn):
+    for model in (User, Tag):
+        columns = [column['name'] for column in inspect(conn).get_columns(model.__tablename__)]
+        if 'post_count' not in columns:
+            conn.execute(text(f'ALTER TABLE {model.__tablename__} ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0'))
+    recount_all(conn)
+    _index(User, 'ix_users_post_count_id').create(conn, checkfirst=True)
+    _index(Tag, 'ix_tags_post_count_id').create(conn, checkfirst=True)
+    trending_tags.create(conn, checkfirst=True)
+
+
+@migration(4, 'Add soft deletes of users and tags')
+def add_soft_deletes(conn):
+    for model in (User, Tag):
+        columns = [column['name'] for column in inspect(conn).get_columns(model.__tablename__)]
+        if 'deleted_at' not in columns:
+            conn.execute(text(f'ALTER TABLE {model.__tablename__} ADD COLUMN deleted_at TIMESTAMP'))
+    _index(User, 'ix_users_deleted_at').create(conn, checkfirst=True)
+    _index(Tag, 'ix_tags_deleted_at').create(conn, checkfirst=True)
+
+
+@migration(5, 'Make tag names unique among the live tags only, ignoring case')
+def free_deleted_tag_names(conn):
+    """Replace the unique constraint on tags.name by a unique index of lower(name) of the tags not deleted.
+
+    Live tags whose names differ only in case get their id appended to the
+    name, all but the oldest, so the index can be built; nothing is merged.
+
+    SQLite cannot drop a constraint in place: a SQLite database from before
+    this version keeps it, so a deleted tag holds its name until it is
+    purged, unless the database is exported and imported into a new one
+    (see transfer.py).
+    """
+    if conn.dialect.name != 'sqlite':
+        for constraint in inspect(conn).get_unique_constraints(Tag.__tablename__):
+            if constraint['column_names'] == ['name']:
+                conn.execute(text(f'ALTER TABLE {Tag.__tablename__} DROP CONSTRAINT {constraint["name"]}'))
+    tags = Tag.__table__
+    seen = set()
+    renames = []
+    for tag_id, name, key in conn.execute(select(tags.c.id, tags.c.name, func.lower(tags.c.name))
+                                          .where(tags.c.deleted_at.is_(None)).order_by(tags.c.id)):
+        if key in seen:
+            suffix = f' ({tag_id})'
+            renames.append({'tag_id': tag_id, 'name': name[:tags.c.name.type.length - len(suffix)] + suffix})
+        seen.add(key)
+    if renames:
+        conn.execute(tags.update().where(tags.c.id == bindparam('tag_id')).values(name=bindparam('name')), renames)
+    _index(Tag, 'ix_tags_name').create(conn, checkfirst=True)
+
+
+@migration(6, 'Add the precomputed post feeds')
+def add_feeds(conn):
+    feed_entries.create(conn, checkfirst=True)
+    feeds.rebuild_all(conn)
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    """The version recorded in the database, or None if it has no Blogly tables yet."""
+    tables = inspect(conn).get_table_names()
+    if User.__tablename__ not in tables:
+        return None
+    if schema_version.name not in tables:
+        return 0
+    return conn.execute(select(func.coalesce(func.max(schema_version.c.version), 0))).scalar()
+
+
+def _stamp(conn, version, description):
+    conn.execute(schema_version.insert().values(
+        version=version, description=description, applied_at=datetime.now(timezone.utc)))
+
+
+def upgrade(engine=None):
+    """Bring the database up to the latest version. Returns the versions applied."""
+    engine = engine if engine is not None else db.engine
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+        if version is None:
+            db.metadata.create_all(conn)
+            _stamp(conn, latest_version(), 'Create the schema')
+            return [latest_version()]
+
+        schema_version.create(conn, checkfirst=True)
+        for number, description, dialects, fn in MIGRATIONS:
+            if number <= version:
+                continue
+            if dialects is None or conn.dialect.name in dialects:
+                fn(conn)
+            _stamp(conn, number, description)
+            applied.append(number)
+    return applied
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """Apply pending schema migrations to the configured database."""
+    applied = upgrade()
+    if applied:
+        click.echo(f'Applied migration(s): {", ".join(str(v) for v in applied)}')
+    else:
+        click.echo(f'Database is up to date (version {latest_version()}).')
@@ -1,25 +1,54 @@
 """Models for Blogly."""
 
+import unicodedata
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 from datetime import datetime, timezone
-
-db = SQLAlchemy()
-
-def connect_db(app):
-    """Connect to database."""
+from pooling import PoolPolicy
+from routing import ReplicaRouter, RoutingSession
+from templating import format_date
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def connect_db(app, pool=None):
+    """Connect to database.
+
+    pool is the PoolPolicy of the engines; by default it is built from the
+    BLOGLY_POOL_* settings of the app. Explicit SQLALCHEMY_ENGINE_OPTIONS win.
+    Read-only requests go to the replica binds in BLOGLY_REPLICAS, if any.
+    """
+    pool = pool if pool is not None else PoolPolicy.from_config(app.config)
+    options = pool.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**options, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
     db.app = app
     db.init_app(app)
+    with app.app_context():
+        app.extensions['blogly_pool'] = {key: (engine, pool.install(engine)) for key, engine in db.engines.items()}
+    ReplicaRouter.from_config(app.config).init_app(app)
 
 
 class User(db.Model):
     """User model."""
 
     __tablename__ = "users"
+    __table_args__ = (
+        # users listing: ORDER BY last_name, first_name, id
+        db.Index('ix_users_last_name_first_name_id', 'last_name', 'first_name', 'id'),
+        # users listing by popularity: ORDER BY post_count DESC, id DESC
+        db.Index('ix_users_post_count_id', 'post_count', 'id'),
+        # the few users waiting to be purged (see deletions.py)
+        db.Index('ix_users_deleted_at', 'deleted_at', postgresql_where=db.text('deleted_at IS NOT NULL'),
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(50), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
     image_url = db.Column(db.String, nullable=False, default='https://images.unsplash.com/photo-1724094505377-ac01c7813010?q=80&w=2574&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D')
+    # maintained by counters.py
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # set by a soft delete; the row is purged later (see deletions.py)
+    deleted_at = db.Column(db.DateTime)
 
     posts = db.relationship('Post', backref='user', cascade='all, delete', passive_deletes=True)
 
@@ -35,11 +64,17 @@ class Post(db.Model):
     """Post model."""
 
     __tablename__ = "posts"
+    __table_args__ = (
+        # home page and post listings: ORDER BY created_at DESC, id DESC
+        db.Index('ix_posts_created_at_id', 'created_at', 'id'),
+        # a user's posts, newest first
+        db.Index('ix_posts_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
 
     posts_tags = db.relationship('PostTag', backref='post')
@@ -50,16 +85,39 @@ class Post(db.Model):
     
     @property
     def formatted_date(self):
-        return f"{self.created_at.strftime('%a %b %d %Y, %I:%M %p')}"
+        return format_date(self.created_at)
+
+
+# Full-text search over posts (Postgres only, so the column is not mapped):
+# title is weighted above content, and a GIN index answers @@ matches.
+POST_SEARCH_DDL = (
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_posts_search_vector ON posts USING GIN (search_vector)",
+)
+
+for statement in POST_SEARCH_DDL:
+    event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
 
 
 class Tag(db.Model):
     """Tag model."""
 
     __tablename__ = "tags"
+    __table_args__ = (
+        # tags listing by popularity: ORDER BY post_count DESC, id DESC
+        db.Index('ix_tags_post_count_id', 'post_count', 'id'),
+        db.Index('ix_tags_deleted_at', 'deleted_at', postgresql_where=db.text('deleted_at IS NOT NULL'),
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(50), nullable=False, unique=True)
+    name = db.Column(db.String(50), nullable=False)
+    # maintained by counters.py
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # set by a soft delete; the row is purged later (see deletions.py)
+    deleted_at = db.Column(db.DateTime)
 
     posts_tags = db.relationship('PostTag', backref='tag', cascade='all, delete', passive_deletes=True)
 
@@ -67,10 +125,32 @@ class Tag(db.Model):
         return f'<Tag id={self.id} name={self.name}>'
 
 
+# Names are unique ignoring case, like the tag dictionary matches them, and
+# among the live tags only: a deleted tag waiting for the purge gives its name
+# up at once. SQLite's lower() folds ASCII letters only; beyond those the
+# dictionary's check is all there is.
+db.Index('ix_tags_name', db.func.lower(Tag.name), unique=True, postgresql_where=db.text('deleted_at IS NULL'),
+         sqlite_where=db.text('deleted_at IS NULL'))
+
+
+def tag_name(name):
+    """name as a tag is stored: without surrounding spaces, in Unicode NFC.
+
+    One form per name, so that spellings the index above would tell apart
+    (a precomposed letter or a letter and a combining accent) cannot make two
+    tags of one name.
+    """
+    return unicodedata.normalize('NFC', name.strip())
+
+
 class PostTag(db.Model):
     """Model for the table to connect posts and tags table (M2M relationship)."""
 
     __tablename__ = "posts_tags"
+    __table_args__ = (
+        # the primary key leads with post_id; this serves lookups by tag
+        db.Index('ix_posts_tags_tag_id_post_id', 'tag_id', 'post_id'),
+    )
 
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
     tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True)
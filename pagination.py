@@ -0,0 +1,171 @@
+"""Keyset (cursor) pagination for Blogly listings."""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from urllib.parse import urlencode
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+
+
+class Page:
+    """One page of a keyset-paginated listing."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f'<Page items={len(self.items)} next={self.next_cursor} prev={self.prev_cursor}>'
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if not isinstance(value.get('dt'), str):
+            raise ValueError(f'Invalid cursor value: {value}')
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def _check_values(values, columns):
+    """Raise ValueError unless each decoded value fits the python type of its sort column."""
+    for value, column in zip(values, columns):
+        expected = _python_type(column)
+        if value is None or expected is None:
+            continue
+        if expected is float:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+        elif expected is int:
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, expected)
+        if not valid:
+            raise ValueError(f'Invalid cursor value for {column.key}: {value!r}')
+
+
+def encode_cursor(values):
+    """Turn the sort key of a row into an opaque, URL-safe cursor."""
+    raw = json.dumps([_encode_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a sort key. Raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+    if not isinstance(values, list):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return [_decode_value(value) for value in values]
+
+
+def paginate(query, columns, after=None, before=None, per_page=DEFAULT_PAGE_SIZE, descending=False):
+    """Return a Page of query results ordered by columns, starting at a cursor.
+
+    columns must end with a unique column (normally the primary key) so that
+    the sort key identifies exactly one row. Only a row value comparison on
+    the sort key is added to the query, which an index on the same columns
+    answers without scanning the rows of earlier pages.
+    """
+    query, cursor, backwards = _keyset(query, columns, after, before, per_page, descending)
+    return _page(query.all(), columns, cursor, backwards, per_page)
+
+
+async def paginate_async(fetch, statement, columns, after=None, before=None, per_page=DEFAULT_PAGE_SIZE,
+                         descending=False):
+    """paginate() for a select() statement; await fetch(statement) returns its rows."""
+    statement, cursor, backwards = _keyset(statement, columns, after, before, per_page, descending)
+    return _page(list(await fetch(statement)), columns, cursor, backwards, per_page)
+
+
+def _keyset(query, columns, after, before, per_page, descending):
+    """Add the cursor condition, order and limit of a page to a Query or select()."""
+    backwards = before is not None
+    cursor = before if backwards else after
+    key = tuple_(*columns)
+
+    # Walking backwards flips both the comparison and the order; the fetched
+    # rows are reversed again in _page().
+    forward_order = not descending
+    ascending = forward_order != backwards
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ValueError(f'Invalid cursor: {cursor}')
+        _check_values(values, columns)
+        values = tuple_(*values)
+        query = query.filter(key > values if ascending else key < values)
+    query = query.order_by(*(column.asc() if ascending else column.desc() for column in columns))
+    return query.limit(per_page + 1), cursor, backwards
+
+
+def _page(rows, columns, cursor, backwards, per_page):
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor_of(row):
+        return encode_cursor([getattr(row, column.key) for column in columns])
+
+    has_next = cursor is not None if backwards else has_more
+    has_prev = has_more if backwards else cursor is not None
+    next_cursor = cursor_of(rows[-1]) if rows and has_next else None
+    prev_cursor = cursor_of(rows[0]) if rows and has_prev else None
+    return Page(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def paginate_request(query, columns, descending=False):
+    """paginate() with the cursor and page size taken from the current request."""
+    try:
+        return paginate(query, columns, **_request_args(), descending=descending)
+    except ValueError:
+        abort(400)
+
+
+async def paginate_request_async(fetch, statement, columns, descending=False):
+    """paginate_async() with the cursor and page size taken from the current request."""
+    try:
+        return await paginate_async(fetch, statement, columns, **_request_args(), descending=descending)
+    except ValueError:
+        abort(400)
+
+
+def _request_args():
+    return {'after': request.args.get('after'),
+            'before': request.args.get('before'),
+            'per_page': current_app.config.get('BLOGLY_PAGE_SIZE', DEFAULT_PAGE_SIZE)}
+
+
+def cursor_url(direction, cursor):
+    """URL of the current page with its cursor replaced, keeping other query args."""
+    args = request.args.to_dict(flat=False)
+    args.pop('after', None)
+    args.pop('before', None)
+    args[direction] = cursor
+    return f'{request.path}?{urlencode(args, doseq=True)}'
@@ -0,0 +1,219 @@
+"""Connection pool policy and checkout metrics for the Blogly database engine."""
+
+import threading
+import time
+from collections import deque
+from sqlalchemy import event, text
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+# Wait times kept per pool for percentiles; older samples are dropped.
+WAIT_SAMPLES = 10000
+
+
+class PoolMetrics:
+    """Counters for connection checkouts and the time spent waiting for one."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self._waits.append(seconds)
+
+    @property
+    def in_use(self):
+        """Connections checked out and not yet returned."""
+        return self.checkouts - self.checkins
+
+    def wait_percentile(self, pct):
+        with self._lock:
+            waits = sorted(self._waits)
+        if not waits:
+            return 0.0
+        return waits[min(len(waits) - 1, int(len(waits) * pct / 100))]
+
+    def snapshot(self, pool=None):
+        """The metrics as a dict, plus the live state of pool if given."""
+        data = {
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'connects': self.connects,
+            'timeouts': self.timeouts,
+            'wait_total_s': round(self.total_wait, 6),
+            'wait_max_s': round(self.max_wait, 6),
+            'wait_p99_s': round(self.wait_percentile(99), 6),
+        }
+        if isinstance(pool, QueuePool):
+            data.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+        return data
+
+
+class TimedCheckouts:
+    """Pool mixin that times how long each checkout waits for a free connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.record_wait(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(TimedCheckouts, QueuePool):
+    """QueuePool with checkout wait metrics."""
+
+
+class InstrumentedAsyncQueuePool(TimedCheckouts, AsyncAdaptedQueuePool):
+    """The asyncio version of InstrumentedQueuePool, for create_async_engine()."""
+
+
+class PoolPolicy:
+    """How the engine sizes, checks and configures its database connections.
+
+    size, max_overflow, timeout and recycle are the QueuePool settings;
+    pre_ping tests each connection before handing it out. statement_timeout
+    (milliseconds) and application_name are applied to every Postgres session.
+    null_pool=True opens a connection per checkout instead of pooling, for
+    running behind a transaction-mode pooler such as PgBouncer; the statement
+    timeout is then set per transaction, since session settings would leak to
+    other clients of the pooler's server connections.
+    """
+
+    def __init__(self, size=5, max_overflow=10, timeout=30, recycle=-1, pre_ping=False,
+                 statement_timeout=None, application_name='blogly', null_pool=False):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.statement_timeout = statement_timeout
+        self.application_name = application_name
+        self.null_pool = null_pool
+
+    @classmethod
+    def from_config(cls, config):
+        """Policy from the BLOGLY_POOL_* keys of a Flask config."""
+        defaults = cls()
+        return cls(size=config.get('BLOGLY_POOL_SIZE', defaults.size),
+                   max_overflow=config.get('BLOGLY_POOL_MAX_OVERFLOW', defaults.max_overflow),
+                   timeout=config.get('BLOGLY_POOL_TIMEOUT', defaults.timeout),
+                   recycle=config.get('BLOGLY_POOL_RECYCLE', defaults.recycle),
+                   pre_ping=config.get('BLOGLY_POOL_PRE_PING', defaults.pre_ping),
+                   statement_timeout=config.get('BLOGLY_STATEMENT_TIMEOUT', defaults.statement_timeout),
+                   application_name=config.get('BLOGLY_APPLICATION_NAME', defaults.application_name),
+                   null_pool=config.get('BLOGLY_NULL_POOL', defaults.null_pool))
+
+    def engine_options(self, url):
+        """Keyword arguments for create_engine() for a database URL."""
+        url = str(url)
+        if url.startswith('sqlite'):
+            if url in ('sqlite://', 'sqlite:///:memory:'):
+                # Flask-SQLAlchemy keeps in-memory databases on one static connection.
+                return {}
+            options = {'poolclass': InstrumentedQueuePool, 'pool_size': self.size,
+                       'max_overflow': self.max_overflow, 'pool_timeout': self.timeout}
+            if 'mode=memory' in url:
+                # A named in-memory database (see config.test_database_url):
+                # its connections are shared by threads.
+                options['connect_args'] = {'check_same_thread': False}
+            return options
+
+        options = {'pool_pre_ping': self.pre_ping}
+        connect_args = {}
+        if self.application_name:
+            connect_args['application_name'] = self.application_name
+        if self.null_pool:
+            options['poolclass'] = NullPool
+        else:
+            options.update(poolclass=InstrumentedQueuePool, pool_size=self.size, max_overflow=self.max_overflow,
+                           pool_timeout=self.timeout, pool_recycle=self.recycle)
+            if self.statement_timeout is not None:
+                connect_args['options'] = f'-c statement_timeout={int(self.statement_timeout)}'
+        options['connect_args'] = connect_args
+        return options
+
+    def async_engine_options(self, url):
+        """Keyword arguments for create_async_engine() (asyncpg or aiosqlite)."""
+        url = str(url)
+        if url.startswith('sqlite'):
+            if url.split('://', 1)[1] in ('', '/:memory:'):
+                return {}
+            return {'poolclass': InstrumentedAsyncQueuePool, 'pool_size': self.size,
+                    'max_overflow': self.max_overflow, 'pool_timeout': self.timeout}
+        server_settings = {}
+        if self.application_name:
+            server_settings['application_name'] = self.application_name
+        options = {'pool_pre_ping': self.pre_ping}
+        if self.null_pool:
+            options['poolclass'] = NullPool
+        else:
+            options.update(poolclass=InstrumentedAsyncQueuePool, pool_size=self.size,
+                           max_overflow=self.max_overflow, pool_timeout=self.timeout, pool_recycle=self.recycle)
+            if self.statement_timeout is not None:
+                server_settings['statement_timeout'] = str(int(self.statement_timeout))
+        # asyncpg prepares statements; a transaction-mode pooler cannot keep them.
+        connect_args = {'server_settings': server_settings}
+        if self.null_pool:
+            connect_args['statement_cache_size'] = 0
+        options['connect_args'] = connect_args
+        return options
+
+    def install(self, engine):
+        """Attach the per-connection setup and the metrics listeners to engine."""
+        metrics = getattr(engine.pool, 'metrics', None)
+        if metrics is None:
+            metrics = engine.pool.metrics = PoolMetrics()
+
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            metrics.connects += 1
+            if engine.dialect.name == 'sqlite':
+                # ON DELETE CASCADE of the models needs foreign keys enforced.
+                cursor = dbapi_connection.cursor()
+                cursor.execute('PRAGMA foreign_keys=ON')
+                if engine.url.query.get('mode') == 'memory':
+                    # A shared-cache memory database locks tables, not the
+                    # file: let readers through a writer's open transaction.
+                    cursor.execute('PRAGMA read_uncommitted=ON')
+                cursor.close()
+
+        @event.listens_for(engine, 'checkout')
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            metrics.checkouts += 1
+
+        @event.listens_for(engine, 'checkin')
+        def on_checkin(dbapi_connection, connection_record):
+            metrics.checkins += 1
+
+        if self.null_pool and self.statement_timeout is not None and engine.dialect.name == 'postgresql':
+            @event.listens_for(engine, 'begin')
+            def on_begin(conn):
+                conn.execute(text(f'SET LOCAL statement_timeout = {int(self.statement_timeout)}'))
+        return metrics
+
+
+def pool_metrics(app):
+    """Checkout metrics and pool state of each of app's engines, by bind key."""
+    return {key or 'default': metrics.snapshot(engine.pool)
+            for key, (engine, metrics) in app.extensions.get('blogly_pool', {}).items()}
@@ -0,0 +1,52 @@
+"""Query-building layer for Blogly: named eager-loading profiles for the models."""
+
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.orm import configure_mappers, joinedload, load_only, selectinload
+from models import db, Post, Tag
+
+# Each profile names the relationships a page is going to touch, so they are
+# loaded up front (one extra statement per collection) instead of lazily per row.
+# Profiles are callables because backref attributes such as Post.user and
+# Tag.posts only exist once the mappers are configured.
+PROFILES = {
+    'post_card': lambda: (selectinload(Post.tags), joinedload(Post.user)),
+    # edit_post.html only reads the post's own columns and its tags.
+    'post_form': lambda: (selectinload(Post.tags),),
+    # The tag forms list posts as checkboxes: their ids and titles only.
+    'tag_with_posts': lambda: (selectinload(Tag.posts).load_only(Post.id, Post.title),),
+    'post_title': lambda: (load_only(Post.id, Post.title),),
+    'plain': lambda: (),
+}
+
+
+def options_for(profile):
+    """Return the loader options of a named profile."""
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown loading profile: {profile}')
+    configure_mappers()
+    return PROFILES[profile]()
+
+
+def query(model, profile='plain'):
+    """Return model.query with the eager loads of the named profile applied."""
+    return model.query.options(*options_for(profile))
+
+
+@contextmanager
+def capture_statements(engine=None):
+    """Record every SQL statement sent to the database inside the block.
+
+    Yields a list that is filled with (statement, parameters) tuples.
+    """
+    engine = engine if engine is not None else db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,88 @@
+"""EXPLAIN the SQL behind each read route and report full table scans."""
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+from models import db, User, Post, Tag
+from queries import capture_statements
+
+DEFAULT_MAX_ROWS = 1000
+
+
+def sample_routes():
+    """The read routes worth checking, filled in with ids that exist."""
+    routes = ['/', '/users', '/tags']
+    for model, url in ((User, '/users/{}'), (Post, '/posts/{}'), (Tag, '/tags/{}')):
+        row_id = db.session.execute(select(func.min(model.id))).scalar()
+        if row_id is not None:
+            routes.append(url.format(row_id))
+    return routes
+
+
+def _postgresql_seq_scans(conn, statement, parameters, max_rows):
+    plan = conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters).scalar()
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan' and node['Plan Rows'] > max_rows:
+            yield f"Seq Scan on {node['Relation Name']} (~{node['Plan Rows']} rows)"
+        nodes.extend(node.get('Plans', []))
+
+
+def _sqlite_seq_scans(conn, statement, parameters, max_rows):
+    # SQLite has no row estimates, so a plain SCAN (one that uses no index)
+    # is measured against the size of the table it reads.
+    for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters):
+        detail = row[-1]
+        words = detail.split()
+        if len(words) == 2 and words[0] == 'SCAN':
+            table = words[1]
+            rows = conn.execute(text(f'SELECT count(*) FROM "{table}"')).scalar()
+            if rows > max_rows:
+                yield f'SCAN {table} ({rows} rows)'
+
+
+def find_seq_scans(url, max_rows=DEFAULT_MAX_ROWS):
+    """GET url and return (statement, problem) for each full scan above max_rows."""
+    engine = db.engine
+    with capture_statements(engine) as statements:
+        current_app.test_client().get(url)
+
+    explain = {'postgresql': _postgresql_seq_scans, 'sqlite': _sqlite_seq_scans}.get(engine.dialect.name)
+    if explain is None:
+        raise RuntimeError(f'No EXPLAIN support for the {engine.dialect.name} dialect')
+
+    problems = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            for problem in explain(conn, statement, parameters, max_rows):
+                problems.append((statement, problem))
+    return problems
+
+
+def check_route_plans(max_rows=DEFAULT_MAX_ROWS, routes=None):
+    """Return {url: problems} for every read route that falls back to a full scan."""
+    report = {}
+    for url in routes if routes is not None else sample_routes():
+        problems = find_seq_scans(url, max_rows)
+        if problems:
+            report[url] = problems
+    return report
+
+
+@click.command('check-plans')
+@click.option('--max-rows', default=DEFAULT_MAX_ROWS, show_default=True,
+              help='Largest table a route may scan without an index.')
+@with_appcontext
+def check_plans_command(max_rows):
+    """Fail if a read route's queries fall back to a sequential scan."""
+    report = check_route_plans(max_rows)
+    for url, problems in report.items():
+        for statement, problem in problems:
+            click.echo(f'{url}: {problem}\n    {" ".join(statement.split())}')
+    if report:
+        raise SystemExit(1)
+    click.echo('No sequential scans above the threshold.')
@@ -0,0 +1,114 @@
+"""Read-replica routing for the Blogly session.
+
+Requests that only read (GET, HEAD, OPTIONS) are served from one of the
+replica binds named in BLOGLY_REPLICAS, picked round-robin or by fewest
+connections in use (BLOGLY_REPLICA_STRATEGY), and kept for the rest of the
+request. Everything else goes to the primary database: other methods,
+flushes, INSERT/UPDATE/DELETE statements and work outside a request (CLI
+commands, migrations). For BLOGLY_STICKY_SECONDS after a browser has sent a
+write, its reads go to the primary as well, so that the page it is
+redirected to shows what it just saved even if the replicas lag behind.
+
+Other browsers may still read the old rows from a replica for that long, so
+what such a request rendered is not cached as current while a dependency
+changed within the sticky window (see replica_lag() and cache.FragmentCache.set).
+"""
+
+import itertools
+import threading
+import time
+from flask import current_app, has_app_context, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.expression import UpdateBase
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_KEY = 'blogly_primary_until'
+REPLICA_KEY = 'blogly_replica'
+STRATEGIES = ('round_robin', 'least_loaded')
+
+
+def connections_in_use(engine):
+    """Connections of engine currently checked out, from its pool metrics."""
+    metrics = getattr(engine.pool, 'metrics', None)
+    return metrics.in_use if metrics is not None else 0
+
+
+class ReplicaRouter:
+    """Chooses the replica bind for read-only requests and tracks stickiness."""
+
+    def __init__(self, replicas=(), strategy='round_robin', sticky_seconds=5):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown replica strategy: {strategy}')
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(replicas=config.get('BLOGLY_REPLICAS', ()),
+                   strategy=config.get('BLOGLY_REPLICA_STRATEGY', 'round_robin'),
+                   sticky_seconds=config.get('BLOGLY_STICKY_SECONDS', 5))
+
+    def init_app(self, app):
+        missing = [key for key in self.replicas if key not in app.config.get('SQLALCHEMY_BINDS', {})]
+        if missing:
+            raise RuntimeError(f'Replica bind(s) not in SQLALCHEMY_BINDS: {", ".join(missing)}')
+        app.extensions['blogly_router'] = self
+        app.after_request(self.mark_write)
+
+    def choose(self, engines):
+        """Bind key of the replica for a new read-only session."""
+        if self.strategy == 'least_loaded':
+            return min(self.replicas, key=lambda key: connections_in_use(engines[key]))
+        with self._lock:
+            return self.replicas[next(self._turn) % len(self.replicas)]
+
+    def reads_from_replica(self):
+        """Whether the current request may read from a replica."""
+        if not self.replicas or not has_request_context() or request.method not in SAFE_METHODS:
+            return False
+        return session.get(STICKY_KEY, 0) <= time.time()
+
+    def mark_write(self, response):
+        """after_request hook: pin the browser to the primary after a write."""
+        if self.replicas and self.sticky_seconds > 0 and request.method not in SAFE_METHODS:
+            session[STICKY_KEY] = time.time() + self.sticky_seconds
+        return response
+
+
+def replica_lag(db_session):
+    """Seconds that the reads of db_session may lag behind the primary.
+
+    0 unless it read from a replica; then the sticky window, the lag the
+    router already assumes the replicas stay within.
+    """
+    if not db_session.info.get(REPLICA_KEY) or not has_app_context():
+        return 0
+    return current_app.extensions['blogly_router'].sticky_seconds
+
+
+class RoutingSession(Session):
+    """Session that sends the reads of read-only requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # A session opened on an explicit connection (e.g. in a test's
+        # transaction) always uses it.
+        if bind is None and self.bind is not None:
+            bind = self.bind
+        if bind is not None:
+            return bind
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            # Once the request has written, it reads from the primary too.
+            self.info[REPLICA_KEY] = False
+        router = current_app.extensions.get('blogly_router') if has_app_context() else None
+        if router is None or self.info.get(REPLICA_KEY) is False or not router.reads_from_replica():
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+        engines = self._db.engines
+        if REPLICA_KEY not in self.info:
+            self.info[REPLICA_KEY] = router.choose(engines)
+        return engines[self.info[REPLICA_KEY]]
+
@@ -0,0 +1,100 @@
+"""Run test.py split across parallel worker processes.
+
+    python runtests.py [--workers 4] [--memory] [--report 1,2,4] [-v]
+
+The test classes are dealt out to the workers, the largest first to the
+least loaded (by test count), and each worker runs its share, in file order,
+with `python -m unittest`. Every worker gets BLOGLY_TEST_WORKER=<n>, which gives
+it a database of its own (see config.test_database_url): a schema of the
+test database on Postgres, a file of its own with SQLite, or a memory
+database with --memory, which sets TEST_DATABASE_URL=sqlite://.
+
+--report runs the whole suite once per worker count given and prints the
+wall times as JSON. Exits with 1 when any worker fails, after printing its
+output.
+"""
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_classes(path=os.path.join(HERE, 'test.py')):
+    """{class name: test count} of the TestCase classes of test.py, read without importing it."""
+    with open(path, encoding='utf-8') as source:
+        tree = ast.parse(source.read())
+    classes = {}
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name.endswith('TestCase'):
+            tests = [item for item in node.body
+                     if isinstance(item, ast.FunctionDef) and item.name.startswith('test')]
+            if tests:
+                classes[node.name] = len(tests)
+    return classes
+
+
+def shard(classes, workers):
+    """Split {class name: test count} into at most workers lists of names of about the same size."""
+    shards = [[] for _ in range(min(workers, len(classes)))]
+    sizes = [0] * len(shards)
+    for name, count in sorted(classes.items(), key=lambda item: (-item[1], item[0])):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(name)
+        sizes[smallest] += count
+    # Each worker runs its classes in the order of the file, like a plain run.
+    order = list(classes)
+    return [sorted(names, key=order.index) for names in shards]
+
+
+def run(workers, env, verbose=False):
+    """Run the suite on workers processes. Returns (seconds, {worker: (returncode, output)})."""
+    started = time.perf_counter()
+    processes = {}
+    for worker, names in enumerate(shard(test_classes(), workers), 1):
+        command = [sys.executable, '-m', 'unittest', *(['-v'] if verbose else []),
+                   *(f'test.{name}' for name in names)]
+        processes[worker] = subprocess.Popen(command, cwd=HERE, env={**env, 'BLOGLY_TEST_WORKER': str(worker)},
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    results = {}
+    for worker, process in processes.items():
+        output, _ = process.communicate()
+        results[worker] = (process.returncode, output)
+    return time.perf_counter() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--memory', action='store_true', help='use in-memory SQLite databases')
+    parser.add_argument('--report', help='comma-separated worker counts to time the suite with')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.memory:
+        env['TEST_DATABASE_URL'] = 'sqlite://'
+    counts = [int(count) for count in args.report.split(',')] if args.report else [args.workers]
+
+    report, failed = {}, False
+    for workers in counts:
+        seconds, results = run(workers, env, args.verbose)
+        report[workers] = round(seconds, 2)
+        for worker, (returncode, output) in sorted(results.items()):
+            if returncode or args.verbose:
+                print(f'--- worker {worker} ---\n{output}', file=sys.stderr)
+            failed = failed or returncode != 0
+        print(f'{workers} worker(s): {seconds:.2f}s' + (' FAILED' if failed else ''), file=sys.stderr)
+    if args.report:
+        print(json.dumps({'database': env.get('TEST_DATABASE_URL', 'postgresql:///blogly_test'),
+                          'seconds_by_workers': report}, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
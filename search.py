@@ -0,0 +1,154 @@
+"""Full-text search over posts.
+
+On Postgres, posts are matched against the generated posts.search_vector
+column (GIN-indexed, title weighted above content), ranked with ts_rank and
+highlighted with ts_headline, with the tag filter in the same statement.
+Other databases (SQLite test runs) use an in-process inverted index built
+from the posts table and rebuilt whenever posts change.
+"""
+
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from markupsafe import Markup, escape
+from sqlalchemy import func, literal_column, select
+from models import db, Post, PostTag
+from cache import cache, ALL
+
+TS_CONFIG = 'english'
+# Placeholders ts_headline puts around matches, swapped for <mark> once the
+# snippet has been HTML-escaped.
+START_SEL, STOP_SEL = '\x02', '\x03'
+SNIPPET_WORDS = 30
+TITLE_WEIGHT = 2.0
+CONTENT_WEIGHT = 1.0
+
+_WORD = re.compile(r'\w+')
+
+
+class SearchResult:
+    """A matching post with its relevance and a highlighted snippet."""
+
+    def __init__(self, post, rank, snippet):
+        self.post = post
+        self.rank = rank
+        self.snippet = snippet
+
+    def __repr__(self):
+        return f'<SearchResult post={self.post.id} rank={self.rank:.3f}>'
+
+
+def _highlight(snippet):
+    """HTML-escape a snippet, then turn the match placeholders into <mark> tags."""
+    return Markup(str(escape(snippet)).replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>'))
+
+
+def _with_tags(statement, tag_ids):
+    """Keep only posts that have every one of tag_ids."""
+    if not tag_ids:
+        return statement
+    tagged = (select(PostTag.post_id)
+              .where(PostTag.tag_id.in_(tag_ids))
+              .group_by(PostTag.post_id)
+              .having(func.count() == len(set(tag_ids))))
+    return statement.where(Post.id.in_(tagged))
+
+
+def _postgresql_search(terms, tag_ids, limit, offset):
+    query = func.websearch_to_tsquery(TS_CONFIG, terms)
+    vector = literal_column('posts.search_vector')
+    rank = func.ts_rank(vector, query)
+    snippet = func.ts_headline(TS_CONFIG, func.coalesce(Post.content, ''), query,
+                               f'StartSel={START_SEL}, StopSel={STOP_SEL}, MaxWords={SNIPPET_WORDS}, MinWords=10')
+    statement = (select(Post, rank.label('rank'), snippet.label('snippet'))
+                 .where(vector.op('@@')(query))
+                 .order_by(rank.desc(), Post.id.desc())
+                 .limit(limit).offset(offset))
+    rows = db.session.execute(_with_tags(statement, tag_ids))
+    return [SearchResult(post, rank, _highlight(snippet)) for post, rank, snippet in rows]
+
+
+def tokenize(text):
+    return [word.lower() for word in _WORD.findall(text or '')]
+
+
+class InvertedIndex:
+    """In-process term -> {post_id: weighted term frequency} index."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = 0
+
+    def add(self, post_id, title, content):
+        self.documents += 1
+        weights = Counter()
+        for word in tokenize(title):
+            weights[word] += TITLE_WEIGHT
+        for word in tokenize(content):
+            weights[word] += CONTENT_WEIGHT
+        for word, weight in weights.items():
+            self.postings[word][post_id] = weight
+
+    def search(self, terms):
+        """Return [(post_id, score)] of posts containing every term, best first."""
+        words = set(tokenize(terms))
+        if not words:
+            return []
+        postings = [self.postings.get(word, {}) for word in words]
+        matches = set.intersection(*(set(posting) for posting in postings))
+        scores = {}
+        for post_id in matches:
+            # tf-idf: rare words count for more
+            scores[post_id] = sum(posting[post_id] * math.log(1 + self.documents / len(posting))
+                                  for posting in postings)
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+
+
+_index = None
+_index_versions = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The inverted index of all posts, rebuilt after any post has changed."""
+    global _index, _index_versions
+    versions = cache.backend.get_versions([ALL, 'posts'])
+    with _index_lock:
+        if _index is None or versions != _index_versions:
+            index = InvertedIndex()
+            for post_id, title, content in db.session.execute(select(Post.id, Post.title, Post.content)):
+                index.add(post_id, title, content)
+            _index, _index_versions = index, versions
+        return _index
+
+
+def _snippet(content, terms):
+    """Up to SNIPPET_WORDS words of content around the first match, matches highlighted."""
+    words = (content or '').split()
+    wanted = set(tokenize(terms))
+    first = next((i for i, word in enumerate(words) if set(tokenize(word)) & wanted), 0)
+    start = max(0, first - SNIPPET_WORDS // 3)
+    marked = [f'{START_SEL}{word}{STOP_SEL}' if set(tokenize(word)) & wanted else word
+              for word in words[start:start + SNIPPET_WORDS]]
+    return _highlight(' '.join(marked))
+
+
+def _fallback_search(terms, tag_ids, limit, offset):
+    ranked = get_index().search(terms)
+    if tag_ids:
+        allowed = set(db.session.execute(_with_tags(select(Post.id), tag_ids)).scalars())
+        ranked = [(post_id, score) for post_id, score in ranked if post_id in allowed]
+    ranked = ranked[offset:offset + limit]
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_([post_id for post_id, _ in ranked]))}
+    return [SearchResult(posts[post_id], score, _snippet(posts[post_id].content, terms))
+            for post_id, score in ranked if post_id in posts]
+
+
+def search_posts(terms, tag_ids=(), limit=20, offset=0):
+    """Posts matching terms (and having all of tag_ids), most relevant first."""
+    if not terms or not terms.strip():
+        return []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _postgresql_search(terms, list(tag_ids), limit, offset)
+    return _fallback_search(terms, list(tag_ids), limit, offset)
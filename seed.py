@@ -1,7 +1,12 @@
-"""Seed file to make sample data for blogly db."""
+"""Seed file to make sample data for blogly db.
+
+For large volumes of generated data, use `flask seed` (seeding.py).
+"""
 
 from models import User, db, Post, Tag, PostTag
-from app import app
+from app import create_app
+
+app = create_app()
 
 with app.app_context():
 
@@ -50,16 +55,16 @@ with app.app_context():
     db.session.commit()
 
     # Add posts_tags
-    pt_fun1 = PostTag(post_id=2, tag_id=1)
-    pt_fun2 = PostTag(post_id=3, tag_id=1)
-    pt_fun3 = PostTag(post_id=8, tag_id=1)
-    pt_flask = PostTag(post_id=1, tag_id=2)
-    pt_ig = PostTag(post_id=4, tag_id=3)
-    pt_pet1 = PostTag(post_id=3, tag_id=4)
-    pt_pet2 = PostTag(post_id=5, tag_id=4)
-    pt_pet3 = PostTag(post_id=7, tag_id=4)
-    pt_pet4 = PostTag(post_id=8, tag_id=4)
-    pt_sqla = PostTag(post_id=6, tag_id=5)
+    pt_fun1 = PostTag(post=summer_p2, tag=tag_fun)
+    pt_fun2 = PostTag(post=alan_p1, tag=tag_fun)
+    pt_fun3 = PostTag(post=jane_p3, tag=tag_fun)
+    pt_flask = PostTag(post=summer_p1, tag=tag_flask)
+    pt_ig = PostTag(post=joel_p1, tag=tag_ig)
+    pt_pet1 = PostTag(post=alan_p1, tag=tag_pet)
+    pt_pet2 = PostTag(post=joel_p2, tag=tag_pet)
+    pt_pet3 = PostTag(post=jane_p2, tag=tag_pet)
+    pt_pet4 = PostTag(post=jane_p3, tag=tag_pet)
+    pt_sqla = PostTag(post=jane_p1, tag=tag_sqla)
 
     db.session.add_all([pt_fun1, pt_fun2, pt_fun3, pt_flask, pt_ig, pt_pet1, pt_pet2, pt_pet3, pt_pet4, pt_sqla])
     db.session.commit()
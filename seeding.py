@@ -0,0 +1,245 @@
+"""Deterministic synthetic data for capacity testing, bulk loaded.
+
+    flask seed --users 100000 --posts 10000000 --tags 2000 --seed 1
+
+The same options and seed always produce the same rows. Authors and tags
+are drawn from power-law (Zipf) distributions, so a few users write most of
+the posts and a few tags are on most of them, as on a real blog. Rows are
+generated in batches and loaded with COPY on Postgres or executemany on
+other databases, in one transaction; the secondary indexes of posts and
+posts_tags are dropped for the load and rebuilt afterwards, and the id
+sequences, post counts and feeds are brought up to date at the end.
+"""
+
+import csv
+import io
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, text
+from models import db, User, Post, Tag, PostTag, POST_SEARCH_DDL
+from counters import recount_all
+from feeds import feeds
+from migrations import upgrade
+from cache import cache
+
+BATCH_SIZE = 50000
+DEFAULT_IMAGE_URL = User.__table__.c.image_url.default.arg
+# Exponents of the power laws: weight of the k-th most active author or
+# most used tag is 1 / k ** exponent.
+AUTHOR_EXPONENT = 0.8
+TAG_EXPONENT = 1.1
+WORD_EXPONENT = 1.0
+
+FIRST_NAMES = ['Alan', 'Ada', 'Grace', 'Joel', 'Jane', 'Summer', 'Linus', 'Barbara', 'Ken', 'Margaret',
+               'Dennis', 'Frances', 'Guido', 'Radia', 'Edsger', 'Katherine', 'Donald', 'Hedy', 'Tim', 'Shafi']
+LAST_NAMES = ['Turing', 'Lovelace', 'Hopper', 'Burton', 'Smith', 'Liskov', 'Torvalds', 'Thompson', 'Hamilton',
+              'Ritchie', 'Allen', 'Rossum', 'Perlman', 'Dijkstra', 'Johnson', 'Knuth', 'Lamarr', 'Berners-Lee',
+              'Goldwasser', 'Kay']
+WORDS = ('the of and to in is it that for on with as was at by this be from or have an are not but they '
+         'flask python sql query index table join post tag user blog database cache page server request '
+         'response session commit transaction pool replica search vector count trending feed dog cat pet '
+         'summer winter orion shepherd lab fun code test bench deploy release bug fix feature review merge '
+         'branch async thread process memory disk network latency throughput scale shard partition').split()
+
+# Posts are spread over the days before this, unless told otherwise, so
+# that a seed value always gives the same timestamps.
+UNTIL = datetime(2025, 1, 1)
+WORD_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) ** WORD_EXPONENT for rank in range(len(WORDS))))
+
+
+def zipf_cum_weights(count, exponent):
+    return list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+
+class Generator:
+    """Rows of a synthetic blog, the same for the same arguments.
+
+    Ids start after start_ids ({table name: last id in use}) so the rows can
+    be added to a database that already has some; tag names whose lower()
+    is in taken_tag_names are skipped, as the unique index would refuse them.
+    """
+
+    def __init__(self, users, posts, tags, seed=0, max_tags_per_post=3, days=365,
+                 until=None, start_ids=None, taken_tag_names=()):
+        self.user_count = users
+        self.post_count = posts
+        self.tag_count = tags
+        self.seed = seed
+        self.max_tags_per_post = max_tags_per_post
+        self.days = days
+        start_ids = start_ids or {}
+        self.first_user_id = start_ids.get('users', 0) + 1
+        self.first_post_id = start_ids.get('posts', 0) + 1
+        self.first_tag_id = start_ids.get('tags', 0) + 1
+        self.taken_tag_names = set(taken_tag_names)
+        self.until = until or UNTIL
+
+    def _random(self, stream):
+        # One stream per table, so changing one count leaves the other tables as they were.
+        return random.Random(f'{self.seed}:{stream}')
+
+    def users(self):
+        """(id, first_name, last_name, image_url) rows."""
+        rng = self._random('users')
+        for offset in range(self.user_count):
+            yield self.first_user_id + offset, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), DEFAULT_IMAGE_URL
+
+    def tags(self):
+        """(id, name) rows, the most used tags first."""
+        names = (f'{word}{n or ""}' for n in itertools.count() for word in WORDS)
+        names = (name for name in names if name.lower() not in self.taken_tag_names)
+        for offset, name in zip(range(self.tag_count), names):
+            yield self.first_tag_id + offset, name
+
+    def post_batches(self, batch_size=BATCH_SIZE):
+        """Lists of (post rows, posts_tags rows); posts are (id, title, content, created_at, user_id)."""
+        rng = self._random('posts')
+        user_ids = range(self.first_user_id, self.first_user_id + self.user_count)
+        tag_ids = range(self.first_tag_id, self.first_tag_id + self.tag_count)
+        author_weights = zipf_cum_weights(self.user_count, AUTHOR_EXPONENT)
+        tag_weights = zipf_cum_weights(self.tag_count, TAG_EXPONENT)
+        span = self.days * 86400
+
+        for start in range(0, self.post_count, batch_size):
+            count = min(batch_size, self.post_count - start)
+            authors = rng.choices(user_ids, cum_weights=author_weights, k=count)
+            posts, links = [], []
+            for offset, user_id in enumerate(authors):
+                post_id = self.first_post_id + start + offset
+                title = ' '.join(rng.choices(WORDS, cum_weights=WORD_WEIGHTS, k=rng.randint(2, 8))).capitalize()
+                content = ' '.join(rng.choices(WORDS, cum_weights=WORD_WEIGHTS, k=rng.randint(20, 120)))
+                created_at = self.until - timedelta(seconds=rng.randrange(span))
+                posts.append((post_id, title, content, created_at, user_id))
+                if tag_ids:
+                    wanted = rng.randint(0, self.max_tags_per_post)
+                    chosen = set(rng.choices(tag_ids, cum_weights=tag_weights, k=wanted))
+                    links.extend((post_id, tag_id) for tag_id in sorted(chosen))
+            yield posts, links
+
+
+class Loader:
+    """Writes rows to one table after another over a single connection."""
+
+    def __init__(self, conn, echo=click.echo):
+        self.conn = conn
+        self.postgres = conn.dialect.name == 'postgresql'
+        self.echo = echo
+        self.loaded = {}
+        self.started = time.perf_counter()
+
+    def load(self, table, columns, rows):
+        if not rows:
+            return
+        if self.postgres:
+            self._copy(table, columns, rows)
+        else:
+            self.conn.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+        self.loaded[table.name] = self.loaded.get(table.name, 0) + len(rows)
+
+    def _copy(self, table, columns, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = self.conn.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+
+    def progress(self, total_posts):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        rows = sum(self.loaded.values())
+        posts = self.loaded.get('posts', 0)
+        self.echo(f'{posts}/{total_posts} posts, {rows} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)')
+
+
+def _deferred_indexes():
+    return [index for model in (Post, PostTag) for index in model.__table__.indexes]
+
+
+def _drop_indexes(conn):
+    for index in _deferred_indexes():
+        index.drop(conn, checkfirst=True)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('DROP INDEX IF EXISTS ix_posts_search_vector'))
+
+
+def _create_indexes(conn):
+    for index in _deferred_indexes():
+        index.create(conn, checkfirst=True)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(POST_SEARCH_DDL[1]))
+
+
+def _reset_sequences(conn, models=(User, Post, Tag)):
+    if conn.dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__tablename__
+        conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                          f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"))
+
+
+def seed(users, posts, tags, seed=0, max_tags_per_post=3, batch_size=BATCH_SIZE, defer_indexes=True,
+         until=None, engine=None, echo=click.echo):
+    """Add generated users, posts and tags to the database. Returns {table: rows loaded}."""
+    if posts and not users:
+        raise ValueError('Generated posts need generated users to write them')
+    engine = engine if engine is not None else db.engine
+    with engine.begin() as conn:
+        start_ids = {model.__tablename__: conn.execute(select(func.coalesce(func.max(model.id), 0))).scalar()
+                     for model in (User, Post, Tag)}
+        taken = set(conn.execute(select(func.lower(Tag.name))).scalars())
+        generator = Generator(users, posts, tags, seed, max_tags_per_post, until=until, start_ids=start_ids,
+                              taken_tag_names=taken)
+        loader = Loader(conn, echo)
+        if defer_indexes:
+            _drop_indexes(conn)
+
+        users_table, tags_table = User.__table__, Tag.__table__
+        rows = list(generator.users())
+        for start in range(0, len(rows), batch_size):
+            loader.load(users_table, ('id', 'first_name', 'last_name', 'image_url'), rows[start:start + batch_size])
+        loader.load(tags_table, ('id', 'name'), list(generator.tags()))
+        for post_rows, link_rows in generator.post_batches(batch_size):
+            loader.load(Post.__table__, ('id', 'title', 'content', 'created_at', 'user_id'), post_rows)
+            loader.load(PostTag.__table__, ('post_id', 'tag_id'), link_rows)
+            loader.progress(posts)
+
+        if defer_indexes:
+            echo('Rebuilding indexes...')
+            _create_indexes(conn)
+        echo('Counting posts...')
+        recount_all(conn)
+        echo('Building feeds...')
+        feeds.rebuild_all(conn)
+        _reset_sequences(conn)
+    cache.clear()
+    loader.progress(posts)
+    return loader.loaded
+
+
+@click.command('seed')
+@click.option('--users', type=int, default=1000, show_default=True)
+@click.option('--posts', type=int, default=10000, show_default=True)
+@click.option('--tags', type=int, default=100, show_default=True)
+@click.option('--seed', 'seed_value', type=int, default=0, show_default=True, help='Random seed.')
+@click.option('--max-tags-per-post', type=int, default=3, show_default=True)
+@click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True)
+@click.option('--until', type=click.DateTime(), default=None,
+              help=f'Newest post time; posts cover the year before it. [default: {UNTIL:%Y-%m-%d}]')
+@click.option('--drop', is_flag=True, help='Drop and recreate all tables first.')
+@click.option('--keep-indexes', is_flag=True, help='Maintain indexes during the load instead of rebuilding them.')
+@with_appcontext
+def seed_command(users, posts, tags, seed_value, max_tags_per_post, batch_size, until, drop, keep_indexes):
+    """Load generated users, posts and tags for capacity testing."""
+    if drop:
+        db.drop_all()
+        upgrade()
+    loaded = seed(users, posts, tags, seed_value, max_tags_per_post, batch_size,
+                  defer_indexes=not keep_indexes, until=until)
+    click.echo(', '.join(f'{count} {table}' for table, count in loaded.items()) + ' loaded.')
@@ -0,0 +1,114 @@
+"""Process-local dictionary of the tags: id <-> name, without a query per page.
+
+Tags are few and rarely change, but every post form and the search page
+lists them all. The dictionary loads them once and keeps them until their
+version changes: any Tag insert, update or delete bumps the 'tags' key in
+the fragment cache backend (see cache.model_deps), as does clearing the
+cache, and the next lookup reloads. With a shared cache backend every
+worker sees the bump.
+
+The memory backend is per process, so another worker's bump goes unseen.
+Two things bound the staleness: the dictionary is reloaded at least every
+BLOGLY_TAG_DICTIONARY_TTL seconds (default 60), and a lookup that misses
+(an id in known(), a name in find()) asks the database before answering
+no, reloading if the tag is there after all. Misses are rare and cheap
+to check; a post form never drops a tag another worker just created, and
+a duplicate name is never accepted.
+
+The dictionary holds ids and names only; post counts are read from the
+table where they are shown.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import func, select
+from models import db, Tag, tag_name
+from cache import cache, ALL, TAGS
+
+TagEntry = namedtuple('TagEntry', 'id name')
+DEFAULT_TTL = 60
+
+
+class TagDictionary:
+    """All tags by id and by (case-insensitive) name, reloaded on a version bump."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.loads = 0
+        self._version = None
+        self._loaded_at = None
+        self._entries = []
+        self._by_id = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get('BLOGLY_TAG_DICTIONARY_TTL', self.ttl)
+        app.extensions['blogly_tag_dictionary'] = self
+
+    def _current(self):
+        # Read the version before the rows: a change in between makes the
+        # next lookup load again rather than keep stale rows.
+        version = cache.backend.get_versions({ALL, TAGS})
+        if version != self._version or self._expired():
+            with self._lock:
+                if version != self._version or self._expired():
+                    self._load(version)
+        return self
+
+    def _expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def _reload(self):
+        """Load again now, whatever the version says: the database has a tag we do not."""
+        version = cache.backend.get_versions({ALL, TAGS})
+        with self._lock:
+            self._load(version)
+        return self
+
+    def _load(self, version):
+        # From the primary, so a replica lagging behind the bump is not cached.
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(Tag.id, Tag.name).where(Tag.deleted_at.is_(None))
+                                .order_by(Tag.name, Tag.id)).all()
+        entries = [TagEntry(tag_id, name) for tag_id, name in rows]
+        self._by_id = {entry.id: entry for entry in entries}
+        self._by_name = {entry.name.casefold(): entry for entry in entries}
+        self._entries = entries
+        self._version = version
+        self._loaded_at = time.monotonic()
+        self.loads += 1
+
+    def all(self):
+        """Every tag, sorted by name."""
+        return list(self._current()._entries)
+
+    def get(self, tag_id):
+        """The tag with this id, or None."""
+        return self._current()._by_id.get(tag_id)
+
+    def find(self, name):
+        """The tag with this name, ignoring case and surrounding spaces, or None."""
+        name = tag_name(name)
+        key = name.casefold()
+        entry = self._current()._by_name.get(key)
+        if entry is None and any(found.casefold() == key for found
+                                 in self._live(Tag.name, func.lower(Tag.name) == name.lower())):
+            entry = self._reload()._by_name.get(key)
+        return entry
+
+    def known(self, tag_ids):
+        """The ids of tag_ids that belong to existing tags."""
+        by_id = self._current()._by_id
+        missing = {tag_id for tag_id in tag_ids if tag_id not in by_id}
+        if missing and self._live(Tag.id, Tag.id.in_(sorted(missing))):
+            by_id = self._reload()._by_id
+        return [tag_id for tag_id in tag_ids if tag_id in by_id]
+
+    def _live(self, column, condition):
+        """column of the tags that meet condition and are not deleted, read from the primary."""
+        with db.engine.connect() as conn:
+            return conn.execute(select(column).where(condition, Tag.deleted_at.is_(None))).scalars().all()
+
+tag_dictionary = TagDictionary()
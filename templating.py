@@ -0,0 +1,68 @@
+"""Template compilation and the shared rendering helpers of Blogly.
+
+Compiled templates are kept as bytecode in BLOGLY_TEMPLATE_CACHE_DIR
+(default: the instance folder), so a fresh process loads them without
+parsing the sources again; Jinja checks each entry against its source, so
+edited templates are recompiled. With BLOGLY_PRECOMPILE_TEMPLATES (on by
+default) every template is compiled at startup instead of on its first
+request.
+
+Posts and tags are rendered by the macros of templates/macros.html, and
+post dates by the memoized post_date filter (atom_date in the Atom feeds).
+"""
+
+import os
+from datetime import timezone
+from functools import lru_cache
+from flask import get_template_attribute
+from jinja2 import FileSystemBytecodeCache
+
+DATE_FORMAT = '%a %b %d %Y, %I:%M %p'
+# Distinct timestamps remembered by the date filter.
+DATE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def format_date(value):
+    """A post timestamp as shown on the pages, e.g. 'Wed Jan 01 2025, 09:30 AM'."""
+    return value.strftime(DATE_FORMAT)
+
+
+def format_atom_date(value):
+    """A timestamp in RFC 3339, as Atom feeds want it; naive ones are UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+
+def render_macro(template, name, *args, **kwargs):
+    """Call a macro of a template directly, without a full render_template()."""
+    return get_template_attribute(template, name)(*args, **kwargs)
+
+
+class Templates:
+    """Sets up the bytecode cache, the filters and precompilation for an app."""
+
+    def init_app(self, app):
+        app.config.setdefault('BLOGLY_TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+        app.config.setdefault('BLOGLY_PRECOMPILE_TEMPLATES', True)
+        app.extensions['blogly_templates'] = self
+
+        app.jinja_env.filters['post_date'] = format_date
+        app.jinja_env.filters['atom_date'] = format_atom_date
+        directory = app.config['BLOGLY_TEMPLATE_CACHE_DIR']
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        if app.config['BLOGLY_PRECOMPILE_TEMPLATES']:
+            self.precompile(app)
+
+    def precompile(self, app):
+        """Compile every template of the app (and its blueprints). Returns their names."""
+        names = app.jinja_env.list_templates(filter_func=lambda name: name.endswith(('.html', '.xml')))
+        for name in names:
+            app.jinja_env.get_template(name)
+        return names
+
+
+templates = Templates()
@@ -0,0 +1,350 @@
+"""Streaming export and import of the whole blog: users, tags, posts and links.
+
+    flask blogly export blogly.ndjson.gz
+    flask blogly export --format csv backup/
+    flask blogly import blogly.ndjson.gz [--chunk-size 10000]
+
+NDJSON exports are one gzipped file with a line per row, tagged with its
+table: {"table": "posts", "id": 1, "title": ...}. CSV exports are a
+directory with a gzipped CSV (with a header) per table. Either way the
+tables come in dependency order (users, tags, posts, posts_tags), and
+soft-deleted users and tags, with their posts and links, are left out.
+
+Both directions use constant memory. The export reads with a server-side
+cursor (yield_per), in one REPEATABLE READ transaction on Postgres so the
+tables are a consistent snapshot. The import commits every chunk of rows in
+its own transaction and upserts: users and posts by id, tags by name
+ignoring case, and links are skipped if present. A user or post keeps its id
+unless the target has an unrelated row there (one that differs in
+NATURAL_KEYS); it then gets a new id, and the posts and links that refer to
+it follow. An interrupted import can simply be run again. The post counts,
+feeds and id sequences are brought up to date at the end.
+
+In CSV an empty content or user_id is read back as NULL.
+"""
+
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import exists, insert, select, update
+from models import db, User, Post, Tag, PostTag, tag_name
+from associations import _INSERTS
+from counters import recount_all
+from feeds import feeds
+from seeding import _reset_sequences
+from cache import cache
+from writequeue import _find_tags, _key
+
+CHUNK_SIZE = 10000
+COMPRESS_LEVEL = 6
+FORMATS = ('ndjson', 'csv')
+
+users = User.__table__
+posts = Post.__table__
+tags = Tag.__table__
+posts_tags = PostTag.__table__
+
+COLUMNS = {
+    'users': ('id', 'first_name', 'last_name', 'image_url'),
+    'tags': ('id', 'name'),
+    'posts': ('id', 'title', 'content', 'created_at', 'user_id'),
+    'posts_tags': ('post_id', 'tag_id'),
+}
+TABLES = tuple(COLUMNS)
+
+# What makes an imported user or post the same as a row here: the row with
+# its id is only overwritten if it agrees on these, and a row that had to
+# move to a new id is found there again by them.
+NATURAL_KEYS = {
+    'users': ('first_name', 'last_name', 'image_url'),
+    'posts': ('user_id', 'created_at'),
+}
+
+
+def _live_post():
+    """Posts whose author is not soft-deleted."""
+    return ~exists().where(users.c.id == posts.c.user_id, users.c.deleted_at.is_not(None))
+
+
+EXPORTS = {
+    'users': select(*(users.c[name] for name in COLUMNS['users']))
+    .where(users.c.deleted_at.is_(None)).order_by(users.c.id),
+    'tags': select(*(tags.c[name] for name in COLUMNS['tags']))
+    .where(tags.c.deleted_at.is_(None)).order_by(tags.c.id),
+    'posts': select(*(posts.c[name] for name in COLUMNS['posts']))
+    .where(_live_post()).order_by(posts.c.id),
+    'posts_tags': select(posts_tags.c.post_id, posts_tags.c.tag_id)
+    .join(posts, posts.c.id == posts_tags.c.post_id).join(tags, tags.c.id == posts_tags.c.tag_id)
+    .where(_live_post(), tags.c.deleted_at.is_(None)).order_by(posts_tags.c.post_id, posts_tags.c.tag_id),
+}
+
+
+class Throughput:
+    """Rows per table and rows/s, reported through echo."""
+
+    def __init__(self, echo):
+        self.echo = echo
+        self.rows = {}
+        self.started = time.perf_counter()
+        self._table_started = self.started
+
+    def begin(self, table):
+        self.rows[table] = 0
+        self._table_started = time.perf_counter()
+
+    def add(self, table, count):
+        self.rows[table] += count
+
+    def end(self, table):
+        self._report(table, self.rows[table], time.perf_counter() - self._table_started)
+
+    def total(self):
+        self._report('total', sum(self.rows.values()), time.perf_counter() - self.started)
+
+    def _report(self, name, rows, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        self.echo(f'{name}: {rows} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)')
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot export {type(value).__name__} values')
+
+
+def _csv_path(path, table):
+    return os.path.join(path, f'{table}.csv.gz')
+
+
+def _write_ndjson(path, tables):
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=COMPRESS_LEVEL) as out:
+        for table, columns, chunks in tables:
+            for chunk in chunks:
+                out.writelines(json.dumps({'table': table, **dict(zip(columns, row))}, default=_json_default) + '\n'
+                               for row in chunk)
+
+
+def _write_csv(path, tables):
+    os.makedirs(path, exist_ok=True)
+    for table, columns, chunks in tables:
+        with gzip.open(_csv_path(path, table), 'wt', encoding='utf-8', newline='',
+                       compresslevel=COMPRESS_LEVEL) as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for chunk in chunks:
+                writer.writerows(chunk)
+
+
+def export_data(path, format='ndjson', chunk_size=CHUNK_SIZE, engine=None, echo=click.echo):
+    """Write every live row to path (a file for ndjson, a directory for csv). Returns {table: rows}."""
+    if format not in FORMATS:
+        raise ValueError(f'Unknown export format: {format}')
+    engine = engine if engine is not None else db.engine
+    throughput = Throughput(echo)
+    with engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        streaming = conn.execution_options(yield_per=chunk_size)
+
+        def chunks(table):
+            throughput.begin(table)
+            for chunk in streaming.execute(EXPORTS[table]).partitions():
+                throughput.add(table, len(chunk))
+                yield chunk
+            throughput.end(table)
+
+        tables = ((table, COLUMNS[table], chunks(table)) for table in TABLES)
+        (_write_ndjson if format == 'ndjson' else _write_csv)(path, tables)
+    throughput.total()
+    return throughput.rows
+
+
+def _int_or_none(value):
+    return None if value is None or value == '' else int(value)
+
+
+def _datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+CONVERTERS = {
+    'id': int, 'post_id': int, 'tag_id': int, 'user_id': _int_or_none, 'created_at': _datetime,
+    'content': lambda value: value if value != '' else None,
+}
+
+
+def _read_ndjson(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as lines:
+        for line in lines:
+            if line.strip():
+                row = json.loads(line)
+                yield row.pop('table'), row
+
+
+def _read_csv(path):
+    for table in TABLES:
+        if not os.path.exists(_csv_path(path, table)):
+            continue
+        with gzip.open(_csv_path(path, table), 'rt', encoding='utf-8', newline='') as lines:
+            for row in csv.DictReader(lines):
+                yield table, row
+
+
+def _chunks(records, chunk_size):
+    """(table, rows) runs of at most chunk_size rows of the same table."""
+    table, rows = None, []
+    for record_table, row in records:
+        if record_table not in COLUMNS:
+            raise ValueError(f'Unknown table in import: {record_table}')
+        if rows and (record_table != table or len(rows) >= chunk_size):
+            yield table, rows
+            rows = []
+        table = record_table
+        rows.append({name: CONVERTERS.get(name, str)(row[name]) if row.get(name) is not None else None
+                     for name in COLUMNS[table]})
+    if rows:
+        yield table, rows
+
+
+def _upsert(conn, table, rows, key):
+    statement = _INSERTS[conn.dialect.name](table)
+    updated = {name: statement.excluded[name] for name in rows[0] if name not in key}
+    conn.execute(statement.on_conflict_do_update(index_elements=key, set_=updated), rows)
+
+
+def _matches(table, row, key):
+    return [table.c[name].is_(None) if row[name] is None else table.c[name] == row[name] for name in key]
+
+
+def _import_rows(conn, model, rows, moved_ids):
+    """Upsert rows by id where the id is free or holds the same row (see NATURAL_KEYS).
+
+    A row whose id holds an unrelated row here goes to the row an earlier
+    import moved it to, or is inserted with a new id; {exported id: id here}
+    of those is recorded in moved_ids.
+    """
+    table = model.__table__
+    key = NATURAL_KEYS[table.name]
+    exported_ids = [row['id'] for row in rows]
+    here = {found.id: found for found in conn.execute(select(table.c.id, *(table.c[name] for name in key))
+                                                      .where(table.c.id.in_(exported_ids)))}
+    kept, moved = [], []
+    for row in rows:
+        found = here.get(row['id'])
+        same = found is None or all(getattr(found, name) == row[name] for name in key)
+        (kept if same else moved).append(row)
+    if kept:
+        _upsert(conn, table, kept, ['id'])
+    new = []
+    for row in moved:
+        values = {name: value for name, value in row.items() if name != 'id'}
+        # Not one of the rows of this chunk, which keep their own ids.
+        match = conn.execute(select(table.c.id).where(*_matches(table, row, key), table.c.id.not_in(exported_ids))
+                             .order_by(table.c.id.desc()).limit(1)).scalar()
+        if match is None:
+            new.append(row)
+        else:
+            conn.execute(update(table).where(table.c.id == match).values(values))
+            moved_ids[row['id']] = match
+    if new:
+        # The explicit ids above may have left the sequence behind.
+        _reset_sequences(conn, (model,))
+        statement = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+        inserted = conn.execute(statement, [{name: value for name, value in row.items() if name != 'id'}
+                                            for row in new]).scalars()
+        moved_ids.update(zip((row['id'] for row in new), inserted))
+
+
+def _import_tags(conn, rows, tag_ids):
+    """Upsert tags by name, ignoring case, and record {exported id: id here} in tag_ids."""
+    names = {tag_name(row['name']): row['id'] for row in rows}
+    found = _find_tags(conn, {_key(name) for name in names})
+    missing = [{'id': names[name], 'name': name} for name in sorted(names) if _key(name) not in found]
+    if missing:
+        # Keep the exported ids where they are free, so a restore is faithful.
+        statement = _INSERTS[conn.dialect.name](tags).on_conflict_do_nothing().returning(tags.c.name, tags.c.id)
+        found.update((_key(name), tag_id) for name, tag_id in conn.execute(statement, missing))
+        taken = [{'name': row['name']} for row in missing if _key(row['name']) not in found]
+        if taken:
+            # The explicit ids above left the sequence behind; without this the
+            # ids it hands out next could be among them.
+            _reset_sequences(conn, (Tag,))
+            found.update((_key(name), tag_id) for name, tag_id
+                         in conn.execute(insert(tags).returning(tags.c.name, tags.c.id), taken))
+    tag_ids.update((exported_id, found[_key(name)]) for name, exported_id in names.items())
+
+
+def _import_links(conn, rows, post_ids, tag_ids):
+    links = [{'post_id': post_ids.get(row['post_id'], row['post_id']),
+              'tag_id': tag_ids.get(row['tag_id'], row['tag_id'])} for row in rows]
+    conn.execute(_INSERTS[conn.dialect.name](posts_tags).on_conflict_do_nothing(), links)
+
+
+def import_data(path, chunk_size=CHUNK_SIZE, engine=None, echo=click.echo):
+    """Upsert the rows of an export (see export_data) chunk by chunk. Returns {table: rows}."""
+    engine = engine if engine is not None else db.engine
+    records = _read_csv(path) if os.path.isdir(path) else _read_ndjson(path)
+    throughput = Throughput(echo)
+    # The only state kept across chunks: the ids of the tags (which are few)
+    # and of the users and posts that had to move.
+    tag_ids, user_ids, post_ids = {}, {}, {}
+    current = None
+    for table, rows in _chunks(records, chunk_size):
+        if table != current:
+            if current is not None:
+                throughput.end(current)
+            throughput.begin(table)
+            current = table
+        with engine.begin() as conn:
+            if table == 'tags':
+                _import_tags(conn, rows, tag_ids)
+            elif table == 'posts_tags':
+                _import_links(conn, rows, post_ids, tag_ids)
+            elif table == 'users':
+                _import_rows(conn, User, rows, user_ids)
+            else:
+                for row in rows:
+                    row['user_id'] = user_ids.get(row['user_id'], row['user_id'])
+                _import_rows(conn, Post, rows, post_ids)
+        throughput.add(table, len(rows))
+    if current is not None:
+        throughput.end(current)
+
+    echo('Counting posts and building feeds...')
+    with engine.begin() as conn:
+        recount_all(conn)
+        feeds.rebuild_all(conn)
+        _reset_sequences(conn)
+    cache.clear()
+    throughput.total()
+    return throughput.rows
+
+
+@click.group('blogly')
+def blogly_command():
+    """Export and import the blog data."""
+
+
+@blogly_command.command('export')
+@click.argument('path', type=click.Path())
+@click.option('--format', 'format_', type=click.Choice(FORMATS), default='ndjson', show_default=True,
+              help='ndjson writes one gzipped file, csv a directory of gzipped files.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True, help='Rows fetched at a time.')
+@with_appcontext
+def export_command(path, format_, chunk_size):
+    """Export users, tags, posts and links to PATH."""
+    export_data(path, format_, chunk_size)
+
+
+@blogly_command.command('import')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True, help='Rows per transaction.')
+@with_appcontext
+def import_command(path, chunk_size):
+    """Import (upsert) an export from PATH, a file (ndjson) or a directory (csv)."""
+    import_data(path, chunk_size)
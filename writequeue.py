@@ -0,0 +1,234 @@
+"""Group commit of post inserts for high-rate ingest.
+
+Requests hand their posts to the write queue and wait. A single writer
+thread collects what arrives within BLOGLY_WRITE_BATCH_MS milliseconds (or
+up to BLOGLY_WRITE_BATCH_ROWS posts) and writes it all in one transaction:
+the tag names of the whole batch are resolved with one SELECT (and missing
+tags created with one INSERT), posts and links are inserted with one
+executemany each, the counters are adjusted once per user and tag, and the
+posts are appended to their feeds with one more INSERT. Each
+request is answered only after the commit of its batch returns, so an
+acknowledged post is durable.
+
+A request that times out waiting cancels its posts if the writer has not
+taken them yet, so they are never written behind its back; if the writer
+has, the request waits for that transaction instead of reporting a
+failure for posts that may still land.
+
+If a batch fails, its requests are retried one by one, so a bad request
+(e.g. an unknown user_id) only fails itself. Only the transaction is
+retried: the cache is invalidated after the commit, and a failure there is
+logged rather than writing the posts again.
+
+Tag names match ignoring case and surrounding spaces, like the tag
+dictionary: 'Python' and 'python' are the same tag.
+"""
+
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from sqlalchemy import func, insert, select
+from models import db, Post, Tag, PostTag, tag_name
+from associations import _INSERTS
+from cache import cache, TAGS
+from counters import adjust_tag_deltas, adjust_user_counts
+from feeds import feeds
+
+DEFAULT_BATCH_ROWS = 500
+DEFAULT_BATCH_MS = 5
+# How long a request waits for its batch before giving up.
+SUBMIT_TIMEOUT = 30
+
+posts = Post.__table__
+tags = Tag.__table__
+posts_tags = PostTag.__table__
+
+
+class Pending:
+    """Posts of one request and, once written, their ids or the error."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = None
+        self.error = None
+        self.done = threading.Event()
+        self.claimed = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def claim(self):
+        """For the writer: whether to write the posts, which they no longer can be cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self.claimed = True
+            return self.claimed
+
+    def cancel(self):
+        """For the request giving up: whether the posts will now never be written."""
+        with self._lock:
+            if not self.claimed:
+                self.cancelled = True
+            return self.cancelled
+
+
+class WriteQueue:
+    """Batches post inserts from concurrent requests into shared transactions."""
+
+    def __init__(self, batch_rows=DEFAULT_BATCH_ROWS, batch_ms=DEFAULT_BATCH_MS):
+        self.batch_rows = batch_rows
+        self.batch_ms = batch_ms
+        self.batches = 0
+        self.rows_written = 0
+        self._queue = queue.Queue()
+        self._app = None
+        self._engine = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.batch_rows = app.config.get('BLOGLY_WRITE_BATCH_ROWS', self.batch_rows)
+        self.batch_ms = app.config.get('BLOGLY_WRITE_BATCH_MS', self.batch_ms)
+        self._app = app
+        with app.app_context():
+            self._engine = db.engine
+        app.extensions['blogly_write_queue'] = self
+
+    def submit(self, rows, timeout=SUBMIT_TIMEOUT):
+        """Write posts and return their ids once committed.
+
+        rows are dicts with title, content, user_id, created_at (optional)
+        and tags (a list of tag names). Raises the error of the write, or
+        TimeoutError if the writer did not get to them in time, in which
+        case none of them is written.
+        """
+        pending = Pending(rows)
+        self._start()
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            if pending.cancel():
+                raise TimeoutError('The write queue did not get to the posts in time; none was written')
+            # The writer has them: the outcome is one transaction away.
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.ids
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='blogly-write-queue', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0].rows)
+            deadline = time.monotonic() + self.batch_ms / 1000
+            while count < self.batch_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                count += len(pending.rows)
+            batch = [pending for pending in batch if pending.claim()]
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            ids, deps = self._write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                batch[0].done.set()
+            else:
+                for pending in batch:
+                    self._write_batch([pending])
+            return
+
+        # Committed: from here on nothing may send the batch back for a retry.
+        self.batches += 1
+        self.rows_written += len(ids)
+        start = 0
+        for pending in batch:
+            pending.ids = ids[start:start + len(pending.rows)]
+            start += len(pending.rows)
+        try:
+            cache.invalidate(*deps)
+        except Exception:
+            self._app.logger.exception('Cache invalidation after a batch of %d posts failed', len(ids))
+        for pending in batch:
+            pending.done.set()
+
+    def _write(self, batch):
+        """Write the posts of batch in one transaction; returns (post ids, cache keys to invalidate)."""
+        rows = [row for pending in batch for row in pending.rows]
+        with self._engine.begin() as conn:
+            tag_ids, created = resolve_tags(conn, {name for row in rows for name in row.get('tags', ())})
+            now = datetime.now(timezone.utc)
+            values = [{'title': row['title'], 'content': row.get('content'), 'user_id': row['user_id'],
+                       'created_at': row.get('created_at') or now} for row in rows]
+            statement = insert(posts).returning(posts.c.id, sort_by_parameter_order=True)
+            ids = list(conn.execute(statement, values).scalars())
+            links = {(post_id, tag_ids[name]) for post_id, row in zip(ids, rows) for name in row.get('tags', ())}
+            if links:
+                conn.execute(insert(posts_tags), [{'post_id': post_id, 'tag_id': tag_id}
+                                                  for post_id, tag_id in sorted(links)])
+
+            adjust_user_counts(Counter(row['user_id'] for row in rows), conn)
+            adjust_tag_deltas(Counter(tag_id for _, tag_id in links), conn)
+            feeds.publish(ids, conn)
+
+        deps = ['posts', *{f'user:{row["user_id"]}' for row in rows},
+                *{f'tag:{tag_id}' for _, tag_id in links}, *([TAGS] if created else [])]
+        return ids, deps
+
+
+def _key(name):
+    return tag_name(name).casefold()
+
+
+def resolve_tags(conn, names):
+    """({name: tag id} for names, whether tags were created), creating the missing ones.
+
+    Names that differ only in case or surrounding spaces resolve to the same
+    tag; a missing tag is created with the first of its spellings in sorted
+    order.
+    """
+    if not names:
+        return {}, False
+    spellings = {}
+    for name in sorted(names):
+        spellings.setdefault(_key(name), tag_name(name))
+    found = _find_tags(conn, spellings)
+    missing = sorted(spellings.keys() - found.keys())
+    created = bool(missing)
+    if missing:
+        statement = _INSERTS[conn.dialect.name](tags).on_conflict_do_nothing().returning(tags.c.name, tags.c.id)
+        found.update((_key(name), tag_id) for name, tag_id
+                     in conn.execute(statement, [{'name': spellings[key]} for key in missing]))
+        # Tags created by a concurrent transaction in the meantime.
+        missing = sorted(spellings.keys() - found.keys())
+        if missing:
+            found.update(_find_tags(conn, missing))
+    return {name: found[_key(name)] for name in names}, created
+
+
+def _find_tags(conn, keys):
+    """{key: tag id} of the existing tags whose names match keys (see _key())."""
+    # lower() narrows the rows down in the database; casefold() decides.
+    rows = conn.execute(select(tags.c.name, tags.c.id).where(func.lower(tags.c.name).in_(sorted(keys)),
+                                                             tags.c.deleted_at.is_(None)))
+    found = {}
+    for name, tag_id in sorted(rows, key=lambda row: row.id):
+        found.setdefault(_key(name), tag_id)
+    return {key: tag_id for key, tag_id in found.items() if key in keys}
+
+
+write_queue = WriteQueue()